@@ -42,6 +42,11 @@ def create_app(config_name):
         compress.init_app(app)
         RQ(app)
 
+        from .search import analyzer, query_cache, search_index
+        analyzer.init_app(app)
+        query_cache.init_app(app)
+        search_index.init_app(app)
+
         # Register Jinja template functions
         from .utils import register_template_utils
         register_template_utils(app)
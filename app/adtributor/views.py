@@ -10,14 +10,12 @@ from flask import (
     send_file
 )
 
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from nltk.stem.snowball import SnowballStemmer
 from flask_login import login_required, current_user
 from flask_rq import get_queue
 
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
 
 from app import db, csrf
 from app.adtributor.forms import (
@@ -46,12 +44,13 @@ from app.models import (
     Suggestion,
     Document,
     Tagged,
-    Idf,
-    Saved
+    Posting,
+    Saved,
+    CorpusStats
 )
 
-from collections import Counter
 from app.email import send_email
+from app.search import analyzer, search_index
 import csv
 import io
 import datetime
@@ -314,7 +313,7 @@ def manage_tags():
                     )
                     db.session.add(tagged)
         try:
-            db.session.commit()
+            commit_corpus_change()
             db.session.flush()
             flash(
                 'Tags successfully created', 'form-success'
@@ -349,7 +348,7 @@ def delete_tag(id):
     Tagged.query.filter_by(tag_id=tag.id).delete()
     db.session.delete(tag)
     try:
-        db.session.commit()
+        commit_corpus_change()
         flash(
             'Tag \"{}\" successfully deleted'.format(
                 tag.tag), 'form-success')
@@ -425,10 +424,10 @@ def publish_contribution(id):
     """Contribution Review page."""
     contribution = Document.query.filter_by(id=id).first()
     if contribution.document_status == "published":
-        contribution.document_status = "draft"
+        set_document_status(contribution, "draft")
     else:
-        contribution.document_status = "published"
-    db.session.commit()
+        set_document_status(contribution, "published")
+    commit_corpus_change()
     return redirect(url_for('admin.review_contributions'))
 
 
@@ -441,10 +440,10 @@ def publish_draft(id):
     """Contribution Review page."""
     contribution = Document.query.filter_by(id=id).first()
     if contribution.document_status == "published":
-        contribution.document_status = "draft"
+        set_document_status(contribution, "draft")
     else:
-        contribution.document_status = "published"
-    db.session.commit()
+        set_document_status(contribution, "published")
+    commit_corpus_change()
     return redirect(url_for('admin.view_all_drafts'))
 
 
@@ -458,12 +457,12 @@ def toggle_publish():
         current_user.first_name + ' ' + current_user.last_name
     contribution.last_edited_date = datetime.datetime.utcnow()
     if contribution.document_status == "published":
-        contribution.document_status = "under review"
-        db.session.commit()
+        set_document_status(contribution, "under review")
+        commit_corpus_change()
         return jsonify(status='Publish')
     else:
-        contribution.document_status = "published"
-        db.session.commit()
+        set_document_status(contribution, "published")
+        commit_corpus_change()
         return jsonify(status='Unpublish')
 
 
@@ -1605,10 +1604,14 @@ def delete_draft(id):
     if draft is None:
         abort(404)
     Tagged.query.filter_by(document_id=id).delete()
-    update_idf(pre_tf=draft.tf, post_tf={}, doc_id=id)
+    update_idf(
+        pre_tf=draft.tf, post_tf={}, doc_id=id,
+        pre_status=draft.document_status
+    )
     db.session.delete(draft)
     try:
-        db.session.commit()
+        commit_corpus_change()
+        search_index.remove(id)
         flash(
             'Draft {} successfully deleted'.format(
                 draft.title), 'form-success')
@@ -1628,10 +1631,14 @@ def delete_entry(id):
     if entry is None:
         abort(404)
     Tagged.query.filter_by(document_id=id).delete()
-    update_idf(pre_tf=entry.tf, post_tf={}, doc_id=id)
+    update_idf(
+        pre_tf=entry.tf, post_tf={}, doc_id=id,
+        pre_status=entry.document_status
+    )
     db.session.delete(entry)
     try:
-        db.session.commit()
+        commit_corpus_change()
+        search_index.remove(id)
     except IntegrityError:
         db.session.rollback()
         flash('Error occurred. Please try again.', 'form-error')
@@ -1655,13 +1662,10 @@ def view_broken_links():
 
 
 def save_or_submit_doc(form, doc_type, submit, entry=None):
-    stemmer = SnowballStemmer("english", ignore_stopwords=True)
-    stop_words = set(stopwords.words('english'))
-
     def update_sql_object(object, kwargs):
         for k, v in kwargs.items():
             setattr(object, k, v)
-        db.session.commit()
+        db.session.flush()
 
     if doc_type == 'news_article':
         article_form = form
@@ -1674,6 +1678,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'author_last_name':
                 ','.join(article_form.article_author_last_name.data),
             'last_edited_by': current_user.id,
+            'last_edited_date': datetime.datetime.utcnow(),
             'publisher': article_form.article_publication.data,
             'day': article_form.article_publication_day.data,
             'month': article_form.article_publication_month.data,
@@ -1685,7 +1690,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'broken_link': NOT_BROKEN,
         }
         if entry is not None:
-            corpus = entry.corpus
+            pre_status = entry.document_status
             if entry.link == article_form.article_link.data:
                 kwargs['broken_link'] = entry.broken_link
             update_sql_object(entry, kwargs)
@@ -1694,23 +1699,24 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             kwargs['posted_by'] = current_user.id
             article = Document(**kwargs)
             db.session.add(article)
-            corpus = article.corpus
-            db.session.commit()
+            db.session.flush()
             entry = article
 
-        word_tokens = word_tokenize(corpus)
-        filtered_corpus = [
-            stemmer.stem(w) for w in word_tokens if w not in stop_words
-        ]
-        new_tf = Counter(filtered_corpus)
+        length, new_tf, positions = analyzer.term_positions(entry.corpus)
 
         if new:
-            update_idf(pre_tf={}, post_tf=new_tf, doc_id=article.id)
+            update_idf(
+                pre_tf={}, post_tf=new_tf, doc_id=article.id,
+                post_status=submit, positions=positions
+            )
 
         else:
-            update_idf(pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id)
+            update_idf(
+                pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id,
+                pre_status=pre_status, post_status=submit, positions=positions
+            )
 
-        entry.tf = Counter(filtered_corpus)
+        entry.length = length
 
         Tagged.query.filter_by(document_id=entry.id).delete()
         tag_ids = [int(x) for x in article_form.article_tags.data]
@@ -1722,7 +1728,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             )
             db.session.add(tagged)
 
-        db.session.commit()
+        commit_corpus_change()
         flash(
             'Article \"{}\" successfully submitted'.format(
                 article_form.article_title.data), 'form-success')
@@ -1744,6 +1750,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'editor_last_name':
                 ','.join(book_form.book_editor_last_name.data),
             'last_edited_by': current_user.id,
+            'last_edited_date': datetime.datetime.utcnow(),
             'publisher': book_form.book_publisher.data,
             'month': book_form.book_publication_month.data,
             'year': book_form.book_publication_year.data,
@@ -1754,7 +1761,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'broken_link': NOT_BROKEN,
         }
         if entry is not None:
-            corpus = entry.corpus
+            pre_status = entry.document_status
             if entry.link == book_form.book_link.data:
                 kwargs['broken_link'] = entry.broken_link
             update_sql_object(entry, kwargs)
@@ -1763,23 +1770,24 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             kwargs['posted_by'] = current_user.id
             article = Document(**kwargs)
             db.session.add(article)
-            corpus = article.corpus
-            db.session.commit()
+            db.session.flush()
             entry = article
 
-        word_tokens = word_tokenize(corpus)
-        filtered_corpus = [
-            stemmer.stem(w) for w in word_tokens if w not in stop_words
-        ]
-        new_tf = Counter(filtered_corpus)
+        length, new_tf, positions = analyzer.term_positions(entry.corpus)
 
         if new:
-            update_idf(pre_tf={}, post_tf=new_tf, doc_id=article.id)
+            update_idf(
+                pre_tf={}, post_tf=new_tf, doc_id=article.id,
+                post_status=submit, positions=positions
+            )
 
         else:
-            update_idf(pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id)
+            update_idf(
+                pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id,
+                pre_status=pre_status, post_status=submit, positions=positions
+            )
 
-        entry.tf = Counter(filtered_corpus)
+        entry.length = length
 
         Tagged.query.filter_by(document_id=entry.id).delete()
         tag_ids = [int(x) for x in book_form.book_tags.data]
@@ -1791,7 +1799,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             )
             db.session.add(tagged)
 
-        db.session.commit()
+        commit_corpus_change()
         flash(
             'Book \"{}\" successfully saved'.format(
                 book_form.book_title.data), 'form-success')
@@ -1807,6 +1815,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'author_last_name':
                 ','.join(journal_form.journal_author_last_name.data),
             'last_edited_by': current_user.id,
+            'last_edited_date': datetime.datetime.utcnow(),
             'publisher': journal_form.journal_publication.data,
             'volume': journal_form.journal_volume.data,
             'page_start': journal_form.journal_start_page.data,
@@ -1821,7 +1830,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'broken_link': NOT_BROKEN,
         }
         if entry is not None:
-            corpus = entry.corpus
+            pre_status = entry.document_status
             if entry.link == journal_form.journal_link.data:
                 kwargs['broken_link'] = entry.broken_link
             update_sql_object(entry, kwargs)
@@ -1830,23 +1839,24 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             kwargs['posted_by'] = current_user.id
             article = Document(**kwargs)
             db.session.add(article)
-            corpus = article.corpus
-            db.session.commit()
+            db.session.flush()
             entry = article
 
-        word_tokens = word_tokenize(corpus)
-        filtered_corpus = [
-            stemmer.stem(w) for w in word_tokens if w not in stop_words
-        ]
-        new_tf = Counter(filtered_corpus)
+        length, new_tf, positions = analyzer.term_positions(entry.corpus)
 
         if new:
-            update_idf(pre_tf={}, post_tf=new_tf, doc_id=article.id)
+            update_idf(
+                pre_tf={}, post_tf=new_tf, doc_id=article.id,
+                post_status=submit, positions=positions
+            )
 
         else:
-            update_idf(pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id)
+            update_idf(
+                pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id,
+                pre_status=pre_status, post_status=submit, positions=positions
+            )
 
-        entry.tf = Counter(filtered_corpus)
+        entry.length = length
 
         Tagged.query.filter_by(document_id=entry.id).delete()
         tag_ids = [int(x) for x in journal_form.journal_tags.data]
@@ -1858,7 +1868,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             )
             db.session.add(tagged)
 
-        db.session.commit()
+        commit_corpus_change()
 
         flash(
             'Article \"{}\" successfully saved'.format(
@@ -1874,6 +1884,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'citation': law_form.law_citation.data,
             'region': law_form.law_region.data,
             'last_edited_by': current_user.id,
+            'last_edited_date': datetime.datetime.utcnow(),
             'title': law_form.law_title.data,
             'description': law_form.law_description.data,
             'country': law_form.law_country.data,
@@ -1886,7 +1897,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
         }
 
         if entry is not None:
-            corpus = entry.corpus
+            pre_status = entry.document_status
             if entry.link == law_form.law_link.data:
                 kwargs['broken_link'] = entry.broken_link
             update_sql_object(entry, kwargs)
@@ -1895,23 +1906,24 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             kwargs['posted_by'] = current_user.id
             article = Document(**kwargs)
             db.session.add(article)
-            corpus = article.corpus
-            db.session.commit()
+            db.session.flush()
             entry = article
 
-        word_tokens = word_tokenize(corpus)
-        filtered_corpus = [
-            stemmer.stem(w) for w in word_tokens if w not in stop_words
-        ]
-        new_tf = Counter(filtered_corpus)
+        length, new_tf, positions = analyzer.term_positions(entry.corpus)
 
         if new:
-            update_idf(pre_tf={}, post_tf=new_tf, doc_id=article.id)
+            update_idf(
+                pre_tf={}, post_tf=new_tf, doc_id=article.id,
+                post_status=submit, positions=positions
+            )
 
         else:
-            update_idf(pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id)
+            update_idf(
+                pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id,
+                pre_status=pre_status, post_status=submit, positions=positions
+            )
 
-        entry.tf = Counter(filtered_corpus)
+        entry.length = length
 
         Tagged.query.filter_by(document_id=entry.id).delete()
         tag_ids = [int(x) for x in law_form.law_tags.data]
@@ -1923,7 +1935,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             )
             db.session.add(tagged)
 
-        db.session.commit()
+        commit_corpus_change()
         flash(
             'Law \"{}\" successfully saved'.format(
                 law_form.law_title.data), 'form-success')
@@ -1936,6 +1948,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'author_first_name': ','.join(video_form.director_first_name.data),
             'author_last_name': ','.join(video_form.director_last_name.data),
             'last_edited_by': current_user.id,
+            'last_edited_date': datetime.datetime.utcnow(),
             'series': video_form.video_series.data,
             'source': video_form.video_source.data,
             'publisher': video_form.video_publisher.data,
@@ -1952,7 +1965,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
         }
 
         if entry is not None:
-            corpus = entry.corpus
+            pre_status = entry.document_status
             if entry.link == video_form.video_link.data:
                 kwargs['broken_link'] = entry.broken_link
             update_sql_object(entry, kwargs)
@@ -1962,23 +1975,24 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             article = Document(**kwargs)
             kwargs['posted_by'] = current_user.id
             db.session.add(article)
-            corpus = article.corpus
-            db.session.commit()
+            db.session.flush()
             entry = article
 
-        word_tokens = word_tokenize(corpus)
-        filtered_corpus = [
-            stemmer.stem(w) for w in word_tokens if w not in stop_words
-        ]
-        new_tf = Counter(filtered_corpus)
+        length, new_tf, positions = analyzer.term_positions(entry.corpus)
 
         if new:
-            update_idf(pre_tf={}, post_tf=new_tf, doc_id=article.id)
+            update_idf(
+                pre_tf={}, post_tf=new_tf, doc_id=article.id,
+                post_status=submit, positions=positions
+            )
 
         else:
-            update_idf(pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id)
+            update_idf(
+                pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id,
+                pre_status=pre_status, post_status=submit, positions=positions
+            )
 
-        entry.tf = Counter(filtered_corpus)
+        entry.length = length
 
         Tagged.query.filter_by(document_id=entry.id).delete()
         tag_ids = [int(x) for x in video_form.video_tags.data]
@@ -1990,7 +2004,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             )
             db.session.add(tagged)
 
-        db.session.commit()
+        commit_corpus_change()
         flash(
             'Video \"{}\" successfully saved'.format(
                 video_form.video_title.data), 'form-success')
@@ -2006,6 +2020,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'author_last_name':
                 ','.join(report_form.report_author_last_name.data),
             'last_edited_by': current_user.id,
+            'last_edited_date': datetime.datetime.utcnow(),
             'publisher': report_form.report_publisher.data,
             'day': report_form.report_publication_day.data,
             'month': report_form.report_publication_month.data,
@@ -2017,7 +2032,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'broken_link': NOT_BROKEN,
         }
         if entry is not None:
-            corpus = entry.corpus
+            pre_status = entry.document_status
             if entry.link == report_form.report_link.data:
                 kwargs['broken_link'] = entry.broken_link
             update_sql_object(entry, kwargs)
@@ -2026,23 +2041,24 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             kwargs['posted_by'] = current_user.id
             article = Document(**kwargs)
             db.session.add(article)
-            corpus = article.corpus
-            db.session.commit()
+            db.session.flush()
             entry = article
 
-        word_tokens = word_tokenize(corpus)
-        filtered_corpus = [
-            stemmer.stem(w) for w in word_tokens if w not in stop_words
-        ]
-        new_tf = Counter(filtered_corpus)
+        length, new_tf, positions = analyzer.term_positions(entry.corpus)
 
         if new:
-            update_idf(pre_tf={}, post_tf=new_tf, doc_id=article.id)
+            update_idf(
+                pre_tf={}, post_tf=new_tf, doc_id=article.id,
+                post_status=submit, positions=positions
+            )
 
         else:
-            update_idf(pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id)
+            update_idf(
+                pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id,
+                pre_status=pre_status, post_status=submit, positions=positions
+            )
 
-        entry.tf = Counter(filtered_corpus)
+        entry.length = length
 
         Tagged.query.filter_by(document_id=entry.id).delete()
         tag_ids = [int(x) for x in report_form.report_tags.data]
@@ -2054,7 +2070,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             )
             db.session.add(tagged)
 
-        db.session.commit()
+        commit_corpus_change()
         flash(
             'Report \"{}\" successfully saved'.format(
                 report_form.report_title.data), 'form-success')
@@ -2072,6 +2088,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'posted_by': current_user.id,
             'last_edited_by':
                 current_user.first_name + " " + current_user.last_name,
+            'last_edited_date': datetime.datetime.utcnow(),
             'day': other_form.other_publication_day.data,
             'month': other_form.other_publication_month.data,
             'year': other_form.other_publication_year.data,
@@ -2084,7 +2101,7 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             'broken_link': NOT_BROKEN,
         }
         if entry is not None:
-            corpus = entry.corpus
+            pre_status = entry.document_status
             if entry.link == other_form.other_link.data:
                 kwargs['broken_link'] = entry.broken_link
             update_sql_object(entry, kwargs)
@@ -2092,23 +2109,24 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             new = True
             article = Document(**kwargs)
             db.session.add(article)
-            corpus = article.corpus
-            db.session.commit()
+            db.session.flush()
             entry = article
 
-        word_tokens = word_tokenize(corpus)
-        filtered_corpus = [
-            stemmer.stem(w) for w in word_tokens if w not in stop_words
-        ]
-        new_tf = Counter(filtered_corpus)
+        length, new_tf, positions = analyzer.term_positions(entry.corpus)
 
         if new:
-            update_idf(pre_tf={}, post_tf=new_tf, doc_id=article.id)
+            update_idf(
+                pre_tf={}, post_tf=new_tf, doc_id=article.id,
+                post_status=submit, positions=positions
+            )
 
         else:
-            update_idf(pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id)
+            update_idf(
+                pre_tf=entry.tf, post_tf=new_tf, doc_id=entry.id,
+                pre_status=pre_status, post_status=submit, positions=positions
+            )
 
-        entry.tf = Counter(filtered_corpus)
+        entry.length = length
 
         Tagged.query.filter_by(document_id=entry.id).delete()
         tag_ids = [int(x) for x in other_form.other_tags.data]
@@ -2120,32 +2138,73 @@ def save_or_submit_doc(form, doc_type, submit, entry=None):
             )
             db.session.add(tagged)
 
-        db.session.commit()
+        commit_corpus_change()
         flash(
             'Other \"{}\" successfully saved'.format(
                 other_form.other_title.data), 'form-success')
 
 
-def update_idf(doc_id, pre_tf, post_tf):
-    pre_set = set(pre_tf.keys())
-    post_set = set(post_tf.keys())
-    remove_set = pre_set.difference(post_set)
-    add_set = post_set.difference(pre_set)
-
-    terms = Idf.query.filter(Idf.term.in_(list(remove_set))).all()
-    for term in terms:
-        if doc_id in term.docs:
-            term.docs.remove(doc_id)
-    
-    terms = Idf.query.filter(Idf.term.in_(list(add_set))).all()
-    for term in terms:
-        if doc_id not in term.docs:
-            term.docs.append(doc_id)
-
-    for i in add_set - {term.term for term in terms}:
-        db.session.add(Idf(term=i, docs=[doc_id]))
-        
+def update_idf(doc_id, pre_tf, post_tf, pre_status=None, post_status=None,
+               positions=None):
+    """
+    Move a document's postings from `pre_tf` to `post_tf` and its share of
+    the published statistics from `pre_status` to `post_status`. A status of
+    None means the document does not exist on that side of the change.
+    `positions` are the term positions of Analyzer.term_positions.
+    """
+    CorpusStats.lock()
+    pre_tf = pre_tf or {}
+    Posting.update_document(doc_id, pre_tf, post_tf, positions=positions)
+    CorpusStats.document_changed(pre_status, pre_tf, post_status, post_tf)
+    db.session.flush()
+    after_commit(
+        search_index.update,
+        doc_id, post_tf, post_status == 'published', positions)
+
+
+def set_document_status(document, status):
+    """Change a document's status, keeping the published statistics in step."""
+    CorpusStats.lock()
+    tf = document.tf or {}
+    CorpusStats.document_changed(document.document_status, tf, status, tf)
+    document.document_status = status
+    after_commit(
+        search_index.set_published, document.id, status == 'published')
+
+
+def after_commit(change, *args):
+    """
+    Call `change` with `args` once commit_corpus_change has committed the
+    current transaction, so the in-memory index only ever reflects
+    committed changes.
+    """
+    db.session.info.setdefault('index_changes', []).append((change, args))
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_index_changes(session, previous_transaction):
+    """Drop the index changes of a rolled back transaction."""
+    session.info.pop('index_changes', None)
+
+
+def commit_corpus_change():
+    """
+    Commit a change to searchable documents, bumping the corpus version so
+    that every worker drops its cached searches, then apply it to this
+    worker's index and refresh the search facets of the documents it
+    touched. The corpus_stats row stays locked from the first change to
+    the commit, so activate_generation cannot switch generations between
+    them.
+    """
+    CorpusStats.lock()
+    version = CorpusStats.bump()
     db.session.commit()
+    for change, args in db.session.info.pop('index_changes', ()):
+        change(*args)
+    search_index.advance(version)
+    changed = db.session.info.pop('facet_changes', None)
+    if changed and search_index.loaded:
+        search_index.facets.refresh(changed)
 
 
 def update_tags(doc_id, tags):
@@ -2159,14 +2218,14 @@ def update_tags(doc_id, tags):
             if not tag:
                 tag = Tag(tag=t)
                 db.session.add(tag)
-                db.session.commit()
+                db.session.flush()
             tagged = Tagged(
                 tag_id=tag.id,
                 document_id=doc_id,
                 tag_name=tag.tag
             )
             db.session.add(tagged)
-            db.session.commit()
+            db.session.flush()
 
 
 @admin.route('/ignore_link/<int:id>', methods=['GET', 'POST'])
@@ -2457,8 +2516,6 @@ def upload_and_download():
                              mimetype='text/csv')
 
         else:
-            stemmer = SnowballStemmer("english", ignore_stopwords=True)
-            stop_words = set(stopwords.words('english'))
             f = request.files['book-file']
             name = f.filename
             stream = io.StringIO(f.stream.read().decode("UTF8"), newline=None)
@@ -2471,9 +2528,7 @@ def upload_and_download():
                 for row in csv_input:
                     document = None
                     tags = None
-                    now = datetime.datetime.utcnow().strftime(
-                        "%a %b %d %H:%M:%S %Z %Y"
-                    )
+                    now = datetime.datetime.utcnow()
                     if header_row:
                         header_row = False
                         continue
@@ -2486,9 +2541,13 @@ def upload_and_download():
                     if row[0] and row[0] in document_ids:
                         is_new_document = False
                         entry = Document.query.filter_by(id=row[0]).first()
-                        update_idf(pre_tf=entry.tf, post_tf={}, doc_id=entry.id)
+                        update_idf(
+                            pre_tf=entry.tf, post_tf={}, doc_id=entry.id,
+                            pre_status=entry.document_status
+                        )
                         Tagged.query.filter_by(document_id=entry.id).delete()
                         db.session.delete(entry)
+                        after_commit(search_index.remove, entry.id)
                     else:
                         row[0] = None
 
@@ -2739,16 +2798,18 @@ def upload_and_download():
                             document.posted_date = now
                             document.posted_by = cu_id
                         db.session.add(document)
-                        db.session.commit()
+                        db.session.flush()
                         doc_id = document.id
-                        word_tokens = word_tokenize(document.corpus)
-                        filtered_corpus = [
-                            stemmer.stem(w) for w in word_tokens if w not in stop_words
-                        ]
-                        new_tf = Counter(filtered_corpus)
-                        document.tf = new_tf
-                        update_idf(pre_tf={}, post_tf=new_tf, doc_id=doc_id)
+                        length, new_tf, positions = analyzer.term_positions(
+                            document.corpus)
+                        document.length = length
+                        update_idf(
+                            pre_tf={}, post_tf=new_tf, doc_id=doc_id,
+                            post_status=document.document_status,
+                            positions=positions
+                        )
                         update_tags(doc_id=doc_id, tags=tags)
+                        commit_corpus_change()
 
             thread = threading.Thread(target=populate_db)
             thread.start()
@@ -46,8 +46,14 @@ class SearchForm(Form):
         multiple=True,
         allow_custom=False
     )
+    tag_match = CustomSelectField(
+        default='any',
+        choices=[
+            ('any', 'Any tag'),
+            ('all', 'All tags'),
+        ])
     sort_by = CustomSelectField(
-        default='Most Relevant',
+        default='most_relevant',
         choices=[
             ('most_relevant', 'Most Relevant'),
             ('title', 'Title'),
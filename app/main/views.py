@@ -1,8 +1,7 @@
 import json
+import re
 import time
 import boto3
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
 from flask import (
     Blueprint,
     flash,
@@ -18,24 +17,26 @@ from app.models import (
     Saved,
     User,
     Suggestion,
-    Idf,
-    Tagged
+    Tagged,
+    CorpusStats
 )
+from app.models.document import MONTHS, publication_key
 from flask_login import current_user, login_required
 from app.decorators import contributor_required, admin_required
 from app.main.forms import SuggestionForm, SearchForm
+from app.search import analyzer, query_cache, search_index
+from app.search.results import load_summaries
 from app import db
 
 import atexit
 from apscheduler.schedulers.background import BackgroundScheduler
 import requests
 import validators
-import math
 import logging
 
-from nltk.stem.snowball import SnowballStemmer
 
-from sqlalchemy import or_, and_
+from flask_sqlalchemy import Pagination
+from sqlalchemy import and_
 
 import os
 import nltk
@@ -45,10 +46,21 @@ main = Blueprint('main', __name__)
 logger = logging.getLogger('werkzeug')
 
 
+@main.before_app_first_request
+def load_search_index():
+    search_index.sync(CorpusStats.current())
+
+
 BROKEN = 0
 NOT_BROKEN = 1
 IGNORE = 2
 
+RESULTS_PER_PAGE = 25
+MAX_RESULTS_PER_PAGE = 100
+MAX_COMPLETIONS = 20
+# A word of a search query, or the ~N of a proximity phrase to keep as is
+QUERY_WORD_RE = re.compile(r'~\d+|[^\W_]+')
+
 
 def role():
     if current_user.is_authenticated and current_user.role_id == 3:
@@ -59,20 +71,21 @@ def role():
 
 @main.route('/', methods=['GET', 'POST'])
 def index():
-    # idf = Idf.query.all()
-
     form = SearchForm()
-
-    stemmer = SnowballStemmer("english", ignore_stopwords=True)
-
-    results = Document.query.filter_by(
-        document_status="published"
-    ).order_by(Document.last_edited_date.desc()).all()
+    page, per_page = page_args()
+    version = CorpusStats.current()
+
+    conditions = [Document.document_status == 'published']
+    # The same filters, for the search facets
+    filters = dict(status='published')
+    terms = None
+    phrases = ()
+    suggestion = None
+    sort_by = None
+    key = ()
 
     if form.validate_on_submit():
         sort_by = form.sort_by.data
-        conditions = []
-        conditions.append(Document.document_status == 'published')
         types = [
             'book',
             'news_article',
@@ -89,103 +102,203 @@ def index():
 
         if len(selected_types) > 0:
             conditions.append(Document.doc_type.in_(selected_types))
-
-        if form.tags.data != '':
-            or_conditions = []
-            the_tags = form.tags.data.split(',')
-            for tag in the_tags:
-                or_conditions.append(Document.tags.any(Tagged.tag_name == tag))
-            or_condition = or_(*or_conditions)
-            conditions.append(or_condition)
-
-        query = form.query.data.lower()
+            filters['doc_types'] = selected_types
+
+        the_tags = form_tag_ids(form.tags.data)
+        all_tags = form.tag_match.data == 'all'
+        if the_tags:
+            # One semi-join on tagged's (tag_id, document_id) primary key
+            tagged = db.session.query(Tagged.document_id).filter(
+                Tagged.tag_id.in_(the_tags))
+            if all_tags:
+                tagged = tagged.group_by(Tagged.document_id).having(
+                    db.func.count(Tagged.tag_id) == len(the_tags))
+            conditions.append(Document.id.in_(tagged))
+            filters['tag_ids'] = the_tags
+            filters['all_tags'] = all_tags
+
+        query = form.query.data
         if len(query) > 0:
-            stop_words = set(stopwords.words('english'))
-            word_tokens = word_tokenize(query)
-            filtered_query = [
-                stemmer.stem(w) for w in word_tokens if w not in stop_words
-            ]
-            docs = get_docs(filtered_query)
-            conditions.append(Document.id.in_(docs))
-
-        month_dict = {
-            'January': 1,
-            'February': 2,
-            'March': 3,
-            'April': 4,
-            'May': 5,
-            'June': 6,
-            'July': 7,
-            'August': 8,
-            'September': 9,
-            'October': 10,
-            'November': 11,
-            'December': 12
-        }
-
-        if len(form.start_date.data) > 0:
-            start_date = form.start_date.data.split(' ')
-            start_month = month_dict.get(start_date[0])
-            start_day = start_date[1][:-1]
-            start_year = start_date[2]
-            start = (start_year, start_month, start_day)
+            search_index.sync(version)
+            terms, phrases = analyzer.parse_query(query)
+            terms, suggestion = correct_query(query, terms)
+
+        start = form_date_key(form.start_date.data)
+        if start is not None:
             conditions.append(Document.is_after(start))
+            filters['start'] = start
 
-        if len(form.end_date.data) > 0:
-            end_date = form.end_date.data.split(' ')
-            end_month = month_dict.get(end_date[0])
-            end_day = end_date[1][:-1]
-            end_year = end_date[2]
-            end = (end_year, end_month, end_day)
+        end = form_date_key(form.end_date.data)
+        if end is not None:
             conditions.append(Document.is_before(end))
+            filters['end'] = end
 
-        results = Document.query.filter(
-                and_(*conditions)
-            )
-        
-        if sort_by == "title":
-            results = results.order_by(Document.title).all()
-        elif sort_by == "newest":
-            results = results.all()
-            results.sort(key=lambda x: x.raw_date, reverse=True)
-        elif sort_by == "oldest":
-            results = results.all()
-            results.sort(key=lambda x: x.raw_date)
-        else:
-            results = results.order_by(Document.last_edited_date.desc()).all()
-
-        if len(query) > 0:
-            idf = {}
-            num_docs = Document.query.count()
-            for w in filtered_query:
-                idf_score = Idf.query.get(w)
-                if idf_score:
-                    idf[w] = math.log(num_docs/(1+len(Idf.query.get(w).docs)))
-
-            for r in results:
-                r.score = 0
-                for w in filtered_query:
-                    tf = r.tf.get(w)
-                    if tf:
-                        r.score += tf * idf.get(w)
-                        
-            
-            if sort_by == "most_relevant":
-                results.sort(key=lambda x: x.score, reverse=True)
-        
-        return render_template(
-            'main/index.html',
-            search_results=results,
-            form=form,
+        key = (
+            terms, phrases, tuple(selected_types), tuple(the_tags),
+            all_tags, start, end, sort_by
         )
 
+    # Ranked ids are cached per corpus version; a relevance ranking may
+    # only hold the top of the list, so deeper pages can still miss.
+    needed = page * per_page
+    cached = query_cache.get(key, version)
+    if cached is not None and (
+            len(cached[0]) >= needed or len(cached[0]) == cached[1]):
+        ids, total, counts = cached
+    else:
+        ids, total, counts = rank_documents(
+            conditions, filters, terms, phrases, sort_by, needed, version)
+        query_cache.set(key, version, (ids, total, counts))
+    show_facet_counts(form, counts)
+
     return render_template(
         'main/index.html',
-        search_results=results,
+        pagination=paginate_ids(ids, page, per_page, total),
         form=form,
+        suggestion=suggestion,
+        year_counts=sorted(
+            ((year, n) for year, n in counts['year'].items() if year),
+            reverse=True),
     )
 
 
+def rank_documents(conditions, filters, terms, phrases, sort_by, k,
+                   version):
+    """
+    Ordered ids of the documents matching a search, how many there are
+    and their facet counts. Relevance rankings only include the best `k`.
+    Text searches are filtered in memory with the facet bitmaps and then
+    to the documents containing each of `phrases`; `conditions` are the
+    same filters in SQL, for listing without a query.
+    """
+    search_index.sync(version)
+    facets = search_index.facets
+    if terms is not None:
+        docs = facets.select(search_index.candidates(terms), **filters)
+        for phrase in phrases:
+            docs = search_index.phrase_docs(phrase, docs)
+        if sort_by == "most_relevant":
+            return (search_index.top_k(terms, k, docs), len(docs),
+                    facets.counts(docs))
+        conditions = [Document.id.in_(docs)]
+    ids_query = db.session.query(Document.id).filter(and_(*conditions))
+
+    if sort_by == "title":
+        order = [Document.title]
+    elif sort_by == "newest":
+        order = [Document.publication_key.desc()]
+    elif sort_by == "oldest":
+        order = [Document.publication_key]
+    else:
+        order = [Document.last_edited_date.desc()]
+    ids = [doc_id for doc_id, in ids_query.order_by(*order)]
+    return ids, len(ids), facets.counts(ids)
+
+
+def correct_query(query, terms):
+    """
+    Add to `terms` the nearest index terms of those no published document
+    has, so a misspelled word still finds what it was meant to. Returns
+    the terms and `query` with each misspelled word replaced by the word
+    of its best match, to suggest, or None if nothing was corrected. The
+    rest of the query, phrase quotes included, is kept as typed.
+    """
+    corrections = search_index.corrections(terms)
+    if not corrections:
+        return terms, None
+    expanded = list(terms)
+    for matches in corrections.values():
+        expanded.extend(match for match, _ in matches)
+
+    def correct(word):
+        word = word.group(0)
+        stemmed = analyzer.analyze(word) if word[0] != '~' else ()
+        if len(stemmed) == 1 and stemmed[0] in corrections:
+            match = corrections[stemmed[0]][0][0]
+            return search_index.word(match) or match
+        return word
+
+    return tuple(sorted(expanded)), QUERY_WORD_RE.sub(correct, query)
+
+
+def show_facet_counts(form, counts):
+    """Add the number of results to the type and tag choices of `form`."""
+    for doc_type, n in counts['doc_type'].items():
+        if doc_type in form:
+            field = form[doc_type]
+            field.label.text = '{} ({})'.format(field.label.text, n)
+    form.tags.choices = [
+        (tag_id, '{} ({})'.format(name, counts['tag'][int(tag_id)]))
+        if int(tag_id) in counts['tag'] else (tag_id, name)
+        for tag_id, name in form.tags.choices
+    ]
+
+
+def page_args():
+    """Read the requested page number and page size from the request."""
+    page = request.values.get('page', 1, type=int)
+    per_page = request.values.get('per_page', RESULTS_PER_PAGE, type=int)
+    return max(page, 1), min(max(per_page, 1), MAX_RESULTS_PER_PAGE)
+
+
+def paginate_ids(ids, page, per_page, total=None):
+    """
+    Load one page of an already ordered list of document ids. `ids` only
+    has to reach the end of the requested page when `total` is given.
+    """
+    page_ids = ids[(page - 1) * per_page:page * per_page]
+    items = load_summaries(page_ids)
+    if total is None:
+        total = len(ids)
+    return Pagination(None, page, per_page, total, items)
+
+
+def form_tag_ids(value):
+    """Sorted tag ids of the comma separated value of SearchForm.tags."""
+    return sorted(set(
+        int(tag_id) for tag_id in value.split(',') if tag_id.strip().isdigit()
+    ))
+
+
+def form_date_key(value):
+    """Publication key for a calendar field value like "June 5, 2019"."""
+    parts = value.replace(',', '').split(' ')
+    if len(parts) != 3 or parts[0] not in MONTHS:
+        return None
+    month, day, year = parts
+    return publication_key(year, month, day)
+
+
+@main.route('/autocomplete')
+def autocomplete():
+    """
+    Index terms that complete the last word of `q`, most common first, as
+    JSON. Served from the in-memory vocabulary without a database query.
+    Each term comes with the word to offer for it, since terms are stems
+    ("retali") and would be stemmed again if searched for as they are.
+    """
+    q = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), MAX_COMPLETIONS)
+    words = q.lower().split()
+    if not words or q[-1].isspace():
+        return jsonify(terms=[])
+    prefix = words[-1]
+
+    if not search_index.loaded:
+        search_index.sync(CorpusStats.current())
+    vocabulary = search_index.vocabulary()
+    completions = vocabulary.complete(prefix, limit)
+    if not completions:
+        # A whole word may only match once stemmed
+        stemmed = analyzer.analyze(prefix)
+        if len(stemmed) == 1:
+            completions = vocabulary.complete(stemmed[0], limit)
+    return jsonify(terms=[
+        dict(term=term, word=search_index.word(term) or term, df=df)
+        for term, df in completions
+    ])
+
+
 @main.route('/about')
 def about():
     editable_html_obj = EditableHTML.get_editable_html('about')
@@ -284,15 +397,6 @@ def check_dead_links():
         db.session.commit()
 
 
-def get_docs(query):
-    search_docs = []
-    for w in query:
-        additional_docs = Idf.query.get(w)
-        if additional_docs:
-            search_docs.extend(additional_docs.docs)
-    return search_docs
-
-
 @main.route('/sign-s3/')
 @admin_required
 @contributor_required
@@ -6,6 +6,9 @@ module (as opposed to just their python files)
 from .mutable import *
 from .user import *  # noqa
 from .idf import *
+from .posting import *
+from .corpus import *
+from .generation import *
 from .miscellaneous import *  # noqa
 from .document import * # noqa
 from .tag import * # noqa
@@ -0,0 +1,174 @@
+import datetime
+
+from .. import db
+
+
+class CorpusStats(db.Model):
+    """
+    Single row of corpus-wide search statistics. `version` is bumped
+    whenever searchable data changes, so every worker knows when its cached
+    searches and index are out of date. `doc_count` and `total_length`
+    cover published documents only; the per-term published document
+    frequency lives on Idf.published_df. `active_generation` points at the
+    index generation searches read.
+    """
+    __tablename__ = 'corpus_stats'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    doc_count = db.Column(db.Integer, default=0, nullable=False)
+    total_length = db.Column(db.BigInteger, default=0, nullable=False)
+    active_generation = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False
+    )
+
+    @property
+    def avg_length(self):
+        if not self.doc_count:
+            return 0.0
+        return self.total_length / self.doc_count
+
+    @staticmethod
+    def get():
+        stats = CorpusStats.query.get(1)
+        if stats is None:
+            stats = CorpusStats(
+                id=1, version=0, doc_count=0, total_length=0,
+                active_generation=0
+            )
+            db.session.add(stats)
+            db.session.flush()
+        return stats
+
+    @staticmethod
+    def current():
+        row = db.session.query(CorpusStats.version).filter_by(id=1).first()
+        return row.version if row else 0
+
+    @staticmethod
+    def generation():
+        """Id of the index generation searches and edits use."""
+        row = db.session.query(CorpusStats.active_generation).filter_by(
+            id=1).first()
+        return row.active_generation if row else 0
+
+    @staticmethod
+    def lock():
+        """
+        Lock the row until the end of the current transaction, so the
+        active generation cannot be switched under a change being written
+        to it, and return the active generation.
+        """
+        CorpusStats.get()
+        return db.session.query(CorpusStats.active_generation).filter_by(
+            id=1).with_for_update().scalar()
+
+    @staticmethod
+    def _increment(**deltas):
+        CorpusStats.get()
+        CorpusStats.query.filter_by(id=1).update(
+            dict(
+                (getattr(CorpusStats, k), getattr(CorpusStats, k) + v)
+                for k, v in deltas.items()
+            ),
+            synchronize_session=False
+        )
+
+    @staticmethod
+    def bump():
+        """Increment the version as part of the current transaction."""
+        CorpusStats._increment(version=1)
+        return CorpusStats.current()
+
+    @staticmethod
+    def document_changed(old_status, old_tf, new_status, new_tf):
+        """
+        Move a document's contribution to the published statistics from
+        (`old_status`, `old_tf`) to (`new_status`, `new_tf`). Only
+        published documents count; a status of None means the document
+        does not exist on that side of the change.
+        """
+        from . import Idf
+
+        old_tf = (old_tf or {}) if old_status == 'published' else {}
+        new_tf = (new_tf or {}) if new_status == 'published' else {}
+        count = int(new_status == 'published') - \
+            int(old_status == 'published')
+        length = sum(new_tf.values()) - sum(old_tf.values())
+        if count or length:
+            CorpusStats._increment(doc_count=count, total_length=length)
+
+        added = set(new_tf) - set(old_tf)
+        removed = set(old_tf) - set(new_tf)
+        generation = CorpusStats.generation()
+        for terms, delta in ((added, 1), (removed, -1)):
+            if terms:
+                Idf.query.filter(
+                    Idf.generation == generation,
+                    Idf.term.in_(list(terms))
+                ).update(
+                    {Idf.published_df: Idf.published_df + delta},
+                    synchronize_session=False
+                )
+
+    @staticmethod
+    def recompute():
+        """
+        Recalculate every published statistic from the document and
+        posting tables. Needed after bulk loads that bypass
+        document_changed.
+        """
+        from . import Document, Idf, Posting
+
+        published = Document.document_status == 'published'
+        doc_count, total_length = db.session.query(
+            db.func.count(Document.id),
+            db.func.coalesce(db.func.sum(Document.length), 0)
+        ).filter(published).one()
+        stats = CorpusStats.get()
+        stats.doc_count = doc_count
+        stats.total_length = total_length
+
+        df = dict(
+            db.session.query(Posting.term_id, db.func.count()).join(
+                Document, Document.id == Posting.document_id
+            ).filter(published).group_by(Posting.term_id)
+        )
+        for idf in Idf.query.filter_by(generation=CorpusStats.generation()):
+            idf.published_df = df.get(idf.id, 0)
+
+    @staticmethod
+    def activate(generation):
+        """
+        Switch searches over to `generation` within the current
+        transaction. Document lengths and the published statistics are
+        recalculated from its postings, and the version is bumped so every
+        worker reloads. Returns the new version.
+        """
+        from . import Document, Idf, IndexGeneration, Posting
+
+        CorpusStats.get()
+        CorpusStats.query.filter_by(id=1).update(
+            {CorpusStats.active_generation: generation},
+            synchronize_session=False
+        )
+        length = db.session.query(db.func.sum(Posting.tf)).join(
+            Idf, Idf.id == Posting.term_id
+        ).filter(
+            Idf.generation == generation,
+            Posting.document_id == Document.id
+        ).correlate(Document).as_scalar()
+        Document.query.update(
+            {Document.length: db.func.coalesce(length, 0)},
+            synchronize_session=False
+        )
+        IndexGeneration.query.filter(
+            IndexGeneration.status == 'active',
+            IndexGeneration.id != generation
+        ).update({IndexGeneration.status: 'retired'},
+                 synchronize_session=False)
+        IndexGeneration.query.filter_by(id=generation).update({
+            IndexGeneration.status: 'active',
+            IndexGeneration.activated_date: datetime.datetime.utcnow()
+        }, synchronize_session=False)
+        CorpusStats.recompute()
+        return CorpusStats.bump()
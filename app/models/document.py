@@ -1,36 +1,91 @@
 from .. import db
-from . import Idf, MutableDict
+from . import CorpusStats, Posting
+from app.search import analyzer
 import random
 from faker import Faker
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.orm import relationship
-from nltk.stem.snowball import SnowballStemmer
-from sqlalchemy import PickleType
+from sqlalchemy import event
 import datetime
-from collections import Counter
 import os
 import nltk
 import datetime
 nltk.data.path.append(os.environ.get('NLTK_DATA'))
 
+MONTHS = {
+    'January': 1, 'February': 2, 'March': 3, 'April': 4,
+    'May': 5, 'June': 6, 'July': 7, 'August': 8, 'September': 9,
+    'October': 10, 'November': 11, 'December': 12
+}
+
+
+# Formats of the string dates stored before posted_date/last_edited_date
+# became DateTime columns
+LEGACY_DATE_FORMATS = (
+    '%a %b %d %H:%M:%S %Y',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+)
+
+
+def parse_legacy_date(value):
+    """Parse a pre-DateTime posted/last edited date, or return None."""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    # strftime's %Z was empty for the naive utcnow(), leaving a double space
+    value = ' '.join(value.split())
+    for fmt in LEGACY_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def publication_key(year, month, day):
+    """
+    Integer YYYYMMDD form of a publication date, or None without a year.
+    A missing month or day defaults the same way as Document.raw_date, to
+    January and the 1st.
+    """
+    try:
+        year = int(year) if year else None
+    except ValueError:
+        year = None
+    if year is None:
+        return None
+    month = MONTHS.get(month) or 1
+    try:
+        day = int(day) if day else 1
+    except ValueError:
+        day = 1
+    return year * 10000 + month * 100 + day
+
 
 class Document(db.Model):
     __tablename__ = 'document'
+    __table_args__ = (
+        # "Recently edited" listings: the library and the drafts pages
+        db.Index(
+            'ix_document_status_last_edited',
+            'document_status', 'last_edited_date'
+        ),
+        db.Index(
+            'ix_document_posted_by_last_edited',
+            'posted_by', 'last_edited_date'
+        ),
+    )
     id = db.Column(db.Integer, primary_key=True)
     # These files are generic
     doc_type = db.Column(db.String(200))
     day = db.Column(db.Integer())  # Publication/case/enactment of law day
     month = db.Column(db.String(20))  # Publication/case/enactment of law month
     year = db.Column(db.Integer())  # Publication/case/enactment of law year
-    posted_date = db.Column(
-        db.String(200),
-        default=datetime.datetime.utcnow().strftime("%a %b %d %H:%M:%S %Z %Y")
-    )
+    # YYYYMMDD of day/month/year, kept in sync on every insert/update
+    publication_key = db.Column(db.Integer(), index=True)
+    posted_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     last_edited_date = db.Column(
-        db.String(200),
-        default=datetime.datetime.utcnow().strftime("%a %b %d %H:%M:%S %Z %Y")
+        db.DateTime, default=datetime.datetime.utcnow, index=True
     )
     posted_by = db.Column(db.String(1000))
     last_edited_by = db.Column(db.String(1000))
@@ -72,7 +127,7 @@ class Document(db.Model):
     source = db.Column(db.String(1000))
     studio = db.Column(db.String(1000))
 
-    tf = db.Column(MutableDict.as_mutable(PickleType))
+    length = db.Column(db.Integer, default=0)  # Number of indexed tokens
 
     broken_link = db.Column(db.Integer())
 
@@ -82,11 +137,17 @@ class Document(db.Model):
     @hybrid_property
     def corpus(self):
         corpus = []
-        fields = self.__dict__
-        for key, value in fields.items():
+        # Read mapped columns rather than self.__dict__, which is empty
+        # after a commit expires the instance.
+        fields = [
+            (attr.key, getattr(self, attr.key))
+            for attr in self.__mapper__.column_attrs
+        ]
+        for key, value in fields:
             if key not in [
-                'tf', 'page_start', 'id', 'day', 'posted_date',
-                'last_edited_date', 'posted_by', 'last_edited_by', 'edition',
+                'tf', 'length', 'publication_key', 'page_start', 'id',
+                'day', 'posted_date', 'last_edited_date', 'posted_by',
+                'last_edited_by', 'edition',
                 'broken_link', 'volume', 'file', 'document_status',
                 '_sa_instance_state', 'link', 'author_first_name',
                 'author_last_name', 'tags', 'doc_type', 'editor_first_name',
@@ -113,6 +174,13 @@ class Document(db.Model):
                     corpus.append(t)
         return ' '.join(corpus)
 
+    @property
+    def tf(self):
+        """Term frequencies of the document, read from its postings."""
+        if self.id is None:
+            return {}
+        return Posting.document_tf(self.id)
+
     @hybrid_property
     def date(self):
         if self.year != "":
@@ -127,41 +195,33 @@ class Document(db.Model):
     
     @hybrid_property
     def raw_date(self):
-        month_dict = {
-            'January': 1, 'February': 2, 'March': 3, 'April': 4,
-            'May': 5, 'June': 6, 'July': 7, 'August': 8, 'September': 9,
-            'October': 10, 'November': 11, 'December': 12
-        }
         year = self.year if self.year else 1970
-        month = month_dict.get(self.month) if month_dict.get(self.month) else 1
+        month = MONTHS.get(self.month) if MONTHS.get(self.month) else 1
         day = self.day if self.day else 1
         return year, month, day
-    
 
+    # Undated documents have no publication key and match no date range;
+    # in SQL the comparison with NULL already leaves them out.
     @hybrid_method
-    def is_after(self, start_date):
-        month_dict = {
-            'January': 1, 'February': 2, 'March': 3, 'April': 4,
-            'May': 5, 'June': 6, 'July': 7, 'August': 8, 'September': 9,
-            'October': 10, 'November': 11, 'December': 12
-        }
-        now_tuple = (self.year, month_dict.get(self.month), self.day)
-        return now_tuple >= start_date
+    def is_after(self, start_key):
+        return self.publication_key is not None and \
+            self.publication_key >= start_key
+
+    @is_after.expression
+    def is_after(cls, start_key):
+        return cls.publication_key >= start_key
 
     @hybrid_method
-    def is_before(self, end_date):
-        month_dict = {
-            'January': 1, 'February': 2, 'March': 3, 'April': 4,
-            'May': 5, 'June': 6, 'July': 7, 'August': 8, 'September': 9,
-            'October': 10, 'November': 11, 'December': 12
-        }
-        now_tuple = (self.year, month_dict.get(self.month), self.day)
-        return now_tuple <= end_date
+    def is_before(self, end_key):
+        return self.publication_key is not None and \
+            self.publication_key <= end_key
+
+    @is_before.expression
+    def is_before(cls, end_key):
+        return cls.publication_key <= end_key
 
     @staticmethod
     def generate_fake(count=1000, **kwargs):
-        stemmer = SnowballStemmer("english", ignore_stopwords=True)
-        stop_words = set(stopwords.words('english'))
         fake = Faker()
         for i in range(count):
             name = fake.name()
@@ -186,23 +246,10 @@ class Document(db.Model):
                 name=fake.company(),
                 document_status=random.choice(["draft", "published"]))
             db.session.add(document)
-            word_tokens = word_tokenize(document.corpus)
-            filtered_query = [
-                stemmer.stem(w).lower() for w in word_tokens
-                if w not in stop_words
-            ]
-            document.tf = Counter(filtered_query)
-
-            for key in Counter(filtered_query):
-                entry = Idf.query.get(key)
-                if entry is None:
-                    idf = Idf(
-                        term=key,
-                        docs=[document.id]
-                    )
-                    db.session.add(idf)
-                else:
-                    entry.docs.append(document.id)
+            document.length, tf, positions = analyzer.term_positions(
+                document.corpus)
+            db.session.flush()
+            Posting.update_document(document.id, {}, tf, positions=positions)
         for i in range(count):
             name = fake.name()
             text = fake.text(max_nb_chars=100)
@@ -222,23 +269,10 @@ class Document(db.Model):
                 document_status=random.choice(["draft", "published"]))
 
             db.session.add(article)
-            word_tokens = word_tokenize(article.corpus)
-            filtered_query = [
-                stemmer.stem(w).lower()
-                for w in word_tokens if w not in stop_words
-            ]
-            article.tf = Counter(filtered_query)
-
-            for key in Counter(filtered_query):
-                entry = Idf.query.get(key)
-                if entry is None:
-                    idf = Idf(
-                        term=key,
-                        docs=[article.id]
-                    )
-                    db.session.add(idf)
-                else:
-                    entry.docs.append(article.id)
+            article.length, tf, positions = analyzer.term_positions(
+                article.corpus)
+            db.session.flush()
+            Posting.update_document(article.id, {}, tf, positions=positions)
         for i in range(count):
             name = fake.name()
             text = fake.text(max_nb_chars=100)
@@ -261,24 +295,10 @@ class Document(db.Model):
                 document_status=random.choice(["draft", "published"]))
 
             db.session.add(journal)
-            word_tokens = word_tokenize(journal.corpus)
-            filtered_query = [
-                stemmer.stem(w).lower()
-                for w in word_tokens
-                if w not in stop_words
-            ]
-            journal.tf = Counter(filtered_query)
-
-            for key in Counter(filtered_query):
-                entry = Idf.query.get(key)
-                if entry is None:
-                    idf = Idf(
-                        term=key,
-                        docs=[journal.id]
-                    )
-                    db.session.add(idf)
-                else:
-                    entry.docs.append(journal.id)
+            journal.length, tf, positions = analyzer.term_positions(
+                journal.corpus)
+            db.session.flush()
+            Posting.update_document(journal.id, {}, tf, positions=positions)
         for i in range(count):
             name = fake.name()
             doc_type = random.choice(["film", "audio", "photograph"])
@@ -299,24 +319,10 @@ class Document(db.Model):
                 document_status=random.choice(["draft", "published"]))
 
             db.session.add(other)
-            word_tokens = word_tokenize(other.corpus)
-            filtered_query = [
-                stemmer.stem(w).lower()
-                for w in word_tokens
-                if w not in stop_words
-            ]
-            other.tf = Counter(filtered_query)
-
-            for key in Counter(filtered_query):
-                entry = Idf.query.get(key)
-                if entry is None:
-                    idf = Idf(
-                        term=key,
-                        docs=[other.id]
-                    )
-                    db.session.add(idf)
-                else:
-                    entry.docs.append(other.id)
+            other.length, tf, positions = analyzer.term_positions(
+                other.corpus)
+            db.session.flush()
+            Posting.update_document(other.id, {}, tf, positions=positions)
         for i in range(count):
             name = fake.name()
             body = random.choice([
@@ -338,28 +344,13 @@ class Document(db.Model):
                 link='http://' + fake.domain_name(),
                 govt_body=body,
                 section=random.randint(1, 100),
-                document_status=random.choice(["draft", "published"]),
-                tf=Counter(filtered_query))
+                document_status=random.choice(["draft", "published"]))
 
             db.session.add(law)
-            word_tokens = word_tokenize(law.corpus)
-            filtered_query = [
-                stemmer.stem(w).lower()
-                for w in word_tokens
-                if w not in stop_words
-            ]
-            law.tf = Counter(filtered_query)
-
-            for key in Counter(filtered_query):
-                entry = Idf.query.get(key)
-                if entry is None:
-                    idf = Idf(
-                        term=key,
-                        docs=[law.id]
-                    )
-                    db.session.add(idf)
-                else:
-                    entry.docs.append(law.id)
+            law.length, tf, positions = analyzer.term_positions(
+                law.corpus)
+            db.session.flush()
+            Posting.update_document(law.id, {}, tf, positions=positions)
         for i in range(count):
             name = fake.name()
             text = fake.text(max_nb_chars=100)
@@ -380,25 +371,12 @@ class Document(db.Model):
                 document_status=random.choice(["draft", "published"]))
 
             db.session.add(video)
-            word_tokens = word_tokenize(video.corpus)
-            filtered_query = [
-                stemmer.stem(w).lower()
-                for w in word_tokens
-                if w not in stop_words
-            ]
-            video.tf = Counter(filtered_query)
-
-            for key in Counter(filtered_query):
-                entry = Idf.query.get(key)
-                if entry is None:
-                    idf = Idf(
-                        term=key,
-                        docs=[video.id]
-                    )
-                    db.session.add(idf)
-                else:
-                    entry.docs.append(video.id)
+            video.length, tf, positions = analyzer.term_positions(
+                video.corpus)
+            db.session.flush()
+            Posting.update_document(video.id, {}, tf, positions=positions)
 
+        CorpusStats.recompute()
         db.session.commit()
 
     def __repr__(self):
@@ -432,3 +410,11 @@ class Document(db.Model):
 
     def __str__(self):
         return self.__repr__()
+
+
+@event.listens_for(Document, 'before_insert')
+@event.listens_for(Document, 'before_update')
+def set_publication_key(mapper, connection, target):
+    target.publication_key = publication_key(
+        target.year, target.month, target.day
+    )
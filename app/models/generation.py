@@ -0,0 +1,23 @@
+import datetime
+
+from .. import db
+
+
+class IndexGeneration(db.Model):
+    """
+    One build of the search index. A new generation is built next to the
+    active one and switched to with CorpusStats.activate; the generation
+    it replaces is retired and can be dropped afterwards. Indexes created
+    before generations existed are generation 0, which has no row here.
+    """
+    __tablename__ = 'index_generation'
+    id = db.Column(db.Integer, primary_key=True)
+    # 'building', 'active' or 'retired'
+    status = db.Column(db.String(16), default='building', nullable=False)
+    # Analyzer settings the generation was built with
+    tokenizer = db.Column(db.String(32))
+    created_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    activated_date = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<IndexGeneration {} {}>'.format(self.id, self.status)
@@ -1,10 +1,23 @@
 from .. import db
-from . import User, MutableList
-from sqlalchemy import Column, Integer, String
-from sqlalchemy.dialects.postgresql import ARRAY
 
 
 class Idf(db.Model):
+    """
+    Term dictionary of the search index; postings live in Posting. Each
+    index generation has its own terms, and searches only read the
+    generation CorpusStats.active_generation points to.
+    """
     __tablename__ = 'idf'
-    term = db.Column(db.String(1000), primary_key=True)
-    docs = db.Column(MutableList.as_mutable(ARRAY(Integer())))
+    __table_args__ = (
+        db.UniqueConstraint(
+            'generation', 'term', name='uq_idf_generation_term'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False, index=True
+    )
+    term = db.Column(db.String(1000), nullable=False)
+    # A word the term is the stem of, shown to users instead of the stem
+    word = db.Column(db.String(1000))
+    # Number of published documents containing the term
+    published_df = db.Column(db.Integer, default=0, nullable=False)
@@ -0,0 +1,170 @@
+from .. import db
+from . import Idf
+from app.search import analyzer
+
+
+def _active_generation():
+    from . import CorpusStats
+    return CorpusStats.generation()
+
+
+class Posting(db.Model):
+    """
+    Frequency of one term in one document, and the token positions it
+    occurs at, encoded by app.search.codec.encode_positions. Positions
+    are NULL for postings written before they were recorded.
+    """
+    __tablename__ = 'posting'
+    term_id = db.Column(db.Integer, db.ForeignKey('idf.id'), primary_key=True)
+    document_id = db.Column(
+        db.Integer, db.ForeignKey('document.id'), primary_key=True,
+        index=True
+    )
+    tf = db.Column(db.Integer, nullable=False)
+    positions = db.Column(db.LargeBinary)
+
+    @staticmethod
+    def update_document(doc_id, pre_tf, post_tf, generation=None,
+                        positions=None):
+        """
+        Change a document's postings from `pre_tf` to `post_tf`, writing
+        only the rows that differ. Terms seen for the first time get an Idf
+        row, and terms left without postings lose theirs. Defaults to the
+        active index generation. With `positions`
+        (term -> encoded positions) rows whose positions moved are written
+        too; without, the positions of changed rows are cleared.
+        """
+        changed = set(
+            t for t in set(pre_tf) | set(post_tf)
+            if pre_tf.get(t) != post_tf.get(t)
+        )
+        if positions is None:
+            positions = {}
+        elif pre_tf:
+            if generation is None:
+                generation = _active_generation()
+            stored = dict(
+                db.session.query(Idf.term, Posting.positions).join(
+                    Posting, Posting.term_id == Idf.id
+                ).filter(
+                    Idf.generation == generation,
+                    Posting.document_id == doc_id
+                )
+            )
+            changed.update(
+                t for t in post_tf
+                if post_tf[t] and positions.get(t) != stored.get(t))
+        if not changed:
+            return
+        if generation is None:
+            generation = _active_generation()
+
+        terms = dict(
+            (idf.term, idf)
+            for idf in Idf.query.filter(
+                Idf.generation == generation, Idf.term.in_(changed))
+        )
+        for term in changed:
+            if not post_tf.get(term):
+                continue
+            if term not in terms:
+                terms[term] = Idf(
+                    term=term, word=analyzer.word(term),
+                    generation=generation, published_df=0)
+                db.session.add(terms[term])
+            elif terms[term].word is None:
+                terms[term].word = analyzer.word(term)
+        db.session.flush()
+
+        removed = [
+            terms[t].id for t in changed if not post_tf.get(t) and t in terms
+        ]
+        if removed:
+            Posting.query.filter(
+                Posting.document_id == doc_id,
+                Posting.term_id.in_(removed)
+            ).delete(synchronize_session=False)
+            Idf.query.filter(
+                Idf.id.in_(removed),
+                ~db.exists().where(Posting.term_id == Idf.id)
+            ).delete(synchronize_session=False)
+
+        updates = []
+        inserts = []
+        for term in changed:
+            if not post_tf.get(term):
+                continue
+            row = dict(
+                term_id=terms[term].id, document_id=doc_id, tf=post_tf[term],
+                positions=positions.get(term)
+            )
+            if pre_tf.get(term):
+                updates.append(row)
+            else:
+                inserts.append(row)
+        if updates:
+            db.session.bulk_update_mappings(Posting, updates)
+        if inserts:
+            db.session.bulk_insert_mappings(Posting, inserts)
+
+    @staticmethod
+    def rebuild(doc_tfs, generation, batch_size=5000):
+        """
+        Replace the contents of index `generation` with the (doc_id, tf)
+        pairs of `doc_tfs`, inserting postings in batches. Items may also
+        be (doc_id, tf, positions) triples. Published statistics have to be
+        recomputed afterwards.
+        """
+        Posting.drop_generation(generation)
+        terms = {}
+        rows = []
+
+        def write():
+            db.session.flush()
+            db.session.bulk_insert_mappings(Posting, [
+                dict(term_id=terms[term].id, document_id=doc_id, tf=tf,
+                     positions=positions)
+                for term, doc_id, tf, positions in rows
+            ])
+            del rows[:]
+
+        for item in doc_tfs:
+            doc_id, tf = item[:2]
+            positions = item[2] if len(item) > 2 else {}
+            for term, count in tf.items():
+                if term not in terms:
+                    terms[term] = Idf(
+                        term=term, word=analyzer.word(term),
+                        generation=generation, published_df=0)
+                    db.session.add(terms[term])
+                rows.append((term, doc_id, count, positions.get(term)))
+            if len(rows) >= batch_size:
+                write()
+        write()
+        return len(terms)
+
+    @staticmethod
+    def drop_generation(generation):
+        """Delete every term and posting of index `generation`."""
+        term_ids = db.session.query(Idf.id).filter(
+            Idf.generation == generation)
+        Posting.query.filter(Posting.term_id.in_(term_ids)).delete(
+            synchronize_session=False)
+        Idf.query.filter(Idf.generation == generation).delete(
+            synchronize_session=False)
+
+    @staticmethod
+    def document_tf(doc_id, generation=None):
+        if generation is None:
+            generation = _active_generation()
+        return dict(
+            db.session.query(Idf.term, Posting.tf).join(
+                Posting, Posting.term_id == Idf.id
+            ).filter(
+                Idf.generation == generation, Posting.document_id == doc_id
+            )
+        )
+
+    def __repr__(self):
+        return '<Posting term_id={} document_id={} tf={}>'.format(
+            self.term_id, self.document_id, self.tf)
@@ -5,6 +5,11 @@ from sqlalchemy import ForeignKey
 
 class Tagged(db.Model):
     __tablename__ = 'tagged'
+    __table_args__ = (
+        # Tags of a document (Document.tags, re-tagging, search facets);
+        # the (tag_id, document_id) primary key serves the tag filter.
+        db.Index('ix_tagged_document_tag', 'document_id', 'tag_id'),
+    )
     tag_id = db.Column(db.Integer, ForeignKey('tag.id'), primary_key=True)
     document_id = db.Column(
         db.Integer, ForeignKey('document.id'), primary_key=True
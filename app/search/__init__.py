@@ -0,0 +1,11 @@
+"""
+Process-resident search structures used by the library search page.
+"""
+
+from .analysis import Analyzer
+from .cache import QueryCache
+from .index import InvertedIndex
+
+analyzer = Analyzer()
+search_index = InvertedIndex()
+query_cache = QueryCache()
@@ -0,0 +1,177 @@
+"""
+Text analysis shared by indexing and querying. Documents and queries go
+through the same analyzer so that their terms always match.
+"""
+
+import re
+from collections import Counter
+from functools import lru_cache
+
+from nltk.corpus import stopwords
+from nltk.stem.snowball import SnowballStemmer
+
+from .codec import encode_positions
+
+TOKEN_RE = re.compile(r'[^\W_]+')
+# A quoted phrase, optionally followed by ~N for a proximity search
+PHRASE_RE = re.compile(r'"([^"]*)"(?:~(\d+))?')
+
+
+def regex_tokenizer(text):
+    """Splits text into runs of letters and digits."""
+    return TOKEN_RE.findall(text)
+
+
+def nltk_tokenizer(text):
+    """NLTK's Punkt + Treebank tokenizer, much slower than the regex one."""
+    from nltk.tokenize import word_tokenize
+    return [w for w in word_tokenize(text) if TOKEN_RE.search(w)]
+
+
+TOKENIZERS = {
+    'regex': regex_tokenizer,
+    'nltk': nltk_tokenizer,
+}
+
+
+class Analyzer(object):
+    """
+    Turns text into index terms: tokenize, lowercase, drop English stop
+    words and stem. Stems are memoized in an LRU cache since the same
+    words keep coming back. The stemmer and stop word list are loaded on
+    first use, once per process. For every term of the documents it
+    analyzes it remembers the shortest word stemmed to it, to show users
+    instead of the stem.
+    """
+
+    def __init__(self, tokenizer=regex_tokenizer, stem_cache_size=50000):
+        self.tokenizer = tokenizer
+        self.stem_cache_size = stem_cache_size
+        self._stem = None
+        self._stop_words = None
+        # term -> shortest word seen with that stem
+        self.words = {}
+
+    def init_app(self, app):
+        name = app.config.get('SEARCH_TOKENIZER', 'regex')
+        if name not in TOKENIZERS:
+            raise ValueError('Unknown SEARCH_TOKENIZER {}'.format(name))
+        self.tokenizer = TOKENIZERS[name]
+        self.stem_cache_size = app.config.get(
+            'SEARCH_STEM_CACHE_SIZE', self.stem_cache_size)
+        self._stem = None
+
+    def _load(self):
+        stemmer = SnowballStemmer('english', ignore_stopwords=True)
+        self._stop_words = frozenset(stopwords.words('english'))
+        self._stem = lru_cache(maxsize=self.stem_cache_size)(stemmer.stem)
+
+    def analyze(self, text):
+        """Returns the list of terms in `text`, in order."""
+        if self._stem is None:
+            self._load()
+        stem = self._stem
+        stop_words = self._stop_words
+        return [
+            stem(w) for w in self.tokenizer(text.lower())
+            if w not in stop_words
+        ]
+
+    def analyze_many(self, texts):
+        """Analyzes each text of `texts`, returning a list of term lists."""
+        return [self.analyze(text) for text in texts]
+
+    def term_frequencies(self, text):
+        """Returns (length, Counter of terms) for `text`."""
+        terms = self.analyze(text)
+        return len(terms), Counter(terms)
+
+    def _tokens(self, text):
+        """(position, word, term) of each term in `text`."""
+        if self._stem is None:
+            self._load()
+        stem = self._stem
+        stop_words = self._stop_words
+        for i, w in enumerate(self.tokenizer(text.lower())):
+            if w not in stop_words:
+                yield i, w, stem(w)
+
+    def positioned_terms(self, text):
+        """
+        (position, term) of each term in `text`. Positions count every
+        token, stop words included, so a phrase keeps its gaps.
+        """
+        for i, _, term in self._tokens(text):
+            yield i, term
+
+    def word(self, term):
+        """The word to show for `term`, if a document had one."""
+        return self.words.get(term)
+
+    def remember(self, words):
+        """Keep the (term, word) pairs of `words` with a shorter word."""
+        known = self.words
+        for term, word in words:
+            current = known.get(term)
+            if current is None or (len(word), word) < (
+                    len(current), current):
+                known[term] = word
+
+    def term_positions(self, text):
+        """
+        Returns (length, Counter of terms, positions) for `text`, where
+        positions maps each term to its positions encoded by
+        codec.encode_positions.
+        """
+        positions = {}
+        words = set()
+        for i, word, term in self._tokens(text):
+            positions.setdefault(term, []).append(i)
+            words.add((term, word))
+        self.remember(words)
+        tf = Counter(dict(
+            (term, len(found)) for term, found in positions.items()))
+        return sum(tf.values()), tf, dict(
+            (term, encode_positions(found))
+            for term, found in positions.items())
+
+    def query_terms(self, text):
+        """Sorted terms of a search query, usable as a cache key."""
+        return tuple(sorted(self.analyze(text)))
+
+    def parse_query(self, text):
+        """
+        Split a search query into terms and phrases. A phrase is written in
+        double quotes and matches its words in order with the same number
+        of words between them; followed by ~N it matches them in any order
+        with up to N more words around them. Returns (terms, phrases), both
+        usable as cache keys. The terms include those of the phrases, and
+        each phrase is (((term, offset from the first term), ...), N).
+        """
+        phrases = set()
+        for match in PHRASE_RE.finditer(text):
+            terms = list(self.positioned_terms(match.group(1)))
+            if len(terms) > 1:
+                start = terms[0][0]
+                phrases.add((
+                    tuple((term, i - start) for i, term in terms),
+                    int(match.group(2) or 0)))
+        words = PHRASE_RE.sub(lambda match: match.group(1), text)
+        return self.query_terms(words), tuple(sorted(phrases))
+
+
+def analyze_batch(batch):
+    """
+    Analyzes a list of (doc_id, text) pairs with the process's analyzer.
+    Returns a list of (doc_id, length, tf, positions) tuples, and the
+    words of the batch's terms for the parent process to remember. Used
+    by process pools.
+    """
+    from . import analyzer
+    results = [
+        (doc_id,) + analyzer.term_positions(text) for doc_id, text in batch
+    ]
+    terms = set()
+    for result in results:
+        terms.update(result[2])
+    return results, [(term, analyzer.word(term)) for term in terms]
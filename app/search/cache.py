@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """
+    LRU cache of ranked search results with a time to live. Entries belong
+    to one corpus version; the first lookup made under a newer version
+    empties the cache, and requests still on an older one neither read
+    nor store entries.
+    """
+
+    def __init__(self, max_size=256, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_size = app.config.get('SEARCH_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.get('SEARCH_CACHE_TTL', self.ttl)
+
+    def _check_version(self, version):
+        """Move on to `version` if it is newer; False if it is older."""
+        if self.version is not None and version < self.version:
+            return False
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+        return True
+
+    def get(self, key, version):
+        with self._lock:
+            if not self._check_version(version):
+                return None
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, version, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if not self._check_version(version):
+                return
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
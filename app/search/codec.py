@@ -0,0 +1,253 @@
+"""
+Compact encoding for posting lists. Doc ids are split into blocks of up
+to BLOCK_SIZE; each block keeps its first doc id in a skip table and
+stores the gaps between doc ids and the term frequencies as arrays of the
+narrowest integer type that fits, so a typical posting costs two or
+three bytes instead of two 8 byte machine words. Blocks decode with
+array.frombytes, and seeking skips whole blocks.
+"""
+
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+BLOCK_SIZE = 128
+
+# Array type codes from narrowest to widest
+TYPECODES = 'BHIQ'
+LIMITS = [2 ** (8 * array(code).itemsize) - 1 for code in TYPECODES]
+
+
+def _typecode(largest):
+    for code, limit in zip(TYPECODES, LIMITS):
+        if largest <= limit:
+            return code
+    raise ValueError('{} does not fit in a posting block'.format(largest))
+
+
+def encode_block(doc_ids, tfs):
+    """
+    Encode sorted `doc_ids` and their `tfs` as bytes; the first doc id is
+    left out and has to be passed back to decode_block.
+    """
+    gaps = [b - a for a, b in zip(doc_ids, doc_ids[1:])]
+    gap_code = _typecode(max(gaps) if gaps else 0)
+    tf_code = _typecode(max(tfs))
+    return b''.join([
+        (gap_code + tf_code).encode('ascii'),
+        array(gap_code, gaps).tobytes(),
+        array(tf_code, tfs).tobytes(),
+    ])
+
+
+def decode_block(first, data):
+    """Returns (doc_ids, tfs) of a block encoded by encode_block."""
+    gap_code, tf_code = chr(data[0]), chr(data[1])
+    gap_size = array(gap_code).itemsize
+    tf_size = array(tf_code).itemsize
+    count = (len(data) - 2 + gap_size) // (gap_size + tf_size)
+    split = 2 + gap_size * (count - 1)
+    gaps = array(gap_code)
+    gaps.frombytes(data[2:split])
+    tfs = array(tf_code)
+    tfs.frombytes(data[split:])
+    doc_ids = list(accumulate([first] + gaps.tolist()))
+    return doc_ids, tfs
+
+
+def encode_positions(positions):
+    """
+    Encode the sorted token positions of a term in a document as bytes:
+    the gaps between them, in the narrowest array type that fits.
+    """
+    gaps = [positions[0]] + [b - a for a, b in zip(positions, positions[1:])]
+    code = _typecode(max(gaps))
+    return code.encode('ascii') + array(code, gaps).tobytes()
+
+
+def decode_positions(data):
+    """Returns the positions encoded by encode_positions."""
+    gaps = array(chr(data[0]))
+    gaps.frombytes(data[1:])
+    return list(accumulate(gaps))
+
+
+class BlockPostings(object):
+    """
+    Read access shared by posting lists stored as blocks: subclasses
+    provide `firsts`, `blocks`, `count` and `max_tf`.
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return self.count
+
+    def doc_ids(self):
+        """Doc ids in order."""
+        for first, data in zip(self.firsts, self.blocks):
+            yield from decode_block(first, data)[0]
+
+    def items(self):
+        """(doc_id, tf) pairs in doc id order."""
+        for first, data in zip(self.firsts, self.blocks):
+            doc_ids, tfs = decode_block(first, data)
+            yield from zip(doc_ids, tfs)
+
+    def cursor(self):
+        return Cursor(self)
+
+
+class Postings(BlockPostings):
+    """
+    Sorted doc ids for one term, with the term frequency of each doc,
+    encoded in blocks. `max_tf` is the largest frequency, which bounds
+    the term's score.
+    """
+    __slots__ = ('firsts', 'blocks', 'count', 'max_tf')
+
+    def __init__(self, doc_ids=(), tfs=()):
+        self.firsts = array('l')
+        self.blocks = []
+        self.count = len(doc_ids)
+        self.max_tf = max(tfs) if len(tfs) else 0
+        for i in range(0, len(doc_ids), BLOCK_SIZE):
+            self._insert_block(
+                len(self.blocks),
+                doc_ids[i:i + BLOCK_SIZE], tfs[i:i + BLOCK_SIZE])
+
+    def _insert_block(self, b, doc_ids, tfs):
+        self.firsts.insert(b, doc_ids[0])
+        self.blocks.insert(b, encode_block(doc_ids, tfs))
+
+    def _find_block(self, doc_id):
+        return max(bisect_right(self.firsts, doc_id) - 1, 0)
+
+    def add(self, doc_id, tf):
+        if not self.blocks:
+            self._insert_block(0, [doc_id], [tf])
+            self.count = 1
+            self.max_tf = tf
+            return
+        b = self._find_block(doc_id)
+        doc_ids, tfs = decode_block(self.firsts[b], self.blocks[b])
+        tfs = tfs.tolist()
+        i = bisect_left(doc_ids, doc_id)
+        if i < len(doc_ids) and doc_ids[i] == doc_id:
+            old = tfs[i]
+            tfs[i] = tf
+        else:
+            old = None
+            doc_ids.insert(i, doc_id)
+            tfs.insert(i, tf)
+            self.count += 1
+
+        del self.firsts[b]
+        del self.blocks[b]
+        if len(doc_ids) > 2 * BLOCK_SIZE:
+            self._insert_block(b, doc_ids[BLOCK_SIZE:], tfs[BLOCK_SIZE:])
+            doc_ids, tfs = doc_ids[:BLOCK_SIZE], tfs[:BLOCK_SIZE]
+        self._insert_block(b, doc_ids, tfs)
+
+        if tf > self.max_tf:
+            self.max_tf = tf
+        elif old == self.max_tf and tf < old:
+            self.max_tf = max(tf for _, tf in self.items())
+
+    def remove(self, doc_id):
+        if not self.blocks:
+            return
+        b = self._find_block(doc_id)
+        doc_ids, tfs = decode_block(self.firsts[b], self.blocks[b])
+        i = bisect_left(doc_ids, doc_id)
+        if i == len(doc_ids) or doc_ids[i] != doc_id:
+            return
+        tf = tfs[i]
+        del doc_ids[i]
+        del tfs[i]
+        self.count -= 1
+        del self.firsts[b]
+        del self.blocks[b]
+        if doc_ids:
+            self._insert_block(b, doc_ids, tfs)
+        if tf == self.max_tf:
+            self.max_tf = max((tf for _, tf in self.items()), default=0)
+
+
+class Cursor(object):
+    """
+    Forward iterator over a posting list. `doc_id` is None once the list
+    is exhausted.
+    """
+    __slots__ = ('postings', 'block', 'doc_ids', 'tfs', 'i', 'doc_id')
+
+    def __init__(self, postings):
+        self.postings = postings
+        self._load(0)
+
+    def _load(self, b):
+        postings = self.postings
+        self.block = b
+        self.i = 0
+        if b >= len(postings.blocks):
+            self.doc_ids = self.tfs = ()
+            self.doc_id = None
+            return
+        self.doc_ids, self.tfs = decode_block(
+            postings.firsts[b], postings.blocks[b])
+        self.doc_id = self.doc_ids[0]
+
+    @property
+    def tf(self):
+        return self.tfs[self.i]
+
+    def next(self):
+        self.i += 1
+        if self.i < len(self.doc_ids):
+            self.doc_id = self.doc_ids[self.i]
+        else:
+            self._load(self.block + 1)
+
+    def seek(self, target):
+        """Move to the first doc id >= `target`."""
+        if self.doc_id is None or self.doc_id >= target:
+            return
+        b = bisect_right(self.postings.firsts, target) - 1
+        if b > self.block:
+            self._load(b)
+        self.i = bisect_left(self.doc_ids, target, self.i)
+        if self.i < len(self.doc_ids):
+            self.doc_id = self.doc_ids[self.i]
+        else:
+            self._load(self.block + 1)
+
+
+def intersect(postings):
+    """Doc ids present in every one of `postings`, in order."""
+    if not postings:
+        return
+    cursors = sorted((p.cursor() for p in postings), key=lambda c: len(
+        c.postings))
+    lead = cursors[0]
+    while lead.doc_id is not None:
+        target = lead.doc_id
+        for cursor in cursors[1:]:
+            cursor.seek(target)
+            if cursor.doc_id is None:
+                return
+            if cursor.doc_id != target:
+                break
+        else:
+            yield target
+            lead.next()
+            continue
+        lead.seek(cursor.doc_id)
+
+
+def union(postings):
+    """Doc ids present in any of `postings`, in order and without repeats."""
+    last = None
+    for doc_id in heapq.merge(*(p.doc_ids() for p in postings)):
+        if doc_id != last:
+            yield doc_id
+            last = doc_id
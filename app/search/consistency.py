@@ -0,0 +1,182 @@
+"""
+Consistency check between documents and their postings in the active
+index generation. Documents are re-analyzed and compared with the stored
+postings one id range at a time, so memory stays bounded by the batch
+size.
+"""
+
+from collections import Counter, OrderedDict
+
+from .. import db
+
+SAMPLE_SIZE = 20
+
+PROBLEMS = OrderedDict([
+    ('missing_postings', 'documents with terms missing from the index'),
+    ('stale_postings', 'documents with postings for terms they lack'),
+    ('wrong_tf', 'documents with wrong term frequencies'),
+    ('wrong_positions', 'documents with missing or wrong term positions'),
+    ('wrong_length', 'documents with a wrong indexed length'),
+    ('deleted_documents', 'deleted documents that still have postings'),
+    ('orphan_terms', 'terms without any postings'),
+    ('published_df', 'terms with a wrong published document frequency'),
+    ('corpus_stats', 'wrong published document count or total length'),
+])
+
+
+class IndexReport(object):
+    """Number of problems of each kind, with a few example ids."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.samples = dict((kind, []) for kind in PROBLEMS)
+
+    def add(self, kind, id):
+        self.counts[kind] += 1
+        if len(self.samples[kind]) < SAMPLE_SIZE:
+            self.samples[kind].append(id)
+
+    @property
+    def ok(self):
+        return not any(self.counts.values())
+
+    def lines(self):
+        for kind, description in PROBLEMS.items():
+            if self.counts[kind]:
+                yield '{}: {} {}'.format(
+                    kind, self.counts[kind], description)
+                if self.samples[kind]:
+                    yield '    e.g. {}'.format(
+                        ', '.join(str(i) for i in self.samples[kind]))
+
+
+def check_documents(report, analyzer, batch_size, repair):
+    from app.models import CorpusStats, Document, Idf, Posting
+
+    generation = CorpusStats.generation()
+    last_id = 0
+    while True:
+        documents = Document.query.options(db.noload('tags')).filter(
+            Document.id > last_id).order_by(Document.id).limit(
+            batch_size).all()
+        if not documents:
+            return
+        last_id = documents[-1].id
+
+        stored = dict((document.id, {}) for document in documents)
+        stored_positions = dict((doc_id, {}) for doc_id in stored)
+        postings = db.session.query(
+            Posting.document_id, Idf.term, Posting.tf, Posting.positions
+        ).join(Idf, Idf.id == Posting.term_id).filter(
+            Idf.generation == generation,
+            Posting.document_id.in_(list(stored)))
+        for doc_id, term, tf, encoded in postings:
+            stored[doc_id][term] = tf
+            stored_positions[doc_id][term] = encoded
+
+        for document in documents:
+            length, tf, positions = analyzer.term_positions(
+                document.corpus)
+            have = stored[document.id]
+            if any(t not in have for t in tf):
+                report.add('missing_postings', document.id)
+            if any(t not in tf for t in have):
+                report.add('stale_postings', document.id)
+            if any(t in have and have[t] != n for t, n in tf.items()):
+                report.add('wrong_tf', document.id)
+            have_positions = stored_positions[document.id]
+            if any(t in have and have_positions[t] != p
+                   for t, p in positions.items()):
+                report.add('wrong_positions', document.id)
+            if document.length != length:
+                report.add('wrong_length', document.id)
+                if repair:
+                    document.length = length
+            if repair:
+                Posting.update_document(
+                    document.id, have, tf, positions=positions)
+        if repair:
+            db.session.commit()
+        # The batch is committed or untouched by now; expunging keeps the
+        # session (and memory) from growing with every batch.
+        db.session.expunge_all()
+
+
+def check_leftovers(report, batch_size, repair):
+    from app.models import CorpusStats, Document, Idf, Posting
+    from .generations import inactive_generations
+
+    deleted = db.session.query(Posting.document_id).outerjoin(
+        Document, Document.id == Posting.document_id
+    ).filter(Document.id.is_(None)).distinct()
+    deleted_ids = [doc_id for doc_id, in deleted]
+    for doc_id in deleted_ids:
+        report.add('deleted_documents', doc_id)
+    if repair:
+        for i in range(0, len(deleted_ids), batch_size):
+            Posting.query.filter(
+                Posting.document_id.in_(deleted_ids[i:i + batch_size])
+            ).delete(synchronize_session=False)
+            db.session.commit()
+
+    # A generation still being built has terms whose postings are not
+    # written yet
+    generations = [CorpusStats.generation()] + inactive_generations()
+    orphans = db.session.query(Idf.id).filter(
+        Idf.generation.in_(generations),
+        ~db.exists().where(Posting.term_id == Idf.id))
+    orphan_ids = [term_id for term_id, in orphans]
+    for term_id in orphan_ids:
+        report.add('orphan_terms', term_id)
+    if repair:
+        for i in range(0, len(orphan_ids), batch_size):
+            Idf.query.filter(
+                Idf.id.in_(orphan_ids[i:i + batch_size])
+            ).delete(synchronize_session=False)
+            db.session.commit()
+
+
+def check_statistics(report, repair):
+    from app.models import CorpusStats, Document, Idf, Posting
+
+    published = Document.document_status == 'published'
+    df = db.session.query(
+        Posting.term_id, db.func.count().label('df')
+    ).join(Document, Document.id == Posting.document_id).filter(
+        published).group_by(Posting.term_id).subquery()
+    wrong_df = db.session.query(Idf.id).outerjoin(
+        df, df.c.term_id == Idf.id
+    ).filter(
+        Idf.generation == CorpusStats.generation(),
+        Idf.published_df != db.func.coalesce(df.c.df, 0)
+    )
+    for term_id, in wrong_df:
+        report.add('published_df', term_id)
+
+    doc_count, total_length = db.session.query(
+        db.func.count(Document.id),
+        db.func.coalesce(db.func.sum(Document.length), 0)
+    ).filter(published).one()
+    stats = CorpusStats.get()
+    if (stats.doc_count, stats.total_length) != (doc_count, total_length):
+        report.add('corpus_stats', stats.id)
+
+    if repair:
+        CorpusStats.recompute()
+        CorpusStats.bump()
+        db.session.commit()
+
+
+def check_index(analyzer, batch_size=500, repair=False):
+    """
+    Compare every document with its postings, look for postings of
+    deleted documents and terms nothing refers to, and check the published
+    statistics. With `repair`, each batch of fixes is committed as it goes
+    and the statistics are recomputed at the end; statistics problems are
+    then counted after the posting repairs. Returns an IndexReport.
+    """
+    report = IndexReport()
+    check_documents(report, analyzer, batch_size, repair)
+    check_leftovers(report, batch_size, repair)
+    check_statistics(report, repair)
+    return report
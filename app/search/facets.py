@@ -0,0 +1,228 @@
+"""
+Bitmaps of the documents having each facet value (document type, status,
+tag and publication year), used to filter searches in memory instead of
+with SQL subqueries. A bitmap is a Python int with bit `doc_id` set for
+every document in it, so intersections and unions are single big-integer
+operations.
+"""
+
+import threading
+from itertools import chain
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .. import db
+
+FACETS = ('doc_type', 'status', 'tag', 'year')
+
+
+def to_bitmap(doc_ids):
+    doc_ids = list(doc_ids)
+    if not doc_ids:
+        return 0
+    bits = bytearray(max(doc_ids) // 8 + 1)
+    for doc_id in doc_ids:
+        bits[doc_id >> 3] |= 1 << (doc_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def from_bitmap(bitmap):
+    """The doc ids in `bitmap`, in order."""
+    bits = bin(bitmap)[:1:-1]
+    i = bits.find('1')
+    while i >= 0:
+        yield i
+        i = bits.find('1', i + 1)
+
+
+def count(bitmap):
+    return bin(bitmap).count('1')
+
+
+class FacetIndex(object):
+    """
+    Facet bitmaps of every document, loaded with the search index and
+    updated from the documents and tags each commit_corpus_change flushed.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.bitmaps = dict((facet, {}) for facet in FACETS)
+        # doc_id -> (doc_type, status, tag ids, publication key)
+        self.documents = {}
+
+    def load(self):
+        from app.models import Document, Tagged
+
+        documents = dict(
+            (doc_id, (doc_type, status, set(), key))
+            for doc_id, doc_type, status, key in db.session.query(
+                Document.id, Document.doc_type, Document.document_status,
+                Document.publication_key)
+        )
+        for doc_id, tag_id in db.session.query(
+                Tagged.document_id, Tagged.tag_id):
+            if doc_id in documents:
+                documents[doc_id][2].add(tag_id)
+
+        values = dict((facet, {}) for facet in FACETS)
+        for doc_id, facets in documents.items():
+            for facet, value in self._values(facets):
+                values[facet].setdefault(value, []).append(doc_id)
+        bitmaps = dict(
+            (facet, dict(
+                (value, to_bitmap(doc_ids))
+                for value, doc_ids in values[facet].items()))
+            for facet in FACETS
+        )
+        with self._lock:
+            self.bitmaps = bitmaps
+            self.documents = documents
+
+    @staticmethod
+    def _values(facets):
+        doc_type, status, tag_ids, key = facets
+        yield 'doc_type', doc_type
+        yield 'status', status
+        for tag_id in tag_ids:
+            yield 'tag', tag_id
+        yield 'year', (key or 0) // 10000
+
+    def set(self, doc_id, doc_type, status, tag_ids, key):
+        """Replace the facet values of a document."""
+        with self._lock:
+            self.remove(doc_id)
+            facets = (doc_type, status, set(tag_ids), key)
+            self.documents[doc_id] = facets
+            bit = 1 << doc_id
+            for facet, value in self._values(facets):
+                bitmaps = self.bitmaps[facet]
+                bitmaps[value] = bitmaps.get(value, 0) | bit
+
+    def remove(self, doc_id):
+        with self._lock:
+            facets = self.documents.pop(doc_id, None)
+            if facets is None:
+                return
+            bit = 1 << doc_id
+            for facet, value in self._values(facets):
+                bitmaps = self.bitmaps[facet]
+                bitmaps[value] &= ~bit
+                if not bitmaps[value]:
+                    del bitmaps[value]
+
+    def refresh(self, doc_ids):
+        """Re-read the facets of `doc_ids`."""
+        from app.models import Document, Tagged
+
+        doc_ids = list(doc_ids)
+        documents = dict(
+            (doc_id, (doc_type, status, set(), key))
+            for doc_id, doc_type, status, key in db.session.query(
+                Document.id, Document.doc_type, Document.document_status,
+                Document.publication_key
+            ).filter(Document.id.in_(doc_ids))
+        ) if doc_ids else {}
+        if documents:
+            for doc_id, tag_id in db.session.query(
+                    Tagged.document_id, Tagged.tag_id).filter(
+                    Tagged.document_id.in_(list(documents))):
+                documents[doc_id][2].add(tag_id)
+        with self._lock:
+            for doc_id in doc_ids:
+                if doc_id in documents:
+                    self.set(doc_id, *documents[doc_id])
+                else:
+                    self.remove(doc_id)
+
+    def bitmap(self, facet, values):
+        """Documents having any of `values` for `facet`."""
+        bitmaps = self.bitmaps[facet]
+        result = 0
+        for value in values:
+            result |= bitmaps.get(value, 0)
+        return result
+
+    def counts(self, doc_ids, facets=('doc_type', 'tag', 'year')):
+        """
+        How many of `doc_ids` have each value of `facets`, by intersecting
+        one bitmap of them with each value's bitmap. Values no document
+        has are left out.
+        """
+        with self._lock:
+            results = to_bitmap(doc_ids)
+            counts = {}
+            for facet in facets:
+                counts[facet] = {}
+                for value, bitmap in self.bitmaps[facet].items():
+                    n = count(results & bitmap)
+                    if n:
+                        counts[facet][value] = n
+        return counts
+
+    def dates(self, start=None, end=None):
+        """
+        Documents whose publication key is within [`start`, `end`]. Years
+        strictly inside the range are taken whole; only documents of the
+        first and last year are compared one by one.
+        """
+        def in_range(doc_id):
+            key = self.documents[doc_id][3]
+            return key is not None and (start is None or key >= start) and (
+                end is None or key <= end)
+
+        first = start // 10000 if start is not None else None
+        last = end // 10000 if end is not None else None
+        result = 0
+        for year, bitmap in self.bitmaps['year'].items():
+            if (first is not None and year < first) or (
+                    last is not None and year > last):
+                continue
+            if year in (first, last, 0):
+                bitmap = to_bitmap(filter(in_range, from_bitmap(bitmap)))
+            result |= bitmap
+        return result
+
+    def select(self, doc_ids, status=None, doc_types=None, tag_ids=None,
+               all_tags=False, start=None, end=None):
+        """
+        The documents of `doc_ids` that pass every filter that is not None;
+        a list of `doc_types` or `tag_ids` matches documents having any of
+        them, or with `all_tags` documents having every one of `tag_ids`.
+        """
+        with self._lock:
+            result = to_bitmap(doc_ids)
+            if status is not None:
+                result &= self.bitmap('status', [status])
+            if doc_types is not None:
+                result &= self.bitmap('doc_type', doc_types)
+            if tag_ids is not None and all_tags:
+                for tag_id in tag_ids:
+                    result &= self.bitmap('tag', [tag_id])
+            elif tag_ids is not None:
+                result &= self.bitmap('tag', tag_ids)
+            if start is not None or end is not None:
+                result &= self.dates(start, end)
+        return list(from_bitmap(result))
+
+
+@event.listens_for(Session, 'after_flush')
+def track_facet_changes(session, flush_context):
+    """
+    Note the documents whose facets a flush may have changed, for
+    commit_corpus_change to refresh. Deleting a tag affects every
+    document that had it.
+    """
+    from app.models import Document, Tag, Tagged
+    from . import search_index
+
+    changed = session.info.setdefault('facet_changes', set())
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, Document):
+            changed.add(instance.id)
+        elif isinstance(instance, Tagged):
+            changed.add(instance.document_id)
+        elif isinstance(instance, Tag) and instance in session.deleted:
+            changed.update(from_bitmap(
+                search_index.facets.bitmap('tag', [instance.id])))
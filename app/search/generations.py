@@ -0,0 +1,104 @@
+"""
+Blue/green builds of the search index. A new generation is written next
+to the active one while searches keep reading the old generation, then
+activate_generation switches over in a single transaction.
+"""
+
+import datetime
+
+from .. import db
+from .index import SYNC_SLACK
+
+
+def begin_generation(tokenizer=None):
+    """Register a new generation to build, committing it."""
+    from app.models import IndexGeneration
+
+    generation = IndexGeneration(status='building', tokenizer=tokenizer)
+    db.session.add(generation)
+    db.session.commit()
+    return generation
+
+
+def catch_up(generation, analyzer, since=None, batch_size=500):
+    """
+    Bring a finished build up to date with edits made while it was being
+    written: documents edited since `since`, by default since the build
+    started, are re-analyzed into it, and postings of documents deleted
+    are removed. Returns the number of documents re-analyzed.
+    """
+    from app.models import Document, Idf, Posting
+
+    if since is None:
+        since = generation.created_date
+    edited = [doc_id for doc_id, in db.session.query(Document.id).filter(
+        Document.last_edited_date >= since)]
+    for i in range(0, len(edited), batch_size):
+        documents = Document.query.options(db.noload('tags')).filter(
+            Document.id.in_(edited[i:i + batch_size]))
+        for document in documents:
+            _, tf, positions = analyzer.term_positions(document.corpus)
+            Posting.update_document(
+                document.id,
+                Posting.document_tf(document.id, generation.id),
+                tf, generation.id, positions
+            )
+
+    deleted = db.session.query(Posting.document_id).join(
+        Idf, Idf.id == Posting.term_id
+    ).outerjoin(Document, Document.id == Posting.document_id).filter(
+        Idf.generation == generation.id, Document.id.is_(None))
+    Posting.query.filter(Posting.document_id.in_(
+        [doc_id for doc_id, in deleted.distinct()]
+    )).delete(synchronize_session=False)
+    return len(edited)
+
+
+def activate_generation(generation, analyzer, batch_size=500):
+    """
+    Catch a finished build up and switch searches over to it. Edits keep
+    going to the active generation until the switch, so the build is
+    caught up twice: once with everything edited during the build, then,
+    in the transaction that switches over, with what was edited during
+    that first catch-up. The second catch-up holds the corpus_stats row
+    lock editors take, so no edit can reach the old generation between it
+    and the switch, and goes back SYNC_SLACK for edits stamped before
+    they were committed. Returns the number of documents re-analyzed.
+    """
+    from app.models import CorpusStats
+
+    started = datetime.datetime.utcnow()
+    edited = catch_up(generation, analyzer, batch_size=batch_size)
+    db.session.commit()
+    CorpusStats.lock()
+    edited += catch_up(
+        generation, analyzer, started - SYNC_SLACK, batch_size)
+    CorpusStats.activate(generation.id)
+    db.session.commit()
+    return edited
+
+
+def inactive_generations():
+    """Ids of generations that are neither active nor being built."""
+    from app.models import CorpusStats, Idf, IndexGeneration
+
+    keep = set([CorpusStats.generation()])
+    keep.update(
+        generation_id for generation_id, in db.session.query(
+            IndexGeneration.id).filter(IndexGeneration.status == 'building'))
+    stored = set(
+        generation for generation, in db.session.query(
+            Idf.generation).distinct())
+    return sorted(stored - keep)
+
+
+def drop_generation(generation):
+    """Delete an inactive generation's terms and postings."""
+    from app.models import CorpusStats, IndexGeneration, Posting
+
+    if generation == CorpusStats.generation():
+        raise ValueError(
+            'Generation {} is active and cannot be dropped'.format(generation))
+    Posting.drop_generation(generation)
+    IndexGeneration.query.filter_by(id=generation).delete(
+        synchronize_session=False)
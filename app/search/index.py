@@ -0,0 +1,720 @@
+import datetime
+import heapq
+import os
+import struct
+import threading
+from collections import Counter
+
+from .. import db
+from .codec import Postings, decode_positions, intersect
+from .facets import FacetIndex
+from .matrix import MatrixScorer, available
+from .phrases import matches
+from .ranking import TfIdf, make_ranker
+from .segments import Segment, TermView, merge_segments
+from .snapshot import Overlay, OverlaySet, Snapshot
+from .vocabulary import Vocabulary
+
+# Allowance for rounding when comparing a score bound with the threshold.
+BOUND_SLACK = 1e-9
+# Edits are dated before they commit, so a sync also re-reads documents
+# edited this long before the previous one.
+SYNC_SLACK = datetime.timedelta(minutes=5)
+
+
+class InvertedIndex(object):
+    """
+    In-memory copy of the active generation of the Idf / Posting tables.
+    It is built once per worker and kept current by the editor views, so
+    searching never needs a per-term query. When SEARCH_SNAPSHOT_PATH
+    names a snapshot file, it is mapped instead of copied into each
+    worker. Edits are appended to segments over the base posting lists
+    and merged into them in the background. Postings cover every
+    document; the statistics used for scoring (document count, document
+    frequency, average length) only count published documents, matching
+    CorpusStats and Idf.published_df. Term positions, for phrase
+    searches, are kept per document rather than in the posting lists.
+    """
+
+    def __init__(self, ranker=None):
+        self._lock = threading.RLock()
+        self.ranker = ranker or TfIdf()
+        self.loaded = False
+        self.version = None
+        # Active generation and UTC time of the last load or sync
+        self.generation = None
+        self.synced = None
+        # Posting lists and document terms as of the last merge
+        self.base = {}
+        self.doc_terms = {}
+        self.segments = [Segment()]
+        self.merge_size = 5000
+        self._merging = False
+        # Changes whenever the base is replaced, voiding running merges
+        self._epoch = 0
+        self.doc_lengths = {}
+        # doc_id -> {term: positions encoded by codec.encode_positions}
+        self.positions = {}
+        self.published = set()
+        self.published_df = {}
+        self.published_length = 0
+        # term -> word shown instead of it, where one is known
+        self.words = {}
+        self.snapshot_path = None
+        self.snapshot = None
+        self.facets = FacetIndex()
+        # MatrixScorer of the base, when SEARCH_VECTORIZED is on
+        self.vectorized = False
+        self.matrix = None
+        # (epoch, Vocabulary) last built
+        self._vocabulary = None
+
+    def init_app(self, app):
+        self.ranker = make_ranker(app.config)
+        self.snapshot_path = app.config.get('SEARCH_SNAPSHOT_PATH')
+        self.merge_size = app.config.get('SEARCH_MERGE_SIZE', 5000)
+        self.vectorized = app.config.get('SEARCH_VECTORIZED', False)
+        if self.vectorized and not available():
+            raise ValueError('SEARCH_VECTORIZED needs numpy and scipy')
+
+    def load(self):
+        """
+        Load the index from the snapshot file if there is one for the
+        active generation, otherwise from the database. Facets always
+        come from the database.
+        """
+        from app.models import CorpusStats
+
+        started = datetime.datetime.utcnow()
+        snapshot = self.open_snapshot()
+        if snapshot is None:
+            self.load_database()
+        else:
+            self.load_snapshot(snapshot)
+        self.facets.load()
+        self.generation = CorpusStats.generation()
+        self.synced = started
+
+    def open_snapshot(self):
+        from app.models import CorpusStats
+
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+        snapshot = self.snapshot
+        stat = os.stat(self.snapshot_path)
+        if snapshot is None or snapshot.stat != (stat.st_ino, stat.st_mtime):
+            try:
+                snapshot = Snapshot(self.snapshot_path)
+            except (ValueError, struct.error):
+                # An older format, rewritten by write_index_snapshot, or a
+                # damaged file; the database is loaded instead
+                return None
+        if snapshot.generation != CorpusStats.generation():
+            return None
+        return snapshot
+
+    def use_snapshot(self, snapshot):
+        """
+        Serve the index out of a mapped Snapshot. Changes go into in-memory
+        overlays; the mapped file itself is shared by every worker.
+        """
+        with self._lock:
+            self.snapshot = snapshot
+            self.base = Overlay(snapshot.postings)
+            self.doc_terms = Overlay(snapshot.doc_terms)
+            self.segments = [Segment()]
+            self.matrix = None
+            self._epoch += 1
+            self.doc_lengths = Overlay(snapshot.doc_lengths)
+            self.positions = Overlay(snapshot.positions)
+            self.published = OverlaySet(snapshot.published)
+            self.published_df = Overlay(snapshot.published_df)
+            self.words = Overlay(snapshot.words)
+            self.published_length = snapshot.published_length
+            self.loaded = True
+        self._build_in_background()
+
+    def load_snapshot(self, snapshot):
+        """
+        Use `snapshot`, then apply the documents added, edited, deleted or
+        (un)published since it was written, going back SYNC_SLACK for
+        edits committed after their timestamps.
+        """
+        with self._lock:
+            self.use_snapshot(snapshot)
+            self.catch_up(
+                datetime.datetime.utcfromtimestamp(snapshot.created) -
+                SYNC_SLACK)
+
+    def catch_up(self, since):
+        """
+        Apply the documents added, edited or deleted since `since` (UTC),
+        reading the postings of those documents only, and the status of
+        every document. Returns the ids of the documents whose facets may
+        have changed: those re-read, deleted or with another status.
+        """
+        from app.models import CorpusStats, Document, Idf, Posting
+
+        with self._lock:
+            published = {}
+            changed = []
+            touched = []
+            query = db.session.query(
+                Document.id, Document.document_status,
+                Document.last_edited_date
+            )
+            for doc_id, status, edited in query:
+                published[doc_id] = status == 'published'
+                if doc_id not in self.doc_lengths or (
+                        edited is not None and edited >= since):
+                    changed.append(doc_id)
+                else:
+                    self.set_published(doc_id, published[doc_id])
+                    facets = self.facets.documents.get(doc_id)
+                    if facets is None or facets[1] != status:
+                        touched.append(doc_id)
+            for doc_id in [d for d in self.doc_lengths if d not in published]:
+                self.remove(doc_id)
+                touched.append(doc_id)
+            touched.extend(changed)
+
+            generation = CorpusStats.generation()
+            for i in range(0, len(changed), 500):
+                tfs = dict((doc_id, {}) for doc_id in changed[i:i + 500])
+                positions = dict((doc_id, {}) for doc_id in tfs)
+                query = db.session.query(
+                    Posting.document_id, Idf.term, Posting.tf,
+                    Posting.positions, Idf.word
+                ).join(Idf, Idf.id == Posting.term_id).filter(
+                    Idf.generation == generation,
+                    Posting.document_id.in_(list(tfs))
+                )
+                for doc_id, term, tf, encoded, word in query:
+                    tfs[doc_id][term] = tf
+                    if encoded is not None:
+                        positions[doc_id][term] = bytes(encoded)
+                    if word is not None and term not in self.words:
+                        self.words[term] = word
+                for doc_id, tf in tfs.items():
+                    self.update(
+                        doc_id, tf, published[doc_id], positions[doc_id])
+            return touched
+
+    def load_database(self):
+        from app.models import CorpusStats, Document, Idf, Posting
+
+        generation = CorpusStats.generation()
+        doc_terms = {}
+        doc_lengths = {}
+        published = set()
+        query = db.session.query(
+            Document.id, Document.length, Document.document_status
+        )
+        for doc_id, length, status in query:
+            doc_terms[doc_id] = []
+            doc_lengths[doc_id] = length or 0
+            if status == 'published':
+                published.add(doc_id)
+
+        postings = {}
+        positions = {}
+        current = None
+        doc_ids = []
+        tfs = []
+        query = db.session.query(
+            Idf.term, Posting.document_id, Posting.tf, Posting.positions
+        ).join(Posting, Posting.term_id == Idf.id).filter(
+            Idf.generation == generation
+        ).order_by(Posting.term_id, Posting.document_id)
+        for term, doc_id, tf, encoded in query.yield_per(10000):
+            if doc_id not in doc_terms:
+                continue
+            if encoded is not None:
+                positions.setdefault(doc_id, {})[term] = bytes(encoded)
+            if term != current:
+                if doc_ids:
+                    postings[current] = Postings(doc_ids, tfs)
+                current = term
+                doc_ids = []
+                tfs = []
+            doc_ids.append(doc_id)
+            tfs.append(tf)
+            doc_terms[doc_id].append(term)
+        if doc_ids:
+            postings[current] = Postings(doc_ids, tfs)
+        for doc_id, terms in doc_terms.items():
+            doc_terms[doc_id] = tuple(terms)
+
+        published_df = {}
+        words = {}
+        for term, df, word in db.session.query(
+                Idf.term, Idf.published_df, Idf.word).filter(
+                Idf.generation == generation):
+            if df > 0:
+                published_df[term] = df
+            if word is not None:
+                words[term] = word
+
+        with self._lock:
+            self.snapshot = None
+            self.base = postings
+            self.doc_terms = doc_terms
+            self.segments = [Segment()]
+            self.matrix = None
+            self._epoch += 1
+            self.doc_lengths = doc_lengths
+            self.positions = positions
+            self.published = published
+            self.published_df = published_df
+            self.words = words
+            self.published_length = sum(doc_lengths[d] for d in published)
+            self.loaded = True
+        self._build_in_background()
+
+    def sync(self, version):
+        """
+        Catch up with changes other processes made to the corpus, if it is
+        no longer at `version`. Only the documents edited since the last
+        sync are re-read, and only their facets refreshed; the index is
+        loaded from scratch the first time and when another generation was
+        activated.
+        """
+        from app.models import CorpusStats
+
+        if self.loaded and self.version == version:
+            return
+        with self._lock:
+            if self.loaded and self.version == version:
+                return
+            if not self.loaded or \
+                    self.generation != CorpusStats.generation():
+                self.load()
+            else:
+                started = datetime.datetime.utcnow()
+                self.facets.refresh(self.catch_up(self.synced - SYNC_SLACK))
+                self.synced = started
+            self.version = version
+
+    def advance(self, version):
+        """
+        Record that this process made the change that produced `version`,
+        so the index does not reload for it.
+        """
+        with self._lock:
+            if self.loaded and self.version == version - 1:
+                self.version = version
+
+    @property
+    def num_docs(self):
+        return len(self.published)
+
+    @property
+    def avg_length(self):
+        if not self.published:
+            return 0.0
+        return self.published_length / len(self.published)
+
+    def df(self, term):
+        return self.published_df.get(term, 0)
+
+    def word(self, term):
+        """
+        The word to show for `term`: the one stored with it, or else the
+        one this process's analyzer saw it stemmed from.
+        """
+        from . import analyzer
+
+        return self.words.get(term) or analyzer.word(term)
+
+    def update(self, doc_id, tf, published=False, positions=None):
+        """
+        Replace the indexed terms of a document with `tf`, and their
+        positions with `positions` (term -> encoded positions) if known.
+        """
+        with self._lock:
+            self.set_published(doc_id, False)
+            self.segments[-1].write(doc_id, tf)
+            self.doc_lengths[doc_id] = sum(tf.values())
+            if positions:
+                self.positions[doc_id] = positions
+            else:
+                self.positions.pop(doc_id, None)
+            self.set_published(doc_id, published)
+        self._merge_if_full()
+
+    def set_published(self, doc_id, published):
+        """Count or stop counting a document in the published statistics."""
+        with self._lock:
+            if published == (doc_id in self.published):
+                return
+            delta = 1 if published else -1
+            if published:
+                self.published.add(doc_id)
+            else:
+                self.published.discard(doc_id)
+            self.published_length += delta * self.doc_lengths.get(doc_id, 0)
+            for term in self.terms_of(doc_id):
+                self.published_df[term] = self.published_df.get(term, 0) + \
+                    delta
+
+    def remove(self, doc_id):
+        with self._lock:
+            self.set_published(doc_id, False)
+            self.segments[-1].delete(doc_id)
+            self.doc_lengths.pop(doc_id, None)
+            self.positions.pop(doc_id, None)
+        self._merge_if_full()
+
+    def terms_of(self, doc_id):
+        """The terms a document is currently indexed under."""
+        with self._lock:
+            for segment in reversed(self.segments):
+                if doc_id in segment.tombstones:
+                    return segment.doc_terms.get(doc_id, ())
+            return self.doc_terms.get(doc_id, ())
+
+    def _merge_if_full(self):
+        if self.segments[-1].size >= self.merge_size and not self._merging:
+            thread = threading.Thread(target=self.merge)
+            thread.daemon = True
+            thread.start()
+
+    def merge(self):
+        """
+        Fold the segments into the base posting lists. The merged lists are
+        built outside the lock: meanwhile writes go to a fresh segment and
+        searches keep reading the old layers, and the result is swapped in
+        at the end. Returns False if there was nothing to merge or another
+        merge is running.
+        """
+        with self._lock:
+            if self._merging or not any(self.segments):
+                return False
+            self._merging = True
+            segments = list(self.segments)
+            self.segments.append(Segment())
+            base, doc_terms, epoch = self.base, self.doc_terms, self._epoch
+        try:
+            merged, written = merge_segments(base, doc_terms, segments)
+            with self._lock:
+                if self._epoch != epoch:
+                    return False
+                for term, entry in merged.items():
+                    if entry is None:
+                        base.pop(term, None)
+                    else:
+                        base[term] = entry
+                for doc_id, terms in written.items():
+                    if terms is None:
+                        doc_terms.pop(doc_id, None)
+                    else:
+                        doc_terms[doc_id] = terms
+                del self.segments[:len(segments)]
+                self.matrix = None
+                self._epoch += 1
+            self.build_vocabulary()
+            if self.vectorized:
+                self._build_matrix()
+        finally:
+            self._merging = False
+        return True
+
+    def _build_in_background(self):
+        targets = [self.build_vocabulary]
+        if self.vectorized:
+            targets.append(self.build_matrix)
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def build_matrix(self):
+        """
+        Copy the base posting lists into a MatrixScorer. Like a merge this
+        runs outside the lock, and searches use the posting lists until it
+        is ready. Returns False if a merge is running; the merge builds
+        the matrix itself when it is done.
+        """
+        with self._lock:
+            if self._merging:
+                return False
+            self._merging = True
+        try:
+            self._build_matrix()
+        finally:
+            self._merging = False
+        return True
+
+    def _build_matrix(self):
+        with self._lock:
+            base, epoch = self.base, self._epoch
+        matrix = MatrixScorer(base, self.doc_lengths)
+        with self._lock:
+            if self._epoch == epoch:
+                self.matrix = matrix
+
+    def _layers(self):
+        """
+        (posting lists, hidden doc ids) of each segment, newest first, and
+        then of the base; a layer hides what newer layers tombstoned.
+        """
+        layers = []
+        hidden = frozenset()
+        for segment in reversed(self.segments):
+            layers.append((segment.postings, hidden))
+            if segment.tombstones:
+                hidden = hidden | segment.tombstones if hidden else \
+                    segment.tombstones
+        layers.append((self.base, hidden))
+        return layers
+
+    def _term_postings(self, term, layers):
+        found = []
+        for postings, hidden in layers:
+            entry = postings.get(term)
+            if entry is not None:
+                found.append((entry, hidden))
+        if not found:
+            return None
+        if len(found) == 1 and not found[0][1]:
+            return found[0][0]
+        return TermView(found)
+
+    def term_postings(self, term):
+        """The live postings of `term` across the base and segments."""
+        with self._lock:
+            return self._term_postings(term, self._layers())
+
+    def vocabulary(self):
+        """
+        The Vocabulary of published terms. It is built on first use after
+        each load or merge, so terms first indexed since the last merge
+        are not in it yet. Like a merge it is built outside the lock, from
+        a copy of the frequencies, and swapped in unless the index was
+        loaded or merged again meanwhile.
+        """
+        with self._lock:
+            if self._vocabulary is not None and \
+                    self._vocabulary[0] == self._epoch:
+                return self._vocabulary[1]
+            epoch = self._epoch
+            dfs = list(self.published_df.items())
+        vocabulary = Vocabulary(dfs)
+        with self._lock:
+            if self._epoch == epoch:
+                self._vocabulary = (epoch, vocabulary)
+        return vocabulary
+
+    def build_vocabulary(self):
+        """
+        Build the Vocabulary and its trigram index ahead of the first
+        misspelled query.
+        """
+        self.vocabulary().trigram_index
+
+    def corrections(self, terms, limit=3):
+        """
+        {term: [(match, df)]} of the nearest vocabulary terms to each of
+        `terms` no published document has. Terms nothing is close to are
+        left out.
+        """
+        vocabulary = self.vocabulary()
+        corrections = {}
+        for term in set(terms):
+            if not self.df(term):
+                matches = vocabulary.similar(term, limit)
+                if matches:
+                    corrections[term] = matches
+        return corrections
+
+    def candidates(self, terms):
+        """Ids of every document containing at least one of `terms`."""
+        docs = set()
+        with self._lock:
+            layers = self._layers()
+            for term in set(terms):
+                entry = self._term_postings(term, layers)
+                if entry is not None:
+                    docs.update(entry.doc_ids())
+        return docs
+
+    def phrase_docs(self, phrase, doc_ids):
+        """
+        The documents of `doc_ids` containing `phrase`, a phrase of
+        Analyzer.parse_query, in order. The posting lists of its terms are
+        intersected first, then the positions of the terms in each
+        document left. Documents indexed without positions match if they
+        contain every term.
+        """
+        terms = sorted(set(term for term, _ in phrase[0]))
+        allowed = set(doc_ids)
+        found = []
+        with self._lock:
+            layers = self._layers()
+            lists = [self._term_postings(term, layers) for term in terms]
+            if None in lists:
+                return []
+            for doc_id in intersect(lists):
+                if doc_id not in allowed:
+                    continue
+                stored = self.positions.get(doc_id) or {}
+                encoded = [stored.get(term) for term in terms]
+                if None in encoded or matches(phrase, dict(
+                        (term, decode_positions(data))
+                        for term, data in zip(terms, encoded))):
+                    found.append(doc_id)
+        return found
+
+    def idf(self, term):
+        return self.ranker.idf(self.num_docs, self.df(term))
+
+    def score(self, terms, doc_ids=None):
+        """
+        Score every matching document with the configured ranker, term at
+        a time. Repeated query terms count once per occurrence. If
+        `doc_ids` is given only those documents are scored.
+        """
+        allowed = set(doc_ids) if doc_ids is not None else None
+        scores = {}
+        with self._lock:
+            avg_length = self.avg_length
+            term_score = self.ranker.term_score
+            layers = self._layers()
+            for term, weight in Counter(terms).items():
+                entry = self._term_postings(term, layers)
+                if entry is None:
+                    continue
+                idf = self.idf(term)
+                for doc_id, tf in entry.items():
+                    if allowed is None or doc_id in allowed:
+                        length = self.doc_lengths.get(doc_id, 0)
+                        scores[doc_id] = scores.get(doc_id, 0) + weight * \
+                            term_score(tf, idf, length, avg_length)
+        return scores
+
+    def top_k(self, terms, k, doc_ids=None):
+        """
+        The `k` best scoring documents for `terms`, best first; ties go to
+        the higher (newer) doc id. Uses MaxScore: each term's score is
+        bounded by its largest tf, and once the k-th best score exceeds
+        the combined bound of the weakest terms, documents containing only
+        those terms are skipped and the rest are only looked up in them
+        while they could still make the cut. If `doc_ids` is given only
+        those documents are ranked. Once a vectorized matrix is built it
+        is used instead.
+        """
+        if k <= 0:
+            return []
+        allowed = set(doc_ids) if doc_ids is not None else None
+        with self._lock:
+            if self.matrix is not None:
+                return self._matrix_top_k(terms, k, allowed)
+            avg_length = self.avg_length
+            term_score = self.ranker.term_score
+            lists = []
+            layers = self._layers()
+            for term, weight in Counter(terms).items():
+                entry = self._term_postings(term, layers)
+                if entry is None or not len(entry):
+                    continue
+                idf = self.idf(term)
+                bound = weight * max(
+                    0.0, term_score(entry.max_tf, idf, 0, avg_length))
+                lists.append((bound, weight, idf, entry))
+            lists.sort(key=lambda x: x[0])
+            # bounds[i] is the combined bound of lists[:i]
+            bounds = [0.0]
+            for bound, _, _, _ in lists:
+                bounds.append(bounds[-1] + bound)
+
+            cursors = [entry.cursor() for _, _, _, entry in lists]
+            heap = []
+            threshold = float('-inf')
+            # lists[:first] are non-essential: they alone can't reach the
+            # threshold, so they are only probed for documents found in
+            # the essential lists.
+            first = 0
+            while first < len(lists):
+                doc_id = None
+                for cursor in cursors[first:]:
+                    if cursor.doc_id is not None and (
+                            doc_id is None or cursor.doc_id < doc_id):
+                        doc_id = cursor.doc_id
+                if doc_id is None:
+                    break
+
+                matched = []
+                for i in range(first, len(lists)):
+                    cursor = cursors[i]
+                    if cursor.doc_id == doc_id:
+                        matched.append((i, cursor.tf))
+                        cursor.next()
+                if allowed is not None and doc_id not in allowed:
+                    continue
+
+                length = self.doc_lengths.get(doc_id, 0)
+                score = 0.0
+                for i, tf in matched:
+                    _, weight, idf, _ = lists[i]
+                    score += weight * term_score(tf, idf, length, avg_length)
+                for i in range(first - 1, -1, -1):
+                    if score + bounds[i + 1] + BOUND_SLACK < threshold:
+                        score = None
+                        break
+                    cursor = cursors[i]
+                    cursor.seek(doc_id)
+                    if cursor.doc_id == doc_id:
+                        _, weight, idf, _ = lists[i]
+                        score += weight * term_score(
+                            cursor.tf, idf, length, avg_length)
+                if score is None:
+                    continue
+
+                if len(heap) < k:
+                    heapq.heappush(heap, (score, doc_id))
+                elif (score, doc_id) > heap[0]:
+                    heapq.heapreplace(heap, (score, doc_id))
+                else:
+                    continue
+                if len(heap) == k:
+                    threshold = heap[0][0]
+                    while first < len(lists) and \
+                            bounds[first + 1] + BOUND_SLACK < threshold:
+                        first += 1
+        return [doc_id for _, doc_id in sorted(heap, reverse=True)]
+
+    def _matrix_top_k(self, terms, k, allowed):
+        """
+        top_k with the MatrixScorer for the base, hiding tombstoned rows
+        and those not `allowed` with masks, and the segments scored here.
+        """
+        avg_length = self.avg_length
+        term_score = self.ranker.term_score
+        query = [
+            (term, weight, self.idf(term))
+            for term, weight in Counter(terms).items()
+        ]
+        layers = self._layers()
+        scores, mask = self.matrix.scores(query, self.ranker, avg_length)
+        hidden = layers[-1][1]
+        if hidden:
+            mask &= ~self.matrix.mask(hidden)
+        if allowed is not None:
+            mask &= self.matrix.mask(allowed)
+        best = self.matrix.top_k(scores, mask, k)
+
+        recent = {}
+        for postings, hidden in layers[:-1]:
+            for term, weight, idf in query:
+                entry = postings.get(term)
+                if entry is None:
+                    continue
+                for doc_id, tf in entry.items():
+                    if doc_id in hidden or (
+                            allowed is not None and doc_id not in allowed):
+                        continue
+                    length = self.doc_lengths.get(doc_id, 0)
+                    recent[doc_id] = recent.get(doc_id, 0) + weight * \
+                        term_score(tf, idf, length, avg_length)
+        best.extend((score, doc_id) for doc_id, score in recent.items())
+        return [doc_id for _, doc_id in heapq.nlargest(k, best)]
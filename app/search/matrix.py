@@ -0,0 +1,107 @@
+"""
+Optional vectorized scoring, used when SEARCH_VECTORIZED is set and NumPy
+and SciPy are installed. The base posting lists of InvertedIndex are
+copied into a sparse document x term matrix of term frequencies, so a
+query is scored with a few array operations and one sparse
+matrix-vector product instead of a Python step per posting, and filters
+become boolean masks over the rows. Documents written since the last
+merge are not in the matrix; the index scores those from its segments.
+"""
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+from .codec import decode_block
+
+
+def available():
+    return np is not None
+
+
+class MatrixScorer(object):
+    """
+    Term frequencies of `postings` (term -> BlockPostings) with one row
+    per document, in doc id order, and one column per term. The matrix is
+    stored by column, as queries only ever read a few of them.
+    """
+
+    def __init__(self, postings, doc_lengths):
+        self.columns = {}
+        indptr = [0]
+        doc_ids = []
+        tfs = []
+        for term, entry in postings.items():
+            for first, block in zip(entry.firsts, entry.blocks):
+                block_ids, block_tfs = decode_block(first, block)
+                doc_ids.extend(block_ids)
+                tfs.extend(block_tfs)
+            self.columns[term] = len(indptr) - 1
+            indptr.append(len(doc_ids))
+
+        doc_ids = np.array(doc_ids, dtype=np.int64)
+        self.doc_ids, rows = np.unique(doc_ids, return_inverse=True)
+        self.lengths = np.array(
+            [doc_lengths.get(doc_id, 0) for doc_id in self.doc_ids.tolist()],
+            dtype=np.float64)
+        self.tfs = sparse.csc_matrix(
+            (np.array(tfs, dtype=np.float64), rows, indptr),
+            shape=(len(self.doc_ids), len(self.columns)))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def mask(self, doc_ids):
+        """Boolean row mask of the documents in `doc_ids`."""
+        mask = np.zeros(len(self.doc_ids), dtype=bool)
+        wanted = np.fromiter(doc_ids, dtype=np.int64)
+        rows = np.searchsorted(self.doc_ids, wanted)
+        found = rows < len(self.doc_ids)
+        rows, wanted = rows[found], wanted[found]
+        mask[rows[self.doc_ids[rows] == wanted]] = True
+        return mask
+
+    def scores(self, query, ranker, avg_length):
+        """
+        Score every row for `query`, a list of (term, weight, idf). The
+        ranker's term_score is applied to whole arrays at once. Returns
+        the scores and a mask of the rows containing any query term.
+        """
+        columns = []
+        weights = []
+        idfs = []
+        for term, weight, idf in query:
+            column = self.columns.get(term)
+            if column is not None:
+                columns.append(column)
+                weights.append(weight)
+                idfs.append(idf)
+        matched = np.zeros(len(self.doc_ids), dtype=bool)
+        if not columns:
+            return np.zeros(len(self.doc_ids)), matched
+
+        terms = self.tfs[:, columns]
+        rows = terms.indices
+        data = ranker.term_score(
+            terms.data, np.repeat(idfs, np.diff(terms.indptr)),
+            self.lengths[rows], avg_length)
+        term_scores = sparse.csc_matrix(
+            (data, rows, terms.indptr), shape=terms.shape)
+        matched[rows] = True
+        return term_scores.dot(np.array(weights, dtype=np.float64)), matched
+
+    def top_k(self, scores, mask, k):
+        """
+        (score, doc_id) of the best `k` rows in `mask`, best first; ties
+        go to the higher doc id.
+        """
+        rows = np.flatnonzero(mask)
+        if len(rows) > k:
+            # Only rows scoring at least the k-th best can make the cut
+            cut = np.partition(scores[rows], len(rows) - k)[len(rows) - k]
+            rows = rows[scores[rows] >= cut]
+        order = np.lexsort((self.doc_ids[rows], scores[rows]))[::-1][:k]
+        rows = rows[order]
+        return list(zip(scores[rows].tolist(), self.doc_ids[rows].tolist()))
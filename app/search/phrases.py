@@ -0,0 +1,61 @@
+"""
+Phrase and proximity matching on the token positions recorded for each
+term of a document (see Analyzer.term_positions and parse_query). Both
+work on one document at a time, after intersecting the posting lists of
+the phrase's terms has narrowed the search to documents having all of
+them.
+"""
+
+import heapq
+
+
+def in_order(positions, offsets):
+    """
+    Whether some start position has term i at `offsets`[i] after it for
+    every i, `positions`[i] being the positions of term i. The starts
+    each term allows are intersected, rarest term first.
+    """
+    starts = None
+    for found, offset in sorted(
+            zip(positions, offsets), key=lambda pair: len(pair[0])):
+        allowed = set(p - offset for p in found)
+        starts = allowed if starts is None else starts & allowed
+        if not starts:
+            return False
+    return True
+
+
+def within(positions, width):
+    """
+    Whether a window of `width` consecutive positions holds a position
+    of every list in `positions`. The lists are merged in order, keeping
+    the latest position seen of each, and the window they span is checked
+    at every step.
+    """
+    heap = [(found[0], i, 0) for i, found in enumerate(positions)]
+    heapq.heapify(heap)
+    last = max(position for position, _, _ in heap)
+    while True:
+        first, i, j = heap[0]
+        if last - first < width:
+            return True
+        if j + 1 == len(positions[i]):
+            return False
+        position = positions[i][j + 1]
+        heapq.heapreplace(heap, (position, i, j + 1))
+        last = max(last, position)
+
+
+def matches(phrase, positions):
+    """
+    Whether a document matches `phrase`, a phrase of
+    Analyzer.parse_query, given the decoded positions of its terms.
+    """
+    terms, slop = phrase
+    if not slop:
+        return in_order(
+            [positions[term] for term, _ in terms],
+            [offset for _, offset in terms])
+    unique = sorted(set(term for term, _ in terms))
+    return within(
+        [positions[term] for term in unique], terms[-1][1] + 1 + slop)
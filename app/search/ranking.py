@@ -0,0 +1,54 @@
+import heapq
+import math
+
+
+class TfIdf(object):
+    """Raw term frequency times log(N / (1 + df))."""
+    name = 'tfidf'
+
+    def idf(self, num_docs, df):
+        if not num_docs:
+            return 0.0
+        return math.log(num_docs / (1 + df))
+
+    def term_score(self, tf, idf, length, avg_length):
+        return tf * idf
+
+
+class BM25(object):
+    """Okapi BM25, which dampens tf and normalizes for document length."""
+    name = 'bm25'
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+    def idf(self, num_docs, df):
+        return math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+
+    def term_score(self, tf, idf, length, avg_length):
+        norm = 1 - self.b
+        if avg_length:
+            norm += self.b * length / avg_length
+        return idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+
+
+def make_ranker(config):
+    """Build the ranker named by SEARCH_RANKING."""
+    name = config.get('SEARCH_RANKING', TfIdf.name)
+    if name == BM25.name:
+        return BM25(
+            k1=config.get('BM25_K1', 1.2), b=config.get('BM25_B', 0.75)
+        )
+    if name == TfIdf.name:
+        return TfIdf()
+    raise ValueError('Unknown SEARCH_RANKING {}'.format(name))
+
+
+def top_k(doc_ids, scores, k):
+    """
+    The `k` best scoring of `doc_ids`, best first. Uses a bounded heap, so
+    ranking a broad query costs O(n log k) rather than a full sort. Ties
+    keep the order of `doc_ids`.
+    """
+    return heapq.nlargest(k, doc_ids, key=lambda x: scores.get(x, 0))
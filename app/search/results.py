@@ -0,0 +1,70 @@
+from .. import db
+
+# The results table shows the first SNIPPET_WORDS words of a description;
+# SNIPPET_CHARS is enough text to find them without loading the whole thing.
+SNIPPET_WORDS = 25
+SNIPPET_CHARS = 400
+
+
+class DocumentSummary(object):
+    """The fields of a Document shown in a search results table."""
+    __slots__ = (
+        'id', 'title', 'doc_type', 'day', 'month', 'year',
+        'author_first_name', 'author_last_name', 'editor_first_name',
+        'editor_last_name', 'publisher', 'studio', 'govt_body',
+        'description', 'tags'
+    )
+
+    def __init__(self, row):
+        for name in self.__slots__:
+            if name not in ('description', 'tags'):
+                setattr(self, name, getattr(row, name))
+        self.description = snippet(row.snippet, row.description_length)
+        self.tags = []
+
+
+def snippet(text, length):
+    """
+    The first SNIPPET_WORDS words of a description `length` characters
+    long, given its first SNIPPET_CHARS characters `text`.
+    """
+    if not text:
+        return ''
+    words = text.split(' ')
+    if len(words) > SNIPPET_WORDS:
+        return ' '.join(words[:SNIPPET_WORDS]) + '...'
+    if length > SNIPPET_CHARS:
+        # The last word may have been cut off
+        return ' '.join(words[:-1]) + '...'
+    return text
+
+
+def load_summaries(ids):
+    """
+    DocumentSummary rows for `ids`, in the same order, from one column
+    limited query plus one query for all of their tags. Never loads
+    Document.tf or a full description.
+    """
+    from app.models import Document, Tag, Tagged
+
+    if not ids:
+        return []
+    columns = [
+        getattr(Document, name) for name in DocumentSummary.__slots__
+        if name not in ('description', 'tags')
+    ]
+    rows = db.session.query(
+        *columns +
+        [db.func.substr(Document.description, 1, SNIPPET_CHARS)
+            .label('snippet'),
+         db.func.length(Document.description).label('description_length')]
+    ).filter(Document.id.in_(ids))
+    summaries = dict((row.id, DocumentSummary(row)) for row in rows)
+
+    tags = db.session.query(Tagged.document_id, Tag.tag).join(
+        Tag, Tag.id == Tagged.tag_id
+    ).filter(Tagged.document_id.in_(ids)).order_by(Tag.tag)
+    for doc_id, tag in tags:
+        summaries[doc_id].tags.append(tag)
+
+    return [summaries[i] for i in ids if i in summaries]
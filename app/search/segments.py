@@ -0,0 +1,172 @@
+"""
+Append-only layout of the in-memory index. The base posting lists, built
+at load time or mapped from a snapshot, are never edited in place: saving
+a document appends its postings to a small Segment along with a tombstone
+that hides its older postings, and deleting a document only writes the
+tombstone. A merge later folds the segments into the base lists of the
+terms they touch, so a save costs the same whether its terms occur in ten
+documents or in all of them.
+"""
+
+import heapq
+
+from .codec import Postings
+
+
+class Segment(object):
+    """
+    Postings of the documents written since the segment was started, and a
+    tombstone for every document written or deleted in it. A tombstone
+    hides the document's postings in the base and in older segments, not
+    in this one. `size` counts postings and tombstones.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.doc_terms = {}
+        self.tombstones = set()
+        self.size = 0
+
+    def __bool__(self):
+        return bool(self.tombstones)
+
+    def write(self, doc_id, tf):
+        """Replace whatever this segment holds for `doc_id` with `tf`."""
+        self.delete(doc_id)
+        terms = []
+        for term, count in tf.items():
+            if not count:
+                continue
+            entry = self.postings.get(term)
+            if entry is None:
+                entry = self.postings[term] = Postings()
+            entry.add(doc_id, count)
+            terms.append(term)
+        self.doc_terms[doc_id] = tuple(terms)
+        self.size += len(terms)
+
+    def delete(self, doc_id):
+        if doc_id not in self.tombstones:
+            self.tombstones.add(doc_id)
+            self.size += 1
+        for term in self.doc_terms.pop(doc_id, ()):
+            entry = self.postings[term]
+            entry.remove(doc_id)
+            self.size -= 1
+            if not len(entry):
+                del self.postings[term]
+
+
+def _visible(postings, hidden):
+    for item in postings.items():
+        if item[0] not in hidden:
+            yield item
+
+
+class TermView(object):
+    """
+    The live postings of one term spread over several layers, read like a
+    BlockPostings. `layers` holds (postings, hidden) pairs, `hidden` being
+    the doc ids tombstoned by newer layers. `count` is an upper bound, as
+    hidden postings are included.
+    """
+    __slots__ = ('layers', 'count', 'max_tf')
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.count = sum(len(postings) for postings, _ in layers)
+        self.max_tf = max(postings.max_tf for postings, _ in layers)
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        """(doc_id, tf) pairs in doc id order."""
+        return heapq.merge(*(
+            _visible(postings, hidden) for postings, hidden in self.layers))
+
+    def doc_ids(self):
+        for doc_id, _ in self.items():
+            yield doc_id
+
+    def cursor(self):
+        return MergedCursor(self)
+
+
+class MergedCursor(object):
+    """A codec.Cursor over the visible postings of a TermView."""
+    __slots__ = ('postings', 'cursors', 'current', 'doc_id')
+
+    def __init__(self, view):
+        self.postings = view
+        self.cursors = [
+            (postings.cursor(), hidden) for postings, hidden in view.layers]
+        self._settle()
+
+    def _settle(self):
+        self.current = None
+        self.doc_id = None
+        for cursor, hidden in self.cursors:
+            while cursor.doc_id is not None and cursor.doc_id in hidden:
+                cursor.next()
+            if cursor.doc_id is not None and (
+                    self.doc_id is None or cursor.doc_id < self.doc_id):
+                self.current = cursor
+                self.doc_id = cursor.doc_id
+
+    @property
+    def tf(self):
+        return self.current.tf
+
+    def next(self):
+        self.current.next()
+        self._settle()
+
+    def seek(self, target):
+        """Move to the first visible doc id >= `target`."""
+        if self.doc_id is None or self.doc_id >= target:
+            return
+        for cursor, _ in self.cursors:
+            cursor.seek(target)
+        self._settle()
+
+
+def merge_segments(base, doc_terms, segments):
+    """
+    Work out what applying `segments`, oldest first, does to the `base`
+    posting lists and the `doc_terms` they were built from. Returns
+    ({term: Postings}, {doc_id: terms}) with None for entries that go
+    away. Only the lists of terms that gain or lose a posting are rebuilt.
+    """
+    written = {}
+    newer = []
+    hidden = set()
+    for segment in reversed(segments):
+        newer.append(frozenset(hidden))
+        hidden.update(segment.tombstones)
+    newer.reverse()
+    for segment in segments:
+        for doc_id in segment.tombstones:
+            written[doc_id] = segment.doc_terms.get(doc_id)
+
+    touched = set()
+    for doc_id in written:
+        touched.update(doc_terms.get(doc_id, ()))
+    for segment in segments:
+        touched.update(segment.postings)
+
+    merged = {}
+    for term in touched:
+        items = []
+        entry = base.get(term)
+        if entry is not None:
+            items.extend(_visible(entry, hidden))
+        for segment, hide in zip(segments, newer):
+            entry = segment.postings.get(term)
+            if entry is not None:
+                items.extend(_visible(entry, hide))
+        items.sort()
+        merged[term] = Postings(
+            [doc_id for doc_id, _ in items],
+            [tf for _, tf in items]) if items else None
+    return merged, written
@@ -0,0 +1,437 @@
+"""
+Immutable on-disk copy of the search index, read through mmap so every
+worker on a machine shares one page-cache copy. `manage.py
+write_index_snapshot` writes it; InvertedIndex opens it and keeps its own
+edits in small overlays on top.
+
+The file is a header, a table of section offsets and the sections, all in
+native byte order (it is only meant to be read on the machine that wrote
+it). Terms and doc ids are sorted and found by bisection; posting lists
+are stored in the blocks of app.search.codec. Term positions are stored
+per document, in the order of the document's terms, and the word shown
+for each term in the order of the terms.
+"""
+
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping, MutableMapping
+
+from .codec import BlockPostings
+
+MAGIC = b'SRCHIDX3'
+HEADER = struct.Struct('=8sqqdqqq')
+
+# (name, typecode) of every section, in file order
+SECTIONS = (
+    ('doc_ids', 'q'),
+    ('doc_length', 'q'),
+    ('doc_published', 'B'),
+    ('doc_term_starts', 'q'),
+    ('doc_term_ordinals', 'I'),
+    ('doc_position_starts', 'q'),
+    ('position_data', 'B'),
+    ('term_starts', 'q'),
+    ('term_text', 'B'),
+    ('term_word_starts', 'q'),
+    ('term_word_text', 'B'),
+    ('term_df', 'q'),
+    ('term_max_tf', 'q'),
+    ('term_count', 'q'),
+    ('term_block_starts', 'q'),
+    ('block_firsts', 'q'),
+    ('block_starts', 'q'),
+    ('block_data', 'B'),
+)
+TABLE = struct.Struct('=' + 'qq' * len(SECTIONS))
+
+
+def write_snapshot(index, path, version, generation, created):
+    """
+    Write the contents of InvertedIndex `index` to `path`. The file is
+    written next to it and renamed into place, so workers that have the
+    old snapshot mapped keep a consistent view. Pending segments are
+    merged first.
+    """
+    index.merge()
+    terms = sorted(index.base)
+    ordinals = dict((term, i) for i, term in enumerate(terms))
+    doc_ids = sorted(index.doc_lengths)
+
+    sections = dict((name, array(code)) for name, code in SECTIONS)
+    sections['doc_ids'].extend(doc_ids)
+    text = bytearray()
+    positions = bytearray()
+    published_length = 0
+    doc_terms = sections['doc_term_ordinals']
+    for doc_id in doc_ids:
+        length = index.doc_lengths[doc_id]
+        published = doc_id in index.published
+        if published:
+            published_length += length
+        sections['doc_length'].append(length)
+        sections['doc_published'].append(int(published))
+        sections['doc_term_starts'].append(len(doc_terms))
+        stored = index.positions.get(doc_id) or {}
+        for ordinal in sorted(
+                ordinals[t] for t in index.doc_terms.get(doc_id, ())):
+            doc_terms.append(ordinal)
+            sections['doc_position_starts'].append(len(positions))
+            positions.extend(stored.get(terms[ordinal], b''))
+    sections['doc_term_starts'].append(len(doc_terms))
+    sections['doc_position_starts'].append(len(positions))
+    sections['position_data'].frombytes(bytes(positions))
+
+    data = bytearray()
+    words = bytearray()
+    for term in terms:
+        entry = index.base[term]
+        sections['term_starts'].append(len(text))
+        text.extend(term.encode('utf-8'))
+        sections['term_word_starts'].append(len(words))
+        words.extend((index.words.get(term) or '').encode('utf-8'))
+        sections['term_df'].append(index.df(term))
+        sections['term_max_tf'].append(entry.max_tf)
+        sections['term_count'].append(len(entry))
+        sections['term_block_starts'].append(len(sections['block_firsts']))
+        for first, block in zip(entry.firsts, entry.blocks):
+            sections['block_firsts'].append(first)
+            sections['block_starts'].append(len(data))
+            data.extend(block)
+    sections['term_starts'].append(len(text))
+    sections['term_word_starts'].append(len(words))
+    sections['term_block_starts'].append(len(sections['block_firsts']))
+    sections['block_starts'].append(len(data))
+    sections['term_text'].frombytes(bytes(text))
+    sections['term_word_text'].frombytes(bytes(words))
+    sections['block_data'].frombytes(bytes(data))
+
+    offset = HEADER.size + TABLE.size
+    table = []
+    for name, _ in SECTIONS:
+        offset += -offset % 8
+        size = len(sections[name]) * sections[name].itemsize
+        table.extend((offset, size))
+        offset += size
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(
+            MAGIC, version, generation, created, len(doc_ids),
+            len(index.published), published_length))
+        f.write(TABLE.pack(*table))
+        for (name, _), start in zip(SECTIONS, table[::2]):
+            f.write(b'\0' * (start - f.tell()))
+            sections[name].tofile(f)
+    os.replace(tmp, path)
+
+
+class Snapshot(object):
+    """A snapshot file mapped into memory."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Identifies the file, so a replaced snapshot gets mapped again
+        self.stat = (stat.st_ino, stat.st_mtime)
+        view = memoryview(self._mmap)
+        (magic, self.version, self.generation, self.created, self.num_docs,
+         self.num_published, self.published_length) = HEADER.unpack_from(
+            view)
+        if magic != MAGIC:
+            raise ValueError('{} is not a search index snapshot'.format(path))
+        table = TABLE.unpack_from(view, HEADER.size)
+        for (name, code), start, size in zip(
+                SECTIONS, table[::2], table[1::2]):
+            if start + size > len(view):
+                raise ValueError('{} is truncated'.format(path))
+            setattr(self, name, view[start:start + size].cast(code))
+
+        self.terms = Terms(self)
+        self.postings = SnapshotPostingsMap(self)
+        self.published_df = DocumentFrequencies(self)
+        self.words = TermWords(self)
+        self.doc_lengths = DocumentLengths(self)
+        self.doc_terms = DocumentTerms(self)
+        self.positions = DocumentPositions(self)
+        self.published = PublishedDocuments(self)
+
+    def term_index(self, term):
+        i = bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return None
+
+    def doc_index(self, doc_id):
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < len(self.doc_ids) and self.doc_ids[i] == doc_id:
+            return i
+        return None
+
+
+class Terms(object):
+    """Sorted sequence of the snapshot's terms."""
+
+    def __init__(self, snapshot):
+        self.starts = snapshot.term_starts
+        self.text = snapshot.term_text
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.text[self.starts[i]:self.starts[i + 1]].tobytes().decode(
+            'utf-8')
+
+
+class SnapshotPostings(BlockPostings):
+    """Read-only posting list of one snapshot term."""
+    __slots__ = ('firsts', 'blocks', 'count', 'max_tf')
+
+    def __init__(self, snapshot, i):
+        start = snapshot.term_block_starts[i]
+        end = snapshot.term_block_starts[i + 1]
+        self.firsts = snapshot.block_firsts[start:end]
+        self.blocks = Blocks(snapshot, start, end)
+        self.count = snapshot.term_count[i]
+        self.max_tf = snapshot.term_max_tf[i]
+
+
+class Blocks(object):
+    """The encoded blocks of one posting list, as memoryview slices."""
+    __slots__ = ('starts', 'data', 'start', 'end')
+
+    def __init__(self, snapshot, start, end):
+        self.starts = snapshot.block_starts
+        self.data = snapshot.block_data
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, b):
+        if not 0 <= b < len(self):
+            raise IndexError(b)
+        b += self.start
+        return self.data[self.starts[b]:self.starts[b + 1]]
+
+
+class SnapshotPostingsMap(Mapping):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, term):
+        i = self.snapshot.term_index(term)
+        if i is None:
+            raise KeyError(term)
+        return SnapshotPostings(self.snapshot, i)
+
+    def __iter__(self):
+        return iter(self.snapshot.terms)
+
+    def __len__(self):
+        return len(self.snapshot.terms)
+
+
+class DocumentFrequencies(SnapshotPostingsMap):
+    def __getitem__(self, term):
+        i = self.snapshot.term_index(term)
+        if i is None:
+            raise KeyError(term)
+        return self.snapshot.term_df[i]
+
+    def items(self):
+        """(term, df) pairs in term order, without a lookup per term."""
+        return zip(self.snapshot.terms, self.snapshot.term_df)
+
+
+class TermWords(SnapshotPostingsMap):
+    """The word shown for each snapshot term that has one."""
+
+    def __getitem__(self, term):
+        snapshot = self.snapshot
+        i = snapshot.term_index(term)
+        if i is None:
+            raise KeyError(term)
+        start = snapshot.term_word_starts[i]
+        end = snapshot.term_word_starts[i + 1]
+        if start == end:
+            raise KeyError(term)
+        return snapshot.term_word_text[start:end].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for term in self.snapshot.terms:
+            if term in self:
+                yield term
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class DocumentLengths(Mapping):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, doc_id):
+        i = self.snapshot.doc_index(doc_id)
+        if i is None:
+            raise KeyError(doc_id)
+        return self.snapshot.doc_length[i]
+
+    def __iter__(self):
+        return iter(self.snapshot.doc_ids)
+
+    def __len__(self):
+        return len(self.snapshot.doc_ids)
+
+
+class DocumentTerms(DocumentLengths):
+    def __getitem__(self, doc_id):
+        snapshot = self.snapshot
+        i = snapshot.doc_index(doc_id)
+        if i is None:
+            raise KeyError(doc_id)
+        ordinals = snapshot.doc_term_ordinals[
+            snapshot.doc_term_starts[i]:snapshot.doc_term_starts[i + 1]]
+        return tuple(snapshot.terms[o] for o in ordinals)
+
+
+class DocumentPositions(DocumentLengths):
+    def __getitem__(self, doc_id):
+        i = self.snapshot.doc_index(doc_id)
+        if i is None:
+            raise KeyError(doc_id)
+        return TermPositions(self.snapshot, i)
+
+
+class TermPositions(object):
+    """The encoded term positions of one snapshot document, by term."""
+    __slots__ = ('snapshot', 'start', 'end')
+
+    def __init__(self, snapshot, i):
+        self.snapshot = snapshot
+        self.start = snapshot.doc_term_starts[i]
+        self.end = snapshot.doc_term_starts[i + 1]
+
+    def get(self, term, default=None):
+        snapshot = self.snapshot
+        ordinal = snapshot.term_index(term)
+        if ordinal is None:
+            return default
+        j = bisect_left(
+            snapshot.doc_term_ordinals, ordinal, self.start, self.end)
+        if j == self.end or snapshot.doc_term_ordinals[j] != ordinal:
+            return default
+        start = snapshot.doc_position_starts[j]
+        end = snapshot.doc_position_starts[j + 1]
+        return snapshot.position_data[start:end] if end > start else default
+
+
+class PublishedDocuments(object):
+    """Set of the snapshot's published doc ids."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __contains__(self, doc_id):
+        i = self.snapshot.doc_index(doc_id)
+        return i is not None and bool(self.snapshot.doc_published[i])
+
+    def __iter__(self):
+        for doc_id, published in zip(
+                self.snapshot.doc_ids, self.snapshot.doc_published):
+            if published:
+                yield doc_id
+
+    def __len__(self):
+        return self.snapshot.num_published
+
+
+class Overlay(MutableMapping):
+    """
+    Changes on top of a read-only mapping: writes and deletes are kept in
+    memory and `base` is never modified.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.changes = {}
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            return self.changes[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.changes.pop(key, None)
+        if key in self.base:
+            self.deleted.add(key)
+
+    def __iter__(self):
+        for key in self.changes:
+            yield key
+        for key in self.base:
+            if key not in self.changes and key not in self.deleted:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def items(self):
+        """(key, value) pairs, read from the base in one pass."""
+        for item in self.changes.items():
+            yield item
+        for key, value in self.base.items():
+            if key not in self.changes and key not in self.deleted:
+                yield key, value
+
+
+class OverlaySet(object):
+    """Additions and removals on top of a read-only set."""
+
+    def __init__(self, base):
+        self.base = base
+        self.added = set()
+        self.removed = set()
+
+    def __contains__(self, key):
+        if key in self.added:
+            return True
+        return key not in self.removed and key in self.base
+
+    def add(self, key):
+        if key in self.base:
+            self.removed.discard(key)
+        else:
+            self.added.add(key)
+
+    def discard(self, key):
+        if key in self.base:
+            self.removed.add(key)
+        else:
+            self.added.discard(key)
+
+    def __iter__(self):
+        for key in self.added:
+            yield key
+        for key in self.base:
+            if key not in self.removed:
+                yield key
+
+    def __len__(self):
+        return len(self.base) + len(self.added) - len(self.removed)
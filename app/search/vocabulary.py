@@ -0,0 +1,130 @@
+"""
+The terms of the search index, sorted, for lookups that work on the
+vocabulary rather than on postings: prefix completion, and approximate
+matching of misspelled query terms through a trigram index.
+"""
+
+import heapq
+from bisect import bisect_left
+from collections import Counter
+
+# Prefixes matching more terms than this have their completions memoized
+MEMO_RANGE = 1000
+# Shorter terms are not matched approximately; one edit changes too much
+MIN_FUZZY_LENGTH = 4
+# Terms this long may be two edits away from their match, others one
+LONG_TERM = 8
+
+
+def trigrams(term):
+    """
+    The distinct three letter substrings of `term` padded with spaces, so
+    that its first and last letters are in as many trigrams as the rest.
+    """
+    padded = '  {} '.format(term)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance of `a` and `b`, or `limit` + 1 past `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        current = [i]
+        for j, y in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1, current[j - 1] + 1,
+                previous[j - 1] + (x != y)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+class Vocabulary(object):
+    """
+    Index terms in sorted order with their published document frequency.
+    Terms only found in unpublished documents are left out.
+    """
+
+    def __init__(self, dfs):
+        items = sorted((term, df) for term, df in dfs if df > 0)
+        self.terms = [term for term, _ in items]
+        self.dfs = [df for _, df in items]
+        self._memo = {}
+        self._trigrams = None
+
+    def __len__(self):
+        return len(self.terms)
+
+    def prefix_range(self, prefix):
+        """(start, end) of the terms beginning with `prefix`."""
+        start = bisect_left(self.terms, prefix)
+        end = bisect_left(
+            self.terms, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        return start, end
+
+    def complete(self, prefix, limit=10):
+        """
+        Up to `limit` (term, df) pairs of terms beginning with `prefix`,
+        the most frequent first and alphabetically among equals.
+        """
+        if not prefix or limit <= 0:
+            return []
+        key = (prefix, limit)
+        if key in self._memo:
+            return self._memo[key]
+        start, end = self.prefix_range(prefix)
+        best = heapq.nlargest(
+            limit, range(start, end), key=self.dfs.__getitem__)
+        completions = [(self.terms[i], self.dfs[i]) for i in best]
+        if end - start > MEMO_RANGE:
+            self._memo[key] = completions
+        return completions
+
+    @property
+    def trigram_index(self):
+        """
+        Trigram -> positions of the terms containing it, built the first
+        time a term is matched approximately.
+        """
+        if self._trigrams is None:
+            index = {}
+            for i, term in enumerate(self.terms):
+                for gram in trigrams(term):
+                    index.setdefault(gram, []).append(i)
+            self._trigrams = index
+        return self._trigrams
+
+    def similar(self, term, limit=3):
+        """
+        Up to `limit` (term, df) pairs of the terms nearest to `term` by
+        edit distance, the most frequent first. Terms of four to seven
+        letters match within one edit, longer ones within two.
+
+        Each edit changes at most three trigrams, so only terms sharing
+        enough trigrams with `term` are compared letter by letter.
+        """
+        if len(term) < MIN_FUZZY_LENGTH or limit <= 0:
+            return []
+        max_distance = 2 if len(term) >= LONG_TERM else 1
+        grams = trigrams(term)
+        index = self.trigram_index
+        shared = Counter()
+        for gram in grams:
+            shared.update(index.get(gram, ()))
+        needed = max(1, len(grams) - 3 * max_distance)
+
+        matches = []
+        for i, n in shared.items():
+            if n < needed:
+                continue
+            distance = edit_distance(term, self.terms[i], max_distance)
+            if 0 < distance <= max_distance:
+                matches.append((distance, -self.dfs[i], self.terms[i]))
+        if not matches:
+            return []
+        nearest = min(matches)[0]
+        matches = sorted(m for m in matches if m[0] == nearest)
+        return [(match, -df) for _, df, match in matches[:limit]]
@@ -64,6 +64,31 @@ class Config:
 
     RAYGUN_APIKEY = os.environ.get('RAYGUN_APIKEY')
 
+    # Search ranking: 'tfidf' or 'bm25'
+    SEARCH_RANKING = os.environ.get('SEARCH_RANKING') or 'tfidf'
+    BM25_K1 = float(os.environ.get('BM25_K1') or 1.2)
+    BM25_B = float(os.environ.get('BM25_B') or 0.75)
+
+    # Text analysis: 'regex' or 'nltk' tokenizer
+    SEARCH_TOKENIZER = os.environ.get('SEARCH_TOKENIZER') or 'regex'
+    SEARCH_STEM_CACHE_SIZE = int(
+        os.environ.get('SEARCH_STEM_CACHE_SIZE') or 50000)
+
+    # Index snapshot mapped by every worker; written by
+    # `manage.py write_index_snapshot`. Unset to load from the database.
+    SEARCH_SNAPSHOT_PATH = os.environ.get('SEARCH_SNAPSHOT_PATH')
+
+    # Postings and tombstones a worker's index takes in before its write
+    # segment is merged into the main posting lists in the background
+    SEARCH_MERGE_SIZE = int(os.environ.get('SEARCH_MERGE_SIZE') or 5000)
+
+    # Rank with sparse matrix products (needs numpy and scipy installed)
+    SEARCH_VECTORIZED = bool(os.environ.get('SEARCH_VECTORIZED'))
+
+    # Search result cache (per worker)
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 256)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 300)
+
     # Parse the REDIS_URL to set RQ config variables
     if PYTHON_VERSION == 3:
         urllib.parse.uses_netloc.append('redis')
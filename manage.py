@@ -8,7 +8,10 @@ from redis import Redis
 from rq import Connection, Queue, Worker
 
 from app import create_app, db
-from app.models import Role, User, Document, Tag, Suggestion, Saved, Tagged
+from app.models import (
+    Role, User, Document, Tag, Suggestion, Saved, Tagged, CorpusStats, Posting
+)
+from app.search import analyzer
 from config import Config
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
@@ -61,6 +64,371 @@ def add_fake_data(number_users):
     Tagged.generate_fake()
 
 
+@manager.command
+def recompute_corpus_stats():
+    """Rebuilds the published search statistics from the documents."""
+    CorpusStats.recompute()
+    CorpusStats.bump()
+    db.session.commit()
+    stats = CorpusStats.get()
+    print('{} published documents, average length {:.1f}'.format(
+        stats.doc_count, stats.avg_length))
+
+
+@manager.command
+def add_document_lengths():
+    """
+    Adds the document.length column to databases created before documents
+    stored their indexed length. Lengths are filled in by the next reindex,
+    which also recomputes the corpus statistics; until then BM25 treats
+    every document as empty.
+    """
+    columns = [
+        c['name'] for c in db.inspect(db.engine).get_columns('document')
+    ]
+    if 'length' in columns:
+        print('document.length already exists')
+        return
+    column_type = Document.__table__.c.length.type.compile(
+        dialect=db.engine.dialect)
+    with db.engine.begin() as conn:
+        conn.execute('ALTER TABLE document ADD COLUMN length {}'.format(
+            column_type))
+    print('Added document.length; run reindex to fill it in')
+
+
+@manager.command
+def update_publication_keys():
+    """
+    Fills Document.publication_key for documents saved before it existed,
+    first adding the column and its index to databases created before it
+    was declared.
+    """
+    from app.models.document import publication_key
+
+    columns = [
+        c['name'] for c in db.inspect(db.engine).get_columns('document')
+    ]
+    if 'publication_key' not in columns:
+        column_type = Document.__table__.c.publication_key.type.compile(
+            dialect=db.engine.dialect)
+        with db.engine.begin() as conn:
+            conn.execute(
+                'ALTER TABLE document ADD COLUMN publication_key {}'.format(
+                    column_type))
+        print('Added document.publication_key')
+    existing = set(
+        index['name']
+        for index in db.inspect(db.engine).get_indexes('document'))
+    for index in Document.__table__.indexes:
+        if 'publication_key' in index.columns and \
+                index.name not in existing:
+            index.create(bind=db.engine)
+            print('Created {}'.format(index.name))
+
+    documents = Document.query.options(db.noload('tags')).yield_per(500)
+    for document in documents:
+        document.publication_key = publication_key(
+            document.year, document.month, document.day)
+    db.session.commit()
+
+
+@manager.command
+def convert_document_dates():
+    """
+    Converts document.posted_date and last_edited_date from the old string
+    columns to timestamps and indexes them. Run once on databases created
+    before they became DateTime columns.
+    """
+    from sqlalchemy import text
+    from app.models.document import parse_legacy_date
+
+    columns = dict(
+        (c['name'], c['type'])
+        for c in db.inspect(db.engine).get_columns('document')
+    )
+    with db.engine.begin() as conn:
+        for column in ('posted_date', 'last_edited_date'):
+            if not isinstance(columns[column], db.String):
+                print('{} is already a timestamp'.format(column))
+                continue
+            values = []
+            unparsed = 0
+            query = 'SELECT id, {} FROM document'.format(column)
+            for doc_id, value in conn.execute(query).fetchall():
+                parsed = parse_legacy_date(value)
+                if value and parsed is None:
+                    unparsed += 1
+                values.append(dict(id=doc_id, value=parsed))
+            conn.execute('ALTER TABLE document ADD COLUMN {}_new TIMESTAMP'
+                         .format(column))
+            if values:
+                conn.execute(
+                    text('UPDATE document SET {}_new = :value WHERE id = :id'
+                         .format(column)), values)
+            conn.execute('ALTER TABLE document DROP COLUMN {}'.format(column))
+            conn.execute('ALTER TABLE document RENAME COLUMN {0}_new TO {0}'
+                         .format(column))
+            print('Converted {} rows of {} ({} unparseable)'.format(
+                len(values), column, unparsed))
+            if column == 'last_edited_date':
+                for index in Document.__table__.indexes:
+                    if 'last_edited_date' in index.columns:
+                        index.create(bind=conn)
+
+
+@manager.command
+def create_tagged_index():
+    """
+    Adds the tagged (document_id, tag_id) index to databases created before
+    it was declared.
+    """
+    existing = set(
+        index['name'] for index in db.inspect(db.engine).get_indexes('tagged'))
+    for index in Tagged.__table__.indexes:
+        if index.name in existing:
+            print('{} already exists'.format(index.name))
+        else:
+            index.create(bind=db.engine)
+            print('Created {}'.format(index.name))
+
+
+@manager.command
+def add_posting_positions():
+    """
+    Adds the posting.positions column to databases created before term
+    positions were recorded. Existing postings get their positions from
+    the next reindex (or check_index --repair); until then phrase
+    searches match their documents on the terms alone.
+    """
+    columns = [
+        c['name'] for c in db.inspect(db.engine).get_columns('posting')
+    ]
+    if 'positions' in columns:
+        print('posting.positions already exists')
+        return
+    column_type = Posting.__table__.c.positions.type.compile(
+        dialect=db.engine.dialect)
+    with db.engine.begin() as conn:
+        conn.execute('ALTER TABLE posting ADD COLUMN positions {}'.format(
+            column_type))
+    print('Added posting.positions; run reindex to fill it in')
+
+
+@manager.command
+def add_term_words():
+    """
+    Adds the idf.word column to databases created before terms kept a word
+    to show instead of the stem. Existing terms get theirs from the next
+    reindex, or when a document containing them is saved; until then
+    suggestions show the stem.
+    """
+    from app.models import Idf
+
+    columns = [c['name'] for c in db.inspect(db.engine).get_columns('idf')]
+    if 'word' in columns:
+        print('idf.word already exists')
+        return
+    column_type = Idf.__table__.c.word.type.compile(dialect=db.engine.dialect)
+    with db.engine.begin() as conn:
+        conn.execute('ALTER TABLE idf ADD COLUMN word {}'.format(column_type))
+    print('Added idf.word; run reindex to fill it in')
+
+
+@manager.command
+def migrate_postings():
+    """
+    Moves the search index from the old idf.docs arrays and pickled
+    document.tf column into the posting table. Run once on databases
+    created before the posting table existed.
+    """
+    import pickle
+
+    columns = [
+        c['name'] for c in db.inspect(db.engine).get_columns('document')
+    ]
+    if 'tf' not in columns:
+        print('document.tf does not exist, nothing to migrate')
+        return
+
+    doc_tfs = []
+    for doc_id, tf in db.engine.execute('SELECT id, tf FROM document'):
+        doc_tfs.append((doc_id, dict(pickle.loads(tf)) if tf else {}))
+    with db.engine.begin() as conn:
+        conn.execute('DROP TABLE idf')
+        conn.execute('ALTER TABLE document DROP COLUMN tf')
+    db.create_all()
+
+    num_terms = Posting.rebuild(doc_tfs, CorpusStats.generation())
+    db.session.bulk_update_mappings(Document, [
+        dict(id=doc_id, length=sum(tf.values())) for doc_id, tf in doc_tfs
+    ])
+    CorpusStats.recompute()
+    CorpusStats.bump()
+    db.session.commit()
+    print('Migrated {} documents, {} terms'.format(len(doc_tfs), num_terms))
+
+
+@manager.option(
+    '-w',
+    '--workers',
+    default=None,
+    type=int,
+    help='Number of analyzer processes (defaults to the CPU count)',
+    dest='workers')
+@manager.option(
+    '-b',
+    '--batch-size',
+    default=500,
+    type=int,
+    help='Documents per batch',
+    dest='batch_size')
+def reindex(workers, batch_size):
+    """
+    Rebuilds the search index as a new generation while searches keep
+    using the current one: streams every document, analyzes the corpora
+    across a process pool, bulk-writes postings and then switches over.
+    """
+    import time
+    from collections import deque
+    from multiprocessing import Pool, cpu_count
+    from app.search.analysis import analyze_batch
+    from app.search.generations import activate_generation, begin_generation
+
+    workers = workers or cpu_count()
+    total = db.session.query(db.func.count(Document.id)).scalar()
+    indexed = 0
+    started = time.time()
+
+    def batches():
+        documents = Document.query.options(db.noload('tags')).order_by(
+            Document.id).yield_per(batch_size)
+        batch = []
+        for document in documents:
+            batch.append((document.id, document.corpus))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def analyzed(pool):
+        # Batches are read here and handed to the pool, keeping a couple
+        # per worker in flight so the database and the workers overlap.
+        pending = deque()
+
+        def finish():
+            nonlocal indexed
+            results, words = pending.popleft().get()
+            # Posting.rebuild reads the words of new terms from analyzer
+            analyzer.remember(words)
+            for doc_id, length, tf, positions in results:
+                indexed += 1
+                yield doc_id, tf, positions
+            elapsed = time.time() - started
+            print('Indexed {}/{} documents ({:.0f} docs/s)'.format(
+                indexed, total, indexed / max(elapsed, 1e-6)))
+
+        for batch in batches():
+            pending.append(pool.apply_async(analyze_batch, (batch,)))
+            if len(pending) > 2 * workers:
+                yield from finish()
+        while pending:
+            yield from finish()
+
+    generation = begin_generation(app.config.get('SEARCH_TOKENIZER'))
+    print('Building index generation {}'.format(generation.id))
+    pool = Pool(workers)
+    try:
+        num_terms = Posting.rebuild(analyzed(pool), generation.id)
+        db.session.commit()
+    except BaseException:
+        # Stop the workers rather than wait for their queued batches
+        pool.terminate()
+        pool.join()
+        db.session.rollback()
+        Posting.drop_generation(generation.id)
+        db.session.delete(generation)
+        db.session.commit()
+        raise
+    else:
+        pool.close()
+        pool.join()
+
+    edited = activate_generation(generation, analyzer)
+    elapsed = time.time() - started
+    print('Reindexed {} documents, {} terms in {:.1f}s ({:.0f} docs/s)'.format(
+        indexed, num_terms, elapsed, indexed / max(elapsed, 1e-6)))
+    print('Generation {} is active ({} documents edited during the build). '
+          'Run drop_index_generations to free the old one.'.format(
+              generation.id, edited))
+
+
+@manager.command
+def drop_index_generations():
+    """Deletes index generations that are neither active nor building."""
+    from app.search.generations import drop_generation, inactive_generations
+
+    for generation in inactive_generations():
+        drop_generation(generation)
+        db.session.commit()
+        print('Dropped index generation {}'.format(generation))
+
+
+@manager.command
+def write_index_snapshot():
+    """
+    Writes the search index to SEARCH_SNAPSHOT_PATH, which web workers map
+    into memory instead of each loading their own copy.
+    """
+    import time
+    from app.search.index import InvertedIndex
+    from app.search.snapshot import write_snapshot
+
+    path = app.config.get('SEARCH_SNAPSHOT_PATH')
+    if not path:
+        print('SEARCH_SNAPSHOT_PATH is not set')
+        return
+    # Edits from here on are newer than the snapshot and get re-read
+    # by the workers that open it.
+    created = time.time()
+    version = CorpusStats.current()
+    generation = CorpusStats.generation()
+    index = InvertedIndex()
+    index.load_database()
+    write_snapshot(index, path, version, generation, created)
+    print('Wrote {} documents, {} terms to {} ({:.1f} MB)'.format(
+        len(index.doc_lengths), len(index.base), path,
+        os.path.getsize(path) / 2 ** 20))
+
+
+@manager.option(
+    '-r',
+    '--repair',
+    action='store_true',
+    help='Fix the problems found',
+    dest='repair')
+@manager.option(
+    '-b',
+    '--batch-size',
+    default=500,
+    type=int,
+    help='Documents per batch',
+    dest='batch_size')
+def check_index(repair, batch_size):
+    """Checks the search index against the documents, optionally fixing it."""
+    from app.search.consistency import check_index
+
+    report = check_index(analyzer, batch_size=batch_size, repair=repair)
+    if report.ok:
+        print('The search index is consistent')
+        return
+    for line in report.lines():
+        print(line)
+    if repair:
+        print('Repaired')
+
+
 @manager.command
 def setup_dev():
     """Runs the set-up needed for local development."""
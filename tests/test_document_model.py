@@ -0,0 +1,170 @@
+import datetime
+import io
+import unittest
+from contextlib import redirect_stdout
+
+from sqlalchemy import text
+
+from app import create_app, db
+from app.models import Document
+from app.models.document import parse_legacy_date, publication_key
+
+# posted_date / last_edited_date values as the string columns stored them:
+# strftime('%a %b %d %H:%M:%S %Z %Y') of a naive utcnow(), whose empty %Z
+# left a double space, and str() of datetimes assigned to the column
+LEGACY_DATES = (
+    ('Tue Feb 28 17:03:11  2017', datetime.datetime(2017, 2, 28, 17, 3, 11)),
+    ('Wed Mar 01 09:15:00 2017', datetime.datetime(2017, 3, 1, 9, 15)),
+    ('2017-02-28 17:03:11.482913',
+     datetime.datetime(2017, 2, 28, 17, 3, 11, 482913)),
+    ('2017-03-01 09:15:00', datetime.datetime(2017, 3, 1, 9, 15)),
+)
+
+
+class DocumentModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_publication_key(self):
+        self.assertEqual(publication_key(2019, 'June', 5), 20190605)
+        self.assertEqual(publication_key('2019', 'June', '5'), 20190605)
+        # A missing month or day defaults like Document.raw_date, but an
+        # undated document gets no key rather than a made up year
+        self.assertEqual(publication_key(2019, None, None), 20190101)
+        self.assertEqual(publication_key(2019, 'Jun', 'x'), 20190101)
+        self.assertIsNone(publication_key(None, 'March', 2))
+        self.assertIsNone(publication_key('n.d.', 'June', 5))
+
+    def test_publication_key_is_set_on_save(self):
+        document = Document(doc_type='book', year=2019, month='June', day=5)
+        db.session.add(document)
+        db.session.commit()
+        self.assertEqual(document.publication_key, 20190605)
+
+        document.month = 'December'
+        document.day = None
+        db.session.commit()
+        stored = db.session.query(Document.publication_key).filter_by(
+            id=document.id).scalar()
+        self.assertEqual(stored, 20191201)
+
+    def test_parse_legacy_date(self):
+        for value, parsed in LEGACY_DATES:
+            self.assertEqual(parse_legacy_date(value), parsed)
+        for value in ('', 'yesterday', '02/28/2017', 'Tue Feb 30 17:03:11'):
+            self.assertIsNone(parse_legacy_date(value))
+        self.assertIsNone(parse_legacy_date(None))
+        now = datetime.datetime.utcnow()
+        self.assertIs(parse_legacy_date(now), now)
+
+    def test_convert_document_dates(self):
+        from manage import convert_document_dates
+
+        # The string columns of databases created before the conversion
+        indexed = [
+            index for index in Document.__table__.indexes
+            if 'last_edited_date' in index.columns]
+        with db.engine.begin() as conn:
+            for index in indexed:
+                index.drop(bind=conn)
+            for column in ('posted_date', 'last_edited_date'):
+                conn.execute(
+                    'ALTER TABLE document DROP COLUMN {}'.format(column))
+                conn.execute(
+                    'ALTER TABLE document ADD COLUMN {} VARCHAR'.format(
+                        column))
+            conn.execute(text(
+                'INSERT INTO document (id, title, posted_date, '
+                'last_edited_date) VALUES (:id, :title, :posted, :edited)'
+            ), [
+                dict(id=1, title='a', posted=LEGACY_DATES[0][0],
+                     edited=LEGACY_DATES[2][0]),
+                dict(id=2, title='b', posted=LEGACY_DATES[3][0],
+                     edited='not a date'),
+                dict(id=3, title='c', posted=None, edited=''),
+            ])
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            convert_document_dates()
+        self.assertEqual(output.getvalue().splitlines(), [
+            'Converted 3 rows of posted_date (0 unparseable)',
+            'Converted 3 rows of last_edited_date (1 unparseable)',
+        ])
+        self.assertEqual(
+            db.session.query(
+                Document.id, Document.posted_date, Document.last_edited_date
+            ).order_by(Document.id).all(), [
+                (1, LEGACY_DATES[0][1], LEGACY_DATES[2][1]),
+                (2, LEGACY_DATES[3][1], None),
+                (3, None, None),
+            ])
+        names = set(
+            index['name']
+            for index in db.inspect(db.engine).get_indexes('document'))
+        self.assertTrue(set(index.name for index in indexed) <= names)
+
+    def test_add_document_lengths(self):
+        from manage import add_document_lengths
+
+        db.session.add(Document(doc_type='book', title='Whistleblower'))
+        db.session.commit()
+        with db.engine.begin() as conn:
+            conn.execute('ALTER TABLE document DROP COLUMN length')
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            add_document_lengths()
+            add_document_lengths()
+        self.assertEqual(output.getvalue().splitlines(), [
+            'Added document.length; run reindex to fill it in',
+            'document.length already exists',
+        ])
+        self.assertEqual(
+            db.session.query(Document.title, Document.length).all(),
+            [('Whistleblower', None)])
+
+    def test_update_publication_keys_adds_the_column(self):
+        from manage import update_publication_keys
+
+        indexed = [
+            index for index in Document.__table__.indexes
+            if 'publication_key' in index.columns]
+        with db.engine.begin() as conn:
+            for index in indexed:
+                index.drop(bind=conn)
+            conn.execute('ALTER TABLE document DROP COLUMN publication_key')
+            conn.execute(
+                "INSERT INTO document (id, title, year, month, day) "
+                "VALUES (1, 'a', 2019, 'June', 5)")
+
+        with redirect_stdout(io.StringIO()):
+            update_publication_keys()
+        self.assertEqual(Document.query.get(1).publication_key, 20190605)
+        names = set(
+            index['name']
+            for index in db.inspect(db.engine).get_indexes('document'))
+        self.assertTrue(set(index.name for index in indexed) <= names)
+
+    def test_undated_documents_match_no_date_range(self):
+        dated = Document(doc_type='book', year=1975, month='May', day=1)
+        undated = Document(doc_type='book', title='Undated')
+        db.session.add_all([dated, undated])
+        db.session.commit()
+        self.assertIsNone(undated.publication_key)
+        self.assertEqual(undated.raw_date, (1970, 1, 1))
+
+        in_range = Document.query.filter(
+            Document.is_after(19600101), Document.is_before(19801231))
+        self.assertEqual([d.id for d in in_range], [dated.id])
+        self.assertTrue(dated.is_after(19600101))
+        self.assertFalse(undated.is_after(19600101))
+        self.assertFalse(undated.is_before(19801231))
@@ -0,0 +1,273 @@
+import datetime
+import io
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from app import create_app, db
+from app.models import CorpusStats, Document, Idf, IndexGeneration, Posting
+from app.search import generations, query_cache, search_index
+from app.search.analysis import Analyzer
+from app.search.consistency import check_index
+from app.search.generations import (
+    activate_generation, begin_generation, catch_up, drop_generation,
+    inactive_generations
+)
+from app.search.index import SYNC_SLACK
+
+
+class IndexConsistencyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.analyzer = Analyzer()
+        search_index.loaded = False
+        query_cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        search_index.loaded = False
+        self.app_context.pop()
+
+    def index_documents(self, *titles):
+        """Add published documents indexed in the active generation."""
+        ids = []
+        for title in titles:
+            document = Document(
+                doc_type='book', title=title, document_status='published')
+            db.session.add(document)
+            db.session.flush()
+            # Long enough ago that the switch's catch-ups leave it alone
+            self.edit(
+                document, title,
+                datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+            ids.append(document.id)
+        return ids
+
+    def edit(self, document, title, edited=None):
+        """Change a document's title the way the editor views do."""
+        pre_tf = Posting.document_tf(document.id)
+        status = document.document_status if pre_tf else None
+        document.title = title
+        document.last_edited_date = edited or datetime.datetime.utcnow()
+        length, tf, positions = self.analyzer.term_positions(
+            document.corpus)
+        Posting.update_document(document.id, pre_tf, tf, positions=positions)
+        CorpusStats.document_changed(status, pre_tf, 'published', tf)
+        document.length = length
+        CorpusStats.bump()
+        db.session.commit()
+
+    def build(self, tokenizer='regex'):
+        """Write a new generation of every document, as reindex does."""
+        generation = begin_generation(tokenizer)
+        Posting.rebuild(
+            ((document.id,) + self.analyzer.term_positions(
+                document.corpus)[1:]
+             for document in Document.query.order_by(Document.id)),
+            generation.id)
+        db.session.commit()
+        return generation
+
+    def test_check_and_repair(self):
+        document = Document(
+            doc_type='book', title='Whistleblower laws',
+            document_status='published')
+        db.session.add(document)
+        stale = Idf(term='stale', published_df=0)
+        db.session.add(stale)
+        db.session.add(Idf(term='orphan', published_df=0))
+        db.session.flush()
+        db.session.add(Posting(term_id=stale.id, document_id=999, tf=1))
+        db.session.commit()
+
+        report = check_index(self.analyzer)
+        self.assertEqual(report.counts['missing_postings'], 1)
+        self.assertEqual(report.counts['wrong_length'], 1)
+        self.assertEqual(report.samples['deleted_documents'], [999])
+        self.assertEqual(report.counts['orphan_terms'], 1)
+        self.assertEqual(report.counts['corpus_stats'], 1)
+        self.assertFalse(report.ok)
+
+        check_index(self.analyzer, batch_size=1, repair=True)
+        self.assertTrue(check_index(self.analyzer).ok)
+        self.assertEqual(
+            sorted(Posting.document_tf(document.id)),
+            ['book', 'law', 'whistleblow'])
+
+    def test_generations_being_built_are_not_checked_for_orphans(self):
+        self.index_documents('Whistleblower laws')
+        building = begin_generation()
+        retired = IndexGeneration(status='retired')
+        db.session.add(retired)
+        db.session.flush()
+        # Rebuilds write the terms of a batch before its postings
+        building, retired = building.id, retired.id
+        db.session.add(Idf(
+            term='whistleblow', published_df=0, generation=building))
+        db.session.add(Idf(term='orphan', published_df=0, generation=retired))
+        db.session.commit()
+
+        report = check_index(self.analyzer)
+        self.assertEqual(report.counts['orphan_terms'], 1)
+        check_index(self.analyzer, repair=True)
+        self.assertEqual(
+            [term for term, in db.session.query(Idf.term).filter_by(
+                generation=building)], ['whistleblow'])
+        self.assertEqual(Idf.query.filter_by(generation=retired).count(), 0)
+
+    def test_edits_leave_no_orphan_terms(self):
+        document = Document(doc_type='book', document_status='published')
+        db.session.add(document)
+        db.session.flush()
+        doc_id = document.id
+        status = None
+        for title in (
+                'Whistleblower laws', 'Whistleblower reports',
+                'Whistleblower'):
+            # check_index leaves the session empty
+            document = Document.query.get(doc_id)
+            pre_tf = Posting.document_tf(document.id)
+            document.title = title
+            length, tf, positions = self.analyzer.term_positions(
+                document.corpus)
+            Posting.update_document(
+                document.id, pre_tf, tf, positions=positions)
+            CorpusStats.document_changed(status, pre_tf, 'published', tf)
+            status = 'published'
+            document.length = length
+            db.session.commit()
+            self.assertTrue(check_index(self.analyzer).ok)
+        self.assertEqual(
+            sorted(term for term, in db.session.query(Idf.term)),
+            ['book', 'whistleblow'])
+
+    def test_generation_swap(self):
+        document = Document(
+            doc_type='book', title='Reports', document_status='published')
+        db.session.add(document)
+        db.session.flush()
+        Posting.update_document(document.id, {}, {'old': 1})
+        CorpusStats.recompute()
+        db.session.commit()
+
+        generation = begin_generation('regex')
+        Posting.rebuild([(document.id, {'new': 2})], generation.id)
+        db.session.commit()
+        self.assertEqual(Posting.document_tf(document.id), {'old': 1})
+
+        self.assertEqual(catch_up(generation, self.analyzer), 0)
+        version = CorpusStats.current()
+        self.assertEqual(CorpusStats.activate(generation.id), version + 1)
+        db.session.commit()
+        self.assertEqual(Posting.document_tf(document.id), {'new': 2})
+        self.assertEqual(Document.query.get(document.id).length, 2)
+        self.assertEqual(CorpusStats.get().total_length, 2)
+        self.assertEqual(
+            IndexGeneration.query.get(generation.id).status, 'active')
+
+        self.assertEqual(inactive_generations(), [0])
+        drop_generation(0)
+        db.session.commit()
+        self.assertEqual(Idf.query.filter_by(generation=0).count(), 0)
+        self.assertRaises(ValueError, drop_generation, generation.id)
+
+    def test_searches_use_the_activated_generation(self):
+        ids = self.index_documents(
+            'Whistleblower laws', 'Tax reports', 'Court records')
+        # Stand-ins for terms the old analysis produced
+        Posting.update_document(
+            ids[0], Posting.document_tf(ids[0]), {'old': 1})
+        db.session.commit()
+        search_index.sync(CorpusStats.current())
+        self.assertEqual(search_index.candidates(['old']), {ids[0]})
+
+        generation = self.build()
+        self.assertEqual(activate_generation(generation, self.analyzer), 0)
+        self.assertEqual(CorpusStats.generation(), generation.id)
+        search_index.sync(CorpusStats.current())
+        self.assertEqual(search_index.candidates(['old']), set())
+        self.assertEqual(
+            search_index.candidates(['whistleblow', 'tax']),
+            {ids[0], ids[1]})
+        self.assertEqual(search_index.df('law'), 1)
+
+    def test_edits_during_the_switch_are_kept(self):
+        ids = self.index_documents(
+            'Whistleblower laws', 'Tax reports', 'Court records')
+        generation = self.build()
+        first = Document.query.get(ids[0])
+        self.edit(first, 'Whistleblower laws amended')
+        real_catch_up = generations.catch_up
+
+        def catch_up_then_edit(*args, **kwargs):
+            edited = real_catch_up(*args, **kwargs)
+            if not catch_up_then_edit.called:
+                # Saved by an editor before the switch, so into the old
+                # generation
+                catch_up_then_edit.called = True
+                self.edit(Document.query.get(ids[1]), 'Tax fraud reports')
+            return edited
+        catch_up_then_edit.called = False
+
+        # The second catch-up goes back SYNC_SLACK, so it re-reads the
+        # first edit as well as the one made between the catch-ups
+        with mock.patch.object(
+                generations, 'catch_up', side_effect=catch_up_then_edit):
+            self.assertEqual(
+                activate_generation(generation, self.analyzer), 3)
+        self.assertEqual(CorpusStats.generation(), generation.id)
+        self.assertIn('amend', Posting.document_tf(ids[0]))
+        self.assertIn('fraud', Posting.document_tf(ids[1]))
+        self.assertTrue(check_index(self.analyzer).ok)
+
+    def test_the_switch_catches_up_under_the_lock(self):
+        ids = self.index_documents('Whistleblower laws', 'Tax reports')
+        generation = self.build()
+        real_catch_up = generations.catch_up
+        steps = []
+
+        def catch_up_then_edit(*args, **kwargs):
+            edited = real_catch_up(*args, **kwargs)
+            steps.append('catch_up')
+            if len(steps) == 1:
+                # Stamped before the switch started but committed after the
+                # first catch-up read the edited documents
+                self.edit(
+                    Document.query.get(ids[1]), 'Tax fraud reports',
+                    datetime.datetime.utcnow() - SYNC_SLACK / 2)
+            return edited
+
+        def lock():
+            steps.append('lock')
+            return real_lock()
+        real_lock = CorpusStats.lock
+
+        with mock.patch.object(
+                generations, 'catch_up', side_effect=catch_up_then_edit), \
+                mock.patch.object(CorpusStats, 'lock', side_effect=lock):
+            activate_generation(generation, self.analyzer)
+        self.assertEqual(steps, ['catch_up', 'lock', 'catch_up'])
+        self.assertEqual(CorpusStats.generation(), generation.id)
+        self.assertIn('fraud', Posting.document_tf(ids[1]))
+        self.assertTrue(check_index(self.analyzer).ok)
+
+    def test_failed_reindex_stops_its_workers(self):
+        from manage import reindex
+
+        self.index_documents('Whistleblower laws')
+        with mock.patch('multiprocessing.Pool') as Pool, \
+                mock.patch.object(
+                    Posting, 'rebuild', side_effect=RuntimeError), \
+                redirect_stdout(io.StringIO()):
+            with self.assertRaises(RuntimeError):
+                reindex(1, 10)
+        pool = Pool.return_value
+        pool.terminate.assert_called_once_with()
+        pool.join.assert_called_once_with()
+        self.assertFalse(pool.close.called)
+        self.assertEqual(IndexGeneration.query.count(), 0)
+        self.assertEqual(CorpusStats.generation(), 0)
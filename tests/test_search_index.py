@@ -0,0 +1,442 @@
+import math
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from app import create_app
+from app.search.analysis import Analyzer
+from app.search.cache import QueryCache
+from app.search.codec import (
+    BLOCK_SIZE, Postings, decode_positions, encode_positions, intersect,
+    union
+)
+from app.search.facets import FacetIndex, from_bitmap, to_bitmap
+from app.search.index import InvertedIndex
+from app.search.matrix import available
+from app.search.phrases import in_order, within
+from app.search.ranking import BM25, top_k
+from app.search.snapshot import Snapshot, write_snapshot
+from app.search.vocabulary import Vocabulary, edit_distance
+
+
+class SearchIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.index = InvertedIndex()
+        self.index.loaded = True
+        self.index.update(1, {'whistl': 2, 'law': 1}, published=True)
+        self.index.update(2, {'law': 3}, published=True)
+        self.index.update(3, {'report': 1}, published=True)
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_candidates(self):
+        self.assertEqual(self.index.candidates(['law']), {1, 2})
+        self.assertEqual(
+            self.index.candidates(['whistl', 'report']), {1, 3})
+        self.assertEqual(self.index.candidates(['missing']), set())
+
+    def test_postings_are_sorted(self):
+        self.index.update(0, {'law': 1}, published=True)
+        self.assertEqual(
+            list(self.index.term_postings('law').doc_ids()), [0, 1, 2])
+
+    def test_score(self):
+        scores = self.index.score(['whistl', 'report'])
+        idf = math.log(3 / 2)
+        self.assertEqual(scores, {1: 2 * idf, 3: 1 * idf})
+        scores = self.index.score(['whistl'], doc_ids=[2, 3])
+        self.assertEqual(scores, {})
+
+    def test_bm25_prefers_shorter_documents(self):
+        self.index.update(4, {'report': 1, 'law': 20}, published=True)
+        self.index.ranker = BM25()
+        scores = self.index.score(['report'])
+        self.assertGreater(scores[3], scores[4])
+        self.assertEqual(self.index.avg_length, (3 + 3 + 1 + 21) / 4)
+
+    def test_update_replaces_terms(self):
+        self.index.update(1, {'report': 4}, published=True)
+        self.assertEqual(self.index.candidates(['whistl']), set())
+        self.assertEqual(self.index.candidates(['law']), {2})
+        self.assertEqual(self.index.df('report'), 2)
+
+    def test_only_published_documents_count(self):
+        self.index.update(4, {'report': 5})
+        self.assertEqual(self.index.num_docs, 3)
+        self.assertEqual(self.index.df('report'), 1)
+        self.assertEqual(self.index.candidates(['report']), {3, 4})
+        self.index.set_published(4, True)
+        self.assertEqual(self.index.df('report'), 2)
+        self.assertEqual(self.index.avg_length, (3 + 3 + 1 + 5) / 4)
+        self.index.set_published(1, False)
+        self.assertEqual(self.index.df('whistl'), 0)
+
+    def test_remove(self):
+        self.index.remove(3)
+        self.assertEqual(self.index.num_docs, 2)
+        self.assertEqual(self.index.candidates(['report']), set())
+        self.index.merge()
+        self.assertNotIn('report', self.index.base)
+
+    def test_max_score_top_k(self):
+        self.index.update(4, {'law': 1, 'report': 4}, published=True)
+        self.index.update(5, {'law': 1}, published=True)
+        terms = ['law', 'law', 'report']
+        ids = sorted(self.index.candidates(terms), reverse=True)
+        expected = top_k(ids, self.index.score(terms), 3)
+        self.assertEqual(self.index.top_k(terms, 3), expected)
+        self.assertEqual(self.index.top_k(terms, 2, [1, 5]), [5, 1])
+        self.assertEqual(self.index.top_k(['missing'], 3), [])
+        self.assertEqual(self.index.term_postings('report').max_tf, 4)
+        self.index.remove(4)
+        self.index.merge()
+        self.assertEqual(self.index.term_postings('report').max_tf, 1)
+
+    def test_snapshot(self):
+        self.index.words['whistl'] = 'whistle'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.snapshot')
+            write_snapshot(self.index, path, 7, 0, 0.0)
+            snapshot = Snapshot(path)
+            index = InvertedIndex()
+            index.use_snapshot(snapshot)
+            self.assertEqual(snapshot.version, 7)
+            self.assertEqual(index.num_docs, 3)
+            self.assertEqual(index.score(['law']), self.index.score(['law']))
+            self.assertEqual(index.doc_terms[1], ('law', 'whistl'))
+            self.assertEqual(index.word('whistl'), 'whistle')
+            self.assertEqual(dict(snapshot.words), {'whistl': 'whistle'})
+
+            index.update(2, {'report': 2}, published=True)
+            index.remove(1)
+            self.assertEqual(index.candidates(['law', 'report']), {2, 3})
+            self.assertEqual(index.df('law'), 0)
+            index.merge()
+            self.assertNotIn('law', index.base)
+            self.assertEqual(index.vocabulary().complete('w'), [])
+            self.assertEqual(index.vocabulary().complete('r'), [('report', 2)])
+            self.assertEqual(list(snapshot.postings['law'].doc_ids()), [1, 2])
+
+    def test_segments(self):
+        self.index.merge()
+        self.index.update(1, {'report': 2}, published=True)
+        self.index.remove(2)
+        self.index.update(4, {'law': 2}, published=True)
+        self.assertEqual(list(self.index.base['law'].doc_ids()), [1, 2])
+        self.assertEqual(self.index.terms_of(1), ('report',))
+        self.assertEqual(self.index.candidates(['law']), {4})
+        self.assertEqual(
+            list(self.index.term_postings('report').items()),
+            [(1, 2), (3, 1)])
+        self.assertEqual(self.index.top_k(['law', 'report'], 3), [4, 3, 1])
+
+        self.assertTrue(self.index.merge())
+        self.assertFalse(self.index.merge())
+        self.assertEqual(list(self.index.base['law'].doc_ids()), [4])
+        self.assertNotIn('whistl', self.index.base)
+        self.assertNotIn(2, self.index.doc_terms)
+        self.assertEqual(self.index.candidates(['law', 'report']), {1, 3, 4})
+
+    def test_phrase_docs(self):
+        def at(*positions):
+            return encode_positions(list(positions))
+
+        tf = {'fals': 1, 'claim': 1, 'act': 1}
+        self.index.update(
+            4, tf, True, {'fals': at(0), 'claim': at(1), 'act': at(2)})
+        self.index.update(
+            5, tf, True, {'act': at(0), 'fals': at(5), 'claim': at(9)})
+        self.index.update(6, tf, True)
+        terms = (('fals', 0), ('claim', 1), ('act', 2))
+        self.assertEqual(
+            self.index.phrase_docs((terms, 0), [1, 4, 5, 6]), [4, 6])
+        self.assertEqual(self.index.phrase_docs((terms, 7), [4, 5]), [4, 5])
+        self.assertEqual(self.index.phrase_docs((terms, 6), [4, 5]), [4])
+        self.assertEqual(
+            self.index.phrase_docs(((('fals', 0), ('law', 1)), 0), [1, 4]),
+            [])
+        self.index.update(4, tf, True)
+        self.index.remove(6)
+        self.assertEqual(self.index.positions, {5: {
+            'act': at(0), 'fals': at(5), 'claim': at(9)}})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.snapshot')
+            write_snapshot(self.index, path, 1, 0, 0.0)
+            index = InvertedIndex()
+            index.use_snapshot(Snapshot(path))
+            self.assertEqual(
+                bytes(index.positions[5].get('claim')), at(9))
+            self.assertIsNone(index.positions[4].get('claim'))
+            self.assertIsNone(index.positions[5].get('law'))
+            self.assertEqual(
+                index.phrase_docs((terms, 0), [4, 5]), [4])
+
+    def test_corrections(self):
+        self.assertEqual(
+            self.index.corrections(['reprt', 'law', 'lwa']),
+            {'reprt': [('report', 1)]})
+        self.index.update(4, {'reprt': 1}, published=True)
+        self.assertEqual(self.index.corrections(['reprt']), {})
+
+    def test_vocabulary_is_built_outside_the_lock(self):
+        def search():
+            acquired = self.index._lock.acquire(timeout=1)
+            if acquired:
+                self.index._lock.release()
+            searched.append(acquired)
+
+        def build(dfs):
+            # A search in another thread is not kept waiting meanwhile
+            thread = threading.Thread(target=search)
+            thread.start()
+            thread.join()
+            return Vocabulary(dfs)
+        searched = []
+
+        with mock.patch('app.search.index.Vocabulary', side_effect=build):
+            vocabulary = self.index.vocabulary()
+        self.assertEqual(searched, [True])
+        self.assertIs(self.index.vocabulary(), vocabulary)
+        self.index.merge()
+        self.assertIsNot(self.index.vocabulary(), vocabulary)
+
+    @unittest.skipUnless(available(), 'needs numpy and scipy')
+    def test_vectorized_top_k(self):
+        self.index.update(4, {'law': 1, 'report': 4}, published=True)
+        self.index.vectorized = True
+        self.index.merge()
+        self.assertIsNotNone(self.index.matrix)
+        self.index.update(5, {'law': 1}, published=True)
+        self.index.remove(4)
+        self.index.ranker = BM25()
+        terms = ['law', 'law', 'report']
+        ids = sorted(self.index.candidates(terms), reverse=True)
+        expected = top_k(ids, self.index.score(terms), 3)
+        self.assertEqual(self.index.top_k(terms, 3), expected)
+        self.assertEqual(
+            self.index.top_k(terms, 2, [1, 5]),
+            top_k([5, 1], self.index.score(terms, [1, 5]), 2))
+
+    def test_top_k(self):
+        scores = {1: 0.5, 2: 2.0, 3: 0.5, 4: 1.0}
+        self.assertEqual(top_k([1, 2, 3, 4], scores, 2), [2, 4])
+        self.assertEqual(top_k([3, 1, 2], scores, 3), [2, 3, 1])
+        self.assertEqual(top_k([5], scores, 1), [5])
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = QueryCache(max_size=2, ttl=60)
+        cache.set('a', 1, [1])
+        cache.set('b', 1, [2])
+        cache.get('a', 1)
+        cache.set('c', 1, [3])
+        self.assertEqual(cache.get('a', 1), [1])
+        self.assertIsNone(cache.get('b', 1))
+
+    def test_new_version_clears(self):
+        cache = QueryCache()
+        cache.set('a', 1, [1])
+        self.assertIsNone(cache.get('a', 2))
+        self.assertIsNone(cache.get('a', 1))
+
+    def test_older_version_is_ignored(self):
+        cache = QueryCache()
+        cache.set('a', 2, [1])
+        # A request that started before the corpus changed finishes late
+        cache.set('b', 1, [2])
+        self.assertIsNone(cache.get('a', 1))
+        self.assertEqual(cache.get('a', 2), [1])
+        self.assertIsNone(cache.get('b', 2))
+
+    def test_ttl(self):
+        cache = QueryCache(ttl=-1)
+        cache.set('a', 1, [1])
+        self.assertIsNone(cache.get('a', 1))
+
+
+class AnalyzerTestCase(unittest.TestCase):
+    def test_case_insensitive(self):
+        analyzer = Analyzer()
+        self.assertEqual(
+            analyzer.analyze('The Whistleblower Laws'),
+            analyzer.analyze('the whistleblower laws'))
+        self.assertNotIn('the', analyzer.analyze('The Whistleblower Laws'))
+
+    def test_punctuation_is_dropped(self):
+        analyzer = Analyzer()
+        self.assertEqual(analyzer.analyze('Reports, laws.'), ['report', 'law'])
+        length, tf = analyzer.term_frequencies('law, law; report')
+        self.assertEqual(length, 3)
+        self.assertEqual(tf, {'law': 2, 'report': 1})
+        self.assertEqual(
+            analyzer.analyze_many(['laws', 'Reports']), [['law'], ['report']])
+
+    def test_positions_and_phrases(self):
+        analyzer = Analyzer()
+        length, tf, positions = analyzer.term_positions('The law of the law')
+        self.assertEqual((length, tf), (2, {'law': 2}))
+        self.assertEqual(decode_positions(positions['law']), [1, 4])
+        terms, phrases = analyzer.parse_query(
+            '"false claims act" "act of Congress"~2 "laws" reports')
+        self.assertEqual(
+            terms, ('act', 'act', 'claim', 'congress', 'fals', 'law',
+                    'report'))
+        self.assertEqual(phrases, (
+            ((('act', 0), ('congress', 2)), 2),
+            ((('fals', 0), ('claim', 1), ('act', 2)), 0),
+        ))
+
+    def test_words_of_terms(self):
+        analyzer = Analyzer()
+        analyzer.term_positions('Falsely filed false claims')
+        analyzer.term_positions('A claim of retaliation')
+        self.assertEqual(analyzer.word('fals'), 'false')
+        self.assertEqual(analyzer.word('claim'), 'claim')
+        self.assertIsNone(analyzer.word('report'))
+        for term in ('fals', 'claim', 'retali'):
+            self.assertEqual(analyzer.analyze(analyzer.word(term)), [term])
+
+
+class PhraseTestCase(unittest.TestCase):
+    def test_in_order(self):
+        self.assertTrue(in_order([[3, 9], [2, 11], [13]], [0, 2, 4]))
+        self.assertFalse(in_order([[3, 9], [2, 10], [13]], [0, 2, 4]))
+        self.assertTrue(in_order([[1, 4], [1, 4]], [0, 3]))
+
+    def test_within(self):
+        self.assertTrue(within([[1, 20], [5, 21], [22]], 3))
+        self.assertFalse(within([[1, 20], [5, 21], [24]], 3))
+        self.assertTrue(within([[7], [7]], 1))
+
+
+class PostingsCodecTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        doc_ids = list(range(5, 5 + 3 * BLOCK_SIZE * 7, 7))
+        tfs = [i % 300 + 1 for i in range(len(doc_ids))]
+        postings = Postings(doc_ids, tfs)
+        self.assertEqual(len(postings.blocks), 3)
+        self.assertEqual(list(postings.items()), list(zip(doc_ids, tfs)))
+        self.assertEqual(postings.max_tf, 300)
+
+    def test_add_and_remove(self):
+        postings = Postings([10, 20, 30], [1, 5, 1])
+        postings.add(15, 2)
+        postings.add(10**10, 1)
+        postings.remove(20)
+        postings.remove(99)
+        self.assertEqual(
+            list(postings.items()), [(10, 1), (15, 2), (30, 1), (10**10, 1)])
+        self.assertEqual(postings.max_tf, 2)
+        self.assertEqual(len(postings), 4)
+
+    def test_cursor_seek(self):
+        doc_ids = list(range(0, 2000, 3))
+        cursor = Postings(doc_ids, [1] * len(doc_ids)).cursor()
+        cursor.seek(1000)
+        self.assertEqual(cursor.doc_id, 1002)
+        cursor.next()
+        self.assertEqual(cursor.doc_id, 1005)
+        cursor.seek(5000)
+        self.assertIsNone(cursor.doc_id)
+
+    def test_intersect_and_union(self):
+        a = Postings(list(range(0, 1000, 2)), [1] * 500)
+        b = Postings(list(range(0, 1000, 3)), [1] * 334)
+        self.assertEqual(list(intersect([a, b])), list(range(0, 1000, 6)))
+        self.assertEqual(
+            list(union([a, b])),
+            sorted(set(range(0, 1000, 2)) | set(range(0, 1000, 3))))
+
+
+class FacetIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.facets = FacetIndex()
+        self.facets.set(1, 'book', 'published', [1, 2], 20010615)
+        self.facets.set(2, 'law', 'published', [2], 20050101)
+        self.facets.set(3, 'book', 'draft', [], 20011231)
+        self.facets.set(70, 'video', 'published', [1], 19990101)
+        self.facets.set(71, 'video', 'published', [], None)
+
+    def test_bitmaps(self):
+        self.assertEqual(list(from_bitmap(to_bitmap([70, 0, 9]))), [0, 9, 70])
+        self.assertEqual(
+            list(from_bitmap(self.facets.bitmap('tag', [1]))), [1, 70])
+        self.facets.set(70, 'video', 'published', [2], 19990101)
+        self.facets.remove(1)
+        self.assertEqual(list(from_bitmap(self.facets.bitmap('tag', [1]))), [])
+        self.assertNotIn(1, self.facets.bitmaps['tag'])
+        self.assertEqual(
+            list(from_bitmap(self.facets.bitmap('doc_type', ['book']))), [3])
+
+    def test_select(self):
+        docs = [1, 2, 3, 70]
+        self.assertEqual(
+            self.facets.select(docs, status='published'), [1, 2, 70])
+        self.assertEqual(
+            self.facets.select(docs, doc_types=['book', 'law']), [1, 2, 3])
+        self.assertEqual(self.facets.select(docs, tag_ids=[1]), [1, 70])
+        self.assertEqual(self.facets.select(docs, tag_ids=[]), [])
+        self.assertEqual(self.facets.select([2, 3], tag_ids=[2]), [2])
+        self.assertEqual(
+            self.facets.select(docs, tag_ids=[1, 2], all_tags=True), [1])
+        self.assertEqual(
+            self.facets.select(docs, start=20010701, end=20050101), [2, 3])
+        self.assertEqual(self.facets.select(docs, end=20010615), [1, 70])
+        self.assertEqual(
+            self.facets.select([70, 71], start=19600101, end=20001231), [70])
+
+    def test_counts(self):
+        counts = self.facets.counts([1, 2, 3])
+        self.assertEqual(counts['doc_type'], {'book': 2, 'law': 1})
+        self.assertEqual(counts['tag'], {1: 1, 2: 2})
+        self.assertEqual(counts['year'], {2001: 2, 2005: 1})
+        # Undated documents count as year 0
+        self.assertEqual(
+            self.facets.counts([1, 71], facets=['year']),
+            {'year': {2001: 1, 0: 1}})
+        self.assertEqual(
+            self.facets.counts([], facets=['doc_type']), {'doc_type': {}})
+
+
+class VocabularyTestCase(unittest.TestCase):
+    def test_complete(self):
+        vocabulary = Vocabulary([
+            ('law', 5), ('lawyer', 2), ('lawsuit', 9), ('leak', 5),
+            ('lax', 0), ('report', 1)])
+        self.assertEqual(len(vocabulary), 5)
+        self.assertEqual(
+            vocabulary.complete('law'),
+            [('lawsuit', 9), ('law', 5), ('lawyer', 2)])
+        self.assertEqual(
+            vocabulary.complete('l', 2), [('lawsuit', 9), ('law', 5)])
+        self.assertEqual(vocabulary.complete('lax'), [])
+        self.assertEqual(vocabulary.complete(''), [])
+
+    def test_similar(self):
+        vocabulary = Vocabulary([
+            ('whistleblow', 4), ('whistl', 7), ('report', 3),
+            ('reporter', 1), ('retort', 2), ('law', 5)])
+        self.assertEqual(vocabulary.similar('reprt'), [('report', 3)])
+        self.assertEqual(
+            vocabulary.similar('repor'), [('report', 3)])
+        # Two edits are allowed from eight letters on
+        self.assertEqual(
+            vocabulary.similar('wistlebow'), [('whistleblow', 4)])
+        self.assertEqual(vocabulary.similar('wistl'), [('whistl', 7)])
+        self.assertEqual(vocabulary.similar('lwa'), [])
+        self.assertEqual(vocabulary.similar('report'), [('retort', 2)])
+        self.assertEqual(vocabulary.similar('zzzzzz'), [])
+
+    def test_edit_distance(self):
+        self.assertEqual(edit_distance('report', 'retort', 2), 1)
+        self.assertEqual(edit_distance('report', 'rpeort', 2), 2)
+        self.assertEqual(edit_distance('report', 'law', 2), 3)
+        self.assertEqual(edit_distance('', 'law', 5), 3)
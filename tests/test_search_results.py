@@ -0,0 +1,85 @@
+import unittest
+
+from app import create_app, db
+from app.models import Document, Tag, Tagged
+from app.search import search_index
+from app.search.results import SNIPPET_CHARS, load_summaries, snippet
+
+
+class SnippetTestCase(unittest.TestCase):
+    def test_short_descriptions_are_kept(self):
+        self.assertEqual(snippet('', 0), '')
+        self.assertEqual(snippet(None, None), '')
+        text = ' '.join(['word'] * 25)
+        self.assertEqual(snippet(text, len(text)), text)
+
+    def test_long_descriptions_are_cut_to_words(self):
+        words = ['w{}'.format(i) for i in range(40)]
+        text = ' '.join(words)
+        self.assertEqual(
+            snippet(text, len(text)), ' '.join(words[:25]) + '...')
+
+        # Fewer than 25 words fit in SNIPPET_CHARS; the last one is cut
+        words = ['{:030d}'.format(i) for i in range(20)]
+        text = ' '.join(words)[:SNIPPET_CHARS]
+        self.assertEqual(
+            snippet(text, 20 * 31 - 1), ' '.join(words[:12]) + '...')
+
+
+class LoadSummariesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        search_index.loaded = False
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        search_index.loaded = False
+        self.app_context.pop()
+
+    def add_document(self, title, description=None, tags=()):
+        document = Document(
+            doc_type='book', title=title, description=description,
+            document_status='published')
+        db.session.add(document)
+        db.session.flush()
+        for tag in tags:
+            db.session.add(Tagged(
+                tag_id=tag.id, document_id=document.id, tag_name=tag.tag))
+        db.session.commit()
+        return document.id
+
+    def test_load_summaries(self):
+        tags = [Tag(tag='Retaliation'), Tag(tag='Federal')]
+        db.session.add_all(tags)
+        db.session.commit()
+        long_description = ' '.join(['Whistleblower'] * 100)
+        first = self.add_document('First', long_description, tags)
+        second = self.add_document('Second', 'Short', tags[:1])
+        third = self.add_document('Third')
+
+        summaries = load_summaries([third, 999, first, second])
+        self.assertEqual(
+            [s.id for s in summaries], [third, first, second])
+        self.assertEqual(
+            [s.title for s in summaries], ['Third', 'First', 'Second'])
+        self.assertEqual(
+            [s.tags for s in summaries],
+            [[], ['Federal', 'Retaliation'], ['Retaliation']])
+        self.assertEqual(
+            [s.description for s in summaries],
+            ['', ' '.join(['Whistleblower'] * 25) + '...', 'Short'])
+        self.assertEqual(load_summaries([]), [])
+
+    def test_results_show_escaped_snippets(self):
+        self.add_document(
+            'First', '<b>Whistleblower</b> rules ' + 'x ' * 30)
+
+        html = self.app.test_client().get('/').get_data(as_text=True)
+        self.assertIn(
+            '&lt;b&gt;Whistleblower&lt;/b&gt; rules ' + 'x ' * 22 + 'x...',
+            html)
+        self.assertNotIn('<b>Whistleblower</b>', html)
@@ -0,0 +1,352 @@
+import datetime
+import json
+import os
+import re
+import tempfile
+import time
+import unittest
+from html.parser import HTMLParser
+from unittest import mock
+
+from app import create_app, db
+from app.adtributor.views import (
+    commit_corpus_change, set_document_status, update_idf
+)
+from app.models import CorpusStats, Document, Posting
+from app.search import analyzer, query_cache, search_index
+from app.search.snapshot import write_snapshot
+
+RESULT_RE = re.compile(r"location.href='/resource/(\d+)'")
+SHOWING_RE = re.compile(
+    r'Showing results\s+(\d+)\s+&ndash;\s+(\d+)\s+out of (\d+)')
+
+
+class FormDefaults(HTMLParser):
+    """The values a browser would submit for the inputs of a page."""
+
+    def __init__(self):
+        super(FormDefaults, self).__init__()
+        self.values = {}
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag != 'input' or not attrs.get('name'):
+            return
+        if attrs.get('type') == 'checkbox' and 'checked' not in attrs:
+            return
+        self.values[attrs['name']] = attrs.get('value') or ''
+
+
+class SearchViewsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        search_index.loaded = False
+        query_cache.clear()
+        self.edited = datetime.datetime(2019, 1, 1)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        search_index.loaded = False
+        self.app_context.pop()
+
+    def add_document(self, title, status='published', **kwargs):
+        """Save a document the way the editor views do."""
+        # Each document counts as edited after the previous one
+        self.edited += datetime.timedelta(days=1)
+        document = Document(
+            doc_type='book', title=title, document_status=status,
+            last_edited_date=self.edited, **kwargs)
+        db.session.add(document)
+        db.session.flush()
+        length, tf, positions = analyzer.term_positions(document.corpus)
+        update_idf(
+            document.id, {}, tf, post_status=status, positions=positions)
+        document.length = length
+        commit_corpus_change()
+        return document.id
+
+    def search(self, **values):
+        """Submit the search form as rendered, changing only `values`."""
+        page = FormDefaults()
+        page.feed(self.client.get('/').get_data(as_text=True))
+        data = dict(page.values, **values)
+        return self.client.post('/', data=data).get_data(as_text=True)
+
+    def result_ids(self, html):
+        """Ids of the listed documents, in order."""
+        return [int(doc_id) for doc_id in RESULT_RE.findall(html)]
+
+    def pages(self, html):
+        """
+        (first, last, total) of the results shown, and whether there are
+        previous and next pages.
+        """
+        showing = tuple(int(n) for n in SHOWING_RE.search(html).groups())
+        return (showing, 'prev-page disabled' not in html,
+                'next-page disabled' not in html)
+
+    def test_default_search_ranks_by_relevance(self):
+        best = self.add_document('Whistleblower whistleblower protection')
+        other = self.add_document('Whistleblower report')
+        for title in ('Tax law', 'Court records', 'Agency budgets'):
+            self.add_document(title)
+
+        html = self.search(query='whistleblower')
+        self.assertEqual(self.result_ids(html), [best, other])
+
+    def test_autocomplete_offers_words(self):
+        found = self.add_document('False claims and retaliation')
+        for title in ('Tax law', 'Court records', 'Agency budgets'):
+            self.add_document(title)
+        # Read the words back from the database, as another worker would
+        analyzer.words.clear()
+
+        response = self.client.get('/autocomplete?q=whistleblower+fal')
+        terms = json.loads(response.get_data(as_text=True))['terms']
+        self.assertEqual(
+            terms, [dict(term='fals', word='false', df=1)])
+        html = self.search(query='whistleblower ' + terms[0]['word'])
+        self.assertEqual(self.result_ids(html), [found])
+
+    def test_suggestion_uses_words(self):
+        found = self.add_document('Whistleblower retaliation')
+        for title in ('Tax law', 'Court records', 'Agency budgets'):
+            self.add_document(title)
+        analyzer.words.clear()
+
+        html = self.search(query='whistlebower retaliation')
+        self.assertEqual(self.result_ids(html), [found])
+        suggestion = re.search(r'searchFor\((.*?)\)', html).group(1)
+        self.assertEqual(
+            json.loads(suggestion),
+            'whistleblower retaliation')
+        html = self.search(query='whistleblower retaliation')
+        self.assertEqual(self.result_ids(html), [found])
+
+    def test_suggestion_keeps_phrases(self):
+        found = self.add_document('Whistleblower retaliation claims')
+        for title in ('Tax law', 'Court records', 'Agency budgets'):
+            self.add_document(title)
+
+        html = self.search(query='"whistlebower retaliation"~2 claims')
+        suggestion = json.loads(
+            re.search(r'searchFor\((.*?)\)', html).group(1))
+        self.assertEqual(suggestion, '"whistleblower retaliation"~2 claims')
+        html = self.search(query=suggestion)
+        self.assertEqual(self.result_ids(html), [found])
+
+    def test_sync_reads_only_changed_documents(self):
+        first = self.add_document('Whistleblower report')
+        for title in ('Tax law', 'Court records', 'Agency budgets'):
+            self.add_document(title)
+        self.assertEqual(
+            self.result_ids(self.search(query='whistleblower')), [first])
+
+        # Saved by another worker, leaving this one's index behind
+        with mock.patch.object(search_index, 'update'), \
+                mock.patch.object(search_index, 'advance'):
+            second = self.add_document('Whistleblower protection')
+        with mock.patch.object(
+                search_index, 'load_database',
+                side_effect=AssertionError('the index was reloaded')), \
+                mock.patch.object(
+                    search_index.facets, 'load',
+                    side_effect=AssertionError('the facets were reloaded')):
+            html = self.search(query='whistleblower')
+        self.assertEqual(sorted(self.result_ids(html)), [first, second])
+
+    def test_sync_refreshes_facets_of_changed_documents(self):
+        first = self.add_document('Whistleblower report')
+        draft = self.add_document('Whistleblower protection', 'draft')
+        gone = self.add_document('Whistleblower memo')
+        self.assertEqual(
+            sorted(self.result_ids(self.search(query='whistleblower'))),
+            [first, gone])
+
+        # Published and deleted by another worker without editing either,
+        # so only their status tells this worker's index what changed
+        with mock.patch.object(search_index, 'set_published'), \
+                mock.patch.object(search_index, 'advance'), \
+                mock.patch.object(search_index.facets, 'refresh'):
+            set_document_status(Document.query.get(draft), 'published')
+            commit_corpus_change()
+        Posting.query.filter_by(document_id=gone).delete()
+        Document.query.filter_by(id=gone).delete()
+        with mock.patch.object(search_index, 'advance'):
+            commit_corpus_change()
+        with mock.patch.object(
+                search_index.facets, 'load',
+                side_effect=AssertionError('the facets were reloaded')):
+            html = self.search(query='whistleblower')
+        self.assertEqual(sorted(self.result_ids(html)), [first, draft])
+        self.assertNotIn(gone, search_index.facets.documents)
+
+    def write_snapshot(self, path):
+        """Write the loaded index to `path`, as write_index_snapshot does."""
+        write_snapshot(
+            search_index, path, CorpusStats.current(),
+            CorpusStats.generation(), time.time())
+
+    def test_snapshot_catch_up_goes_back_sync_slack(self):
+        first = self.add_document('Whistleblower report')
+        self.add_document('Tax law')
+        self.search(query='whistleblower')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.snapshot')
+            self.write_snapshot(path)
+            # Stamped a minute before the snapshot was written, committed
+            # by another worker after it
+            document = Document.query.get(first)
+            pre_tf = Posting.document_tf(first)
+            document.title = 'Whistleblower fraud report'
+            document.last_edited_date = (
+                datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+            length, tf, positions = analyzer.term_positions(document.corpus)
+            with mock.patch.object(search_index, 'update'), \
+                    mock.patch.object(search_index, 'advance'):
+                update_idf(
+                    first, pre_tf, tf, 'published', 'published', positions)
+                document.length = length
+                commit_corpus_change()
+
+            search_index.loaded = False
+            with mock.patch.object(search_index, 'snapshot_path', path), \
+                    mock.patch.object(
+                        search_index, 'load_database',
+                        side_effect=AssertionError('snapshot not used')):
+                html = self.search(query='fraud')
+            search_index.snapshot = None
+        self.assertEqual(self.result_ids(html), [first])
+
+    def test_damaged_snapshot_falls_back_to_the_database(self):
+        first = self.add_document('Whistleblower report')
+        self.add_document('Tax law')
+        self.search(query='whistleblower')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.snapshot')
+            self.write_snapshot(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            for size in (0, 20, 200, len(data) // 2):
+                with open(path, 'wb') as f:
+                    f.write(data[:size])
+                search_index.loaded = False
+                search_index.snapshot = None
+                query_cache.clear()
+                with mock.patch.object(
+                        search_index, 'snapshot_path', path), \
+                        mock.patch.object(
+                            search_index, 'load_database',
+                            wraps=search_index.load_database) as load:
+                    html = self.search(query='whistleblower')
+                self.assertTrue(load.called)
+                self.assertEqual(self.result_ids(html), [first])
+
+    def test_failed_save_changes_nothing(self):
+        for title in ('Tax law', 'Court records', 'Agency budgets'):
+            self.add_document(title)
+        self.assertEqual(self.result_ids(self.search(query='tax')), [1])
+
+        document = Document(
+            doc_type='book', title='Tax whistleblower',
+            document_status='published')
+        db.session.add(document)
+        db.session.flush()
+        doc_id = document.id
+        length, tf, positions = analyzer.term_positions(document.corpus)
+        update_idf(doc_id, {}, tf, post_status='published',
+                   positions=positions)
+        db.session.rollback()
+
+        self.assertIsNone(Document.query.get(doc_id))
+        self.assertEqual(Posting.document_tf(doc_id), {})
+        self.assertEqual(search_index.candidates(['whistleblow']), set())
+        self.assertEqual(self.result_ids(self.search(query='tax')), [1])
+
+    def test_pagination(self):
+        for n in range(1, 8):
+            self.add_document(' '.join(['Whistleblower'] * n))
+        for title in ('Tax law', 'Court records', 'Agency budgets'):
+            self.add_document(title)
+
+        # Later pages are asked for after the first is cached, which only
+        # holds the top of the ranking
+        pages = []
+        for page in (1, 2, 3):
+            html = self.search(
+                query='whistleblower', per_page='3', page=str(page))
+            pages.append(self.result_ids(html))
+            if page == 1:
+                self.assertEqual(self.pages(html), ((1, 3, 7), False, True))
+            elif page == 2:
+                self.assertEqual(self.pages(html), ((4, 6, 7), True, True))
+            else:
+                self.assertEqual(self.pages(html), ((7, 7, 7), True, False))
+        query_cache.clear()
+        ranked = self.result_ids(
+            self.search(query='whistleblower', per_page='100'))
+        self.assertEqual(pages, [ranked[:3], ranked[3:6], ranked[6:]])
+        self.assertEqual(len(ranked), 7)
+
+    def test_pagination_of_sorted_results(self):
+        ids = [self.add_document(title) for title in (
+            'Court records', 'Agency budgets', 'Tax law', 'Budget law')]
+
+        html = self.search(sort_by='title', per_page='2', page='2')
+        self.assertEqual(self.result_ids(html), [ids[0], ids[2]])
+        self.assertEqual(self.pages(html), ((3, 4, 4), True, False))
+        html = self.search(sort_by='title', per_page='4')
+        self.assertEqual(self.pages(html), ((1, 4, 4), False, False))
+
+    def test_filter_and_sort_by_publication_date(self):
+        titles = {}
+        for title, year, month, day in (
+                ('Whistleblower act', 1989, 'April', 10),
+                ('Whistleblower report', 2019, 'June', 5),
+                ('Tax law', 2018, 'March', 1),
+                ('Whistleblower review', 2019, 'January', 20),
+                ('Whistleblower history', 1970, None, None),
+                ('Whistleblower brief', 2019, 'June', 6)):
+            doc_id = self.add_document(
+                title, year=year, month=month, day=day)
+            titles[doc_id] = title.split()[-1]
+
+        def listed(**values):
+            html = self.search(**values)
+            return [titles[doc_id] for doc_id in self.result_ids(html)]
+
+        oldest = ['history', 'act', 'law', 'review', 'report', 'brief']
+        self.assertEqual(listed(sort_by='oldest'), oldest)
+        self.assertEqual(listed(sort_by='newest'), oldest[::-1])
+        self.assertEqual(
+            listed(query='whistleblower', sort_by='newest'),
+            ['brief', 'report', 'review', 'act', 'history'])
+
+        between = dict(
+            start_date='January 20, 2019', end_date='June 5, 2019',
+            sort_by='oldest')
+        self.assertEqual(listed(**between), ['review', 'report'])
+        self.assertEqual(
+            listed(query='whistleblower', **between), ['review', 'report'])
+        self.assertEqual(
+            listed(query='whistleblower', start_date='June 6, 2019'),
+            ['brief'])
+
+    def test_undated_documents_are_left_out_of_years(self):
+        dated = self.add_document(
+            'Whistleblower report', year=2019, month='June', day=5)
+        undated = self.add_document('Whistleblower memo')
+
+        html = self.search(query='whistleblower')
+        self.assertEqual(sorted(self.result_ids(html)), [dated, undated])
+        self.assertIn('<div class="item">2019 (1)</div>', html)
+        self.assertNotIn('<div class="item">0 (1)</div>', html)
+        self.assertEqual(
+            self.result_ids(self.search(
+                query='whistleblower', start_date='January 1, 1960')),
+            [dated])